@@ -4,6 +4,7 @@
 This module is for twitter bot.
 """
 
-from twitter_bot import (Config, NicoSearch, NicoVideo, NicoComment,
-                         YoutubeSearch, YoutubeVideo, Job, User, DbManager,
-                         JobManager, TwitterBotBase, TwitterBot, TwitterVideoBot)
+from twitter_bot import (Config, NicoSearch, AsyncNicoSearch, NicoVideo,
+                         NicoComment, YoutubeSearch, YoutubeVideo, Job, User,
+                         DbManager, JobManager, RateLimitScheduler,
+                         TwitterBotBase, TwitterBot, TwitterVideoBot)
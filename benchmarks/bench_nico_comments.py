@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of parsing message server responses.
+
+Usage: python benchmarks/bench_nico_comments.py [num_chats ...]
+
+A response with num_chats <chat> elements is built from the chats in
+samples/sample_nico_comments.txt, and parsed by xml.dom.minidom (as
+search_videos_with_comments() did) and by NicoCommentParser, with half
+of the comments older than from_datetime. Each parser runs in its own
+process to measure the growth of the peak RSS.
+"""
+
+from __future__ import print_function
+import StringIO
+import datetime
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import time
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from twitter_bot import NicoComment, NicoCommentParser
+
+SAMPLE_NICO_COMMENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    '..', 'samples', 'sample_nico_comments.txt')
+DEFAULT_SIZES = [1000, 10000]
+REPEAT = 5
+BASE_DATE = 1356594224
+
+
+def make_response(num_chats):
+    with open(SAMPLE_NICO_COMMENTS) as f:
+        sample = f.read()
+    start = sample.index('<?xml')
+    end = sample.index('</packet>', start)
+    chats = re.findall(r'<chat [^>]*>[^<]*</chat>', sample[start:end])
+
+    lines = [sample[start:end].split('<chat', 1)[0]]
+    for no in xrange(1, num_chats + 1):
+        chat = chats[no % len(chats)]
+        chat = re.sub(r' no="\d+"', ' no="{}"'.format(no), chat)
+        chat = re.sub(r' date="\d+"', ' date="{}"'.format(BASE_DATE + no), chat)
+        lines.append('\t' + chat + '\n')
+    lines.append('</packet>')
+    return ''.join(lines)
+
+
+def parse_minidom(response, from_datetime):
+    nico_comments = []
+    dom = xml.dom.minidom.parseString(response.read())
+    for chat in dom.getElementsByTagName('chat'):
+        post_datetime = datetime.datetime.fromtimestamp(int(chat.getAttribute('date')))
+        if post_datetime < from_datetime:
+            continue
+        vpos = int(chat.getAttribute('vpos'))
+        try:
+            chat_node = chat.childNodes[0]
+        except IndexError:
+            continue
+        if not chat_node.nodeType == chat_node.TEXT_NODE:
+            continue
+        nico_comments.append(NicoComment(chat_node.data, vpos, post_datetime,
+                                         int(chat.getAttribute('no'))))
+    return nico_comments
+
+
+def parse_expat(response, from_datetime):
+    return NicoCommentParser(from_datetime).parse(response)
+
+
+PARSERS = [('minidom', parse_minidom), ('expat', parse_expat)]
+
+
+def run(parser_name, response_data, from_datetime, queue):
+    func = dict(PARSERS)[parser_name]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for _ in xrange(REPEAT):
+        nico_comments = func(StringIO.StringIO(response_data), from_datetime)
+    elapsed = (time.time() - start) / REPEAT
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, rss_after - rss_before, len(nico_comments)))
+
+
+def bench(num_chats):
+    response_data = make_response(num_chats)
+    from_datetime = datetime.datetime.fromtimestamp(BASE_DATE + num_chats // 2)
+    for parser_name, _ in PARSERS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run,
+                                          args=(parser_name, response_data,
+                                                from_datetime, queue))
+        process.start()
+        elapsed, rss_kb, num_comments = queue.get()
+        process.join()
+        print('{:>7} chats {:>7}: {:>8.1f}ms, {:>10.0f} chats/s, '
+              'peak RSS +{:>7}KiB ({} comments)'
+              .format(num_chats, parser_name, elapsed * 1000,
+                      num_chats / elapsed, rss_kb, num_comments))
+
+
+def main(argv):
+    sizes = [int(x) for x in argv[1:]] or DEFAULT_SIZES
+    for num_chats in sizes:
+        bench(num_chats)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of NicoVideo and NicoComment.
+
+Usage: python benchmarks/bench_nico_memory.py [num_videos [comments_per_video]]
+
+num_videos videos (1000 by default) with comments_per_video comments
+(100 by default) are built from search results, as search_videos() and
+NicoCommentParser do, and held at once. The plain classes they replaced
+(a __dict__ per instance, eager strptime() and a formatted vpos string)
+run as the baseline. Each representation runs in its own process to
+measure the growth of the peak RSS.
+"""
+
+from __future__ import print_function
+import datetime
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from twitter_bot import NicoComment, NicoVideo
+
+DEFAULT_NUM_VIDEOS = 1000
+DEFAULT_COMMENTS_PER_VIDEO = 100
+BASE_DATE = 1356594224
+
+
+class PlainNicoVideo(object):
+    def __init__(self, title, description_short, length, first_retrieve,
+                 mylist_counter, view_counter, thumbnail_url, num_res, id):
+        self.title = title
+        self.description_short = description_short
+        self.length = length
+        self.first_retrieve = datetime.datetime.strptime(first_retrieve,
+                                                         '%Y-%m-%d %H:%M:%S')
+        self.mylist_counter = int(mylist_counter)
+        self.view_counter = int(view_counter)
+        self.thumbnail_url = thumbnail_url
+        self.num_res = int(num_res)
+        self.id = id
+
+        self.nico_comments = []
+
+
+class PlainNicoComment(object):
+    def __init__(self, comment, vpos, post_datetime, no=None):
+        self.comment = comment
+        self.vpos = '{:>02d}:{:>02d}'.format((vpos / 100 / 60),
+                                             (vpos / 100 % 60))
+        self.post_datetime = post_datetime
+        self.no = no
+
+
+REPRESENTATIONS = [('plain', (PlainNicoVideo, PlainNicoComment)),
+                   ('slots', (NicoVideo, NicoComment))]
+
+
+def make_json_video(i):
+    first_retrieve = datetime.datetime.fromtimestamp(BASE_DATE - i * 60)
+    return {'title': u'動画{}'.format(i),
+            'description_short': u'説明',
+            'length': '1:00',
+            'first_retrieve': first_retrieve.strftime('%Y-%m-%d %H:%M:%S'),
+            'mylist_counter': str(i),
+            'view_counter': str(i * 10),
+            'thumbnail_url': 'http://tn-skr.smilevideo.jp/smile?i={}'.format(i),
+            'num_res': str(DEFAULT_COMMENTS_PER_VIDEO),
+            'id': 'sm{}'.format(i)}
+
+
+def build(video_class, comment_class, num_videos, comments_per_video):
+    videos = []
+    for i in xrange(num_videos):
+        video = video_class(**make_json_video(i))
+        video.first_retrieve
+        for no in xrange(1, comments_per_video + 1):
+            post_datetime = datetime.datetime.fromtimestamp(BASE_DATE + no)
+            video.nico_comments.append(comment_class(u'コメント{}'.format(no),
+                                                     no * 100, post_datetime,
+                                                     no))
+        videos.append(video)
+    return videos
+
+
+def run(name, num_videos, comments_per_video, queue):
+    video_class, comment_class = dict(REPRESENTATIONS)[name]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    videos = build(video_class, comment_class, num_videos, comments_per_video)
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, rss_after - rss_before, len(videos)))
+
+
+def main(argv):
+    num_videos = int(argv[1]) if len(argv) > 1 else DEFAULT_NUM_VIDEOS
+    comments_per_video = int(argv[2]) if len(argv) > 2 \
+        else DEFAULT_COMMENTS_PER_VIDEO
+    for name, _ in REPRESENTATIONS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run,
+                                          args=(name, num_videos,
+                                                comments_per_video, queue))
+        process.start()
+        elapsed, rss_kb, _ = queue.get()
+        process.join()
+        print('{:>6} videos x {:>4} comments {:>5}: {:>8.1f}ms, '
+              'peak RSS +{:>7}KiB ({:.0f}B/comment)'
+              .format(num_videos, comments_per_video, name, elapsed * 1000,
+                      rss_kb,
+                      rss_kb * 1024.0 / (num_videos * comments_per_video)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
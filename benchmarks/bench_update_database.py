@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the user table reconciliation done by update_database().
+
+Usage: python benchmarks/bench_update_database.py [num_ids ...]
+
+For each size, a fresh SQLite file is filled from synthetic follower/friend
+id sets (initial run), and then reconciled again after 1% churn
+(steady-state run). The per-row query loop used before the bulk path is
+measured for sizes up to LEGACY_MAX_IDS.
+"""
+
+from __future__ import print_function
+import datetime
+import os
+import random
+import shutil
+import sqlalchemy
+import sqlalchemy.orm
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from twitter_bot import follow_graph, User
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+LEGACY_MAX_IDS = 10000
+CHURN_RATE = 0.01
+
+
+def make_session(db_file):
+    engine = sqlalchemy.create_engine('sqlite:///' + db_file)
+    User.metadata.create_all(engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)()
+
+
+def make_id_sets(num_ids, seed=0):
+    rand = random.Random(seed)
+    ids = rand.sample(xrange(1, num_ids * 10), num_ids)
+    # Two thirds are followers and two thirds are friends.
+    follower_ids = set(ids[:num_ids * 2 // 3])
+    friend_ids = set(ids[num_ids // 3:])
+    return follower_ids, friend_ids
+
+
+def churn(ids, num_ids, seed=1):
+    rand = random.Random(seed)
+    ids = set(ids)
+    num_churn = int(len(ids) * CHURN_RATE)
+    for user_id in rand.sample(sorted(ids), num_churn):
+        ids.discard(user_id)
+    for _ in xrange(num_churn):
+        ids.add(rand.randint(num_ids * 10, num_ids * 20))
+    return ids
+
+
+def legacy_update(db_session, follower_ids, friend_ids, date):
+    for user_id in follower_ids | friend_ids:
+        follow_status = User.follow_status_following if user_id in friend_ids \
+            else User.follow_status_not_following
+        follower_status = User.follower_status_follower if user_id in follower_ids \
+            else User.follower_status_not_follower
+        try:
+            user = db_session.query(User).filter(User.user_id == user_id).one()
+            user.follow_status = follow_status
+            user.follower_status = follower_status
+            user.date = date
+        except sqlalchemy.orm.exc.NoResultFound:
+            db_session.add(User(user_id, follow_status, follower_status, date))
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench(num_ids, work_dir):
+    follower_ids, friend_ids = make_id_sets(num_ids)
+    churned_follower_ids = churn(follower_ids, num_ids, seed=1)
+    churned_friend_ids = churn(friend_ids, num_ids, seed=2)
+
+    def bulk(db_session, followers, friends):
+        result = follow_graph.upsert_users(db_session, followers, friends,
+                                           datetime.datetime.now())
+        db_session.commit()
+        return result
+
+    def legacy(db_session, followers, friends):
+        legacy_update(db_session, followers, friends, datetime.datetime.now())
+        db_session.commit()
+
+    runs = [('bulk', bulk)]
+    if num_ids <= LEGACY_MAX_IDS:
+        runs.append(('legacy', legacy))
+
+    for name, func in runs:
+        db_session = make_session(os.path.join(work_dir,
+                                               '{}_{}.db'.format(name, num_ids)))
+        initial_sec, _ = timed(func, db_session, follower_ids, friend_ids)
+        steady_sec, _ = timed(func, db_session, churned_follower_ids,
+                              churned_friend_ids)
+        db_session.close()
+        print('{:>8} ids {:>6}: initial {:>8.2f}s, steady-state {:>8.2f}s'
+              .format(num_ids, name, initial_sec, steady_sec))
+
+
+def main(argv):
+    sizes = [int(x) for x in argv[1:]] or DEFAULT_SIZES
+    work_dir = tempfile.mkdtemp(prefix='bench_update_database_')
+    try:
+        for num_ids in sizes:
+            bench(num_ids, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
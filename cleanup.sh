@@ -3,6 +3,11 @@ cwd=$(cd "$(dirname "d0")" && pwd)
 
 list=(record.txt
       twitter_bot.db
+      twitter_bot.db-wal
+      twitter_bot.db-shm
+      snapshots
+      youtube_v3_discovery.json
+      samples/youtube_v3_discovery.json
       twitter_bot.egg-info
       dist
       build)
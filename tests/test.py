@@ -2,16 +2,40 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import ast
+import cookielib
+import copy
 import datetime
+import json
 import logging
 import os
+import re
+import shutil
+import socket
+import sqlalchemy
+import sqlalchemy.orm
+import tempfile
+import threading
+import time
 import unittest
+import urlparse
 
-from twitter_bot import (Config, NicoVideo, NicoComment, NicoSearch,
+from twitter_bot import (Config, NicoVideo, NicoComment, NicoCommentParser,
+                         NicoSearch, AsyncNicoSearch,
                          JobManager, TwitterBot, TwitterBotBase,
-                         DbManager, TwitterVideoBot, Job, User, utils)
+                         DbManager, TwitterVideoBot, Job, User, utils,
+                         database, fetch_memo, follow_graph, http_session,
+                         login_cache, migration, models, niconico_async, outbox,
+                         posted_videos, scheduler, snapshot, youtube,
+                         RateLimitScheduler, YoutubeSearch)
 
 SAMPLE_BOT_CONFIG = 'samples/bot.cfg.sample'
+SAMPLE_NICO_COMMENTS = 'samples/sample_nico_comments.txt'
+SAMPLE_NICO_SEARCH = 'samples/sample_nico_search.txt'
+SAMPLE_YOUTUBE_RESULT = 'samples/sample_youtube_result.txt'
 BOT_CONFIG = 'samples/bot.cfg'
 
 logging.basicConfig(level=logging.INFO)
@@ -56,6 +80,342 @@ class ModelsTest(unittest.TestCase):
                           .format('0001', User.follow_status_following, User.follower_status_follower, self.now))
 
 
+def make_memory_session():
+    engine = sqlalchemy.create_engine('sqlite://')
+    User.metadata.create_all(engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)()
+
+
+class FollowGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.db_session = make_memory_session()
+        self.date = datetime.datetime(2013, 1, 1)
+        # 1: removed in db but following again, 2: unchanged, 9: not in sets.
+        self.db_session.add(User(1, User.follow_status_removed,
+                                 User.follower_status_follower, self.date))
+        self.db_session.add(User(2, User.follow_status_following,
+                                 User.follower_status_follower, self.date))
+        self.db_session.add(User(9, User.follow_status_following,
+                                 User.follower_status_not_follower, self.date))
+        self.db_session.commit()
+
+    def test_load_user_states(self):
+        states = follow_graph.load_user_states(self.db_session, chunk_size=2)
+        self.assertEquals(3, len(states))
+        self.assertEquals((User.follow_status_removed,
+                           User.follower_status_follower), states[1])
+
+    def test_upsert_users(self):
+        now = datetime.datetime(2013, 2, 1)
+        inserted, updated = follow_graph.upsert_users(self.db_session,
+                                                      set([1, 2, 3]),
+                                                      set([1, 2, 4]), now,
+                                                      batch_size=1)
+        self.db_session.commit()
+        self.assertEquals((2, 1), (inserted, updated))
+
+        users = dict((user.user_id, user)
+                     for user in self.db_session.query(User))
+        self.assertEquals(User.follow_status_following, users[1].follow_status)
+        self.assertEquals(now, users[1].date)
+        self.assertEquals(self.date, users[2].date)
+        self.assertEquals(User.follow_status_not_following, users[3].follow_status)
+        self.assertEquals(User.follower_status_follower, users[3].follower_status)
+        self.assertEquals(User.follow_status_following, users[4].follow_status)
+        self.assertEquals(User.follower_status_not_follower, users[4].follower_status)
+        self.assertEquals(User.follow_status_following, users[9].follow_status)
+
+    def test_find_existing_and_insert_users(self):
+        candidate_ids = set(range(1, 11))
+        known_ids = follow_graph.find_existing_user_ids(self.db_session,
+                                                        candidate_ids,
+                                                        chunk_size=3)
+        self.assertEquals(set([1, 2, 9]), known_ids)
+
+        follow_graph.insert_users(self.db_session, candidate_ids - known_ids,
+                                  User.follow_status_not_following,
+                                  User.follower_status_not_follower, self.date)
+        self.db_session.commit()
+        self.assertEquals(10, self.db_session.query(User).count())
+        self.assertEquals(User.follow_status_removed,
+                          self.db_session.query(User).get(1).follow_status)
+
+
+def make_file_db_manager(db_dir):
+    """Return a DbManager of a new database created in db_dir."""
+    db_manager = DbManager('sqlite:///' + os.path.join(db_dir, 'test.db'))
+    models.Base.metadata.create_all(db_manager.db_engine)
+    return db_manager
+
+
+class MigrationTest(unittest.TestCase):
+    def test_upgrade(self):
+        # Tables made before the indexes existed.
+        db_engine = sqlalchemy.create_engine('sqlite://')
+        db_engine.execute('CREATE TABLE user (user_id INTEGER PRIMARY KEY,'
+                          ' follow_status INTEGER, follower_status INTEGER,'
+                          ' date DATETIME)')
+        db_engine.execute('CREATE TABLE post_video (video_id VARCHAR PRIMARY KEY,'
+                          ' last_post_datetime DATETIME, post_count INTEGER)')
+        self.assertEquals(0, migration.get_version(db_engine))
+
+        latest_version = migration.MIGRATIONS[-1][0]
+        self.assertEquals(latest_version, migration.upgrade(db_engine))
+        self.assertEquals(latest_version, migration.upgrade(db_engine))
+        index_names = [index['name'] for index in
+                       sqlalchemy.inspect(db_engine).get_indexes('user')]
+        self.assertTrue('ix_user_follow_status_date' in index_names)
+
+    def test_upgrade_on_start(self):
+        # A database made before the tables of migrations existed.
+        db_dir = tempfile.mkdtemp()
+        try:
+            db_name = 'sqlite:///' + os.path.join(db_dir, 'test.db')
+            db_engine = sqlalchemy.create_engine(db_name)
+            for table in [Job.__table__, User.__table__, models.PostVideo.__table__]:
+                table.create(db_engine)
+            db_engine.dispose()
+
+            with DbManager(db_name) as db_manager:
+                table_names = sqlalchemy.inspect(db_manager.db_engine).get_table_names()
+                self.assertTrue('fetch_cursor' in table_names)
+                self.assertTrue('tweet_outbox' in table_names)
+                self.assertTrue('nico_login_session' in table_names)
+                self.assertTrue('youtube_watermark' in table_names)
+                self.assertEquals(migration.MIGRATIONS[-1][0],
+                                  migration.get_version(db_manager.db_engine))
+        finally:
+            shutil.rmtree(db_dir)
+
+    def test_upgrade_new_database(self):
+        db_engine = sqlalchemy.create_engine('sqlite://')
+        User.metadata.create_all(db_engine)
+        self.assertEquals(migration.MIGRATIONS[-1][0],
+                          migration.upgrade(db_engine))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.store = snapshot.SnapshotStore(self.snapshot_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_snapshot(self):
+        self.assertTrue(self.store.load('followers') is None)
+
+        ids = self.store.stage('followers', [5, 2 ** 40, 3, 5, 1])
+        self.assertEquals([1, 3, 5, 2 ** 40], list(ids))
+        self.assertEquals(2 ** 40, ids[-1])
+        self.assertTrue(3 in ids)
+        self.assertFalse(4 in ids)
+        ids.close()
+        self.assertTrue(self.store.load('followers') is None)
+
+        self.store.commit('followers')
+        with self.store.load('followers') as ids:
+            self.assertEquals(4, len(ids))
+
+        empty = self.store.stage('friends', [])
+        self.assertEquals([], list(empty))
+        self.assertFalse(1 in empty)
+        empty.close()
+
+    def test_spool(self):
+        with self.store.open_spool('followers') as spool:
+            spool.append([3, 1])
+        self.assertTrue(self.store.has_spool('followers'))
+        with self.store.open_spool('followers', resume=True) as spool:
+            spool.append([2, 3])
+        with self.store.stage_spool('followers') as ids:
+            self.assertEquals([1, 2, 3], list(ids))
+        self.assertFalse(self.store.has_spool('followers'))
+
+    def test_write_runs(self):
+        path = os.path.join(self.snapshot_dir, 'runs.ids')
+        ids = [5, 2 ** 40, 3, 5, 1, 3, 0]
+        with snapshot.IdSnapshot.write(path, iter(ids), run_size=2) as snap:
+            self.assertEquals([0, 1, 3, 5, 2 ** 40], list(snap))
+        self.assertEquals(['runs.ids'], os.listdir(self.snapshot_dir))
+
+    def test_diff_sorted(self):
+        added, removed = snapshot.diff_sorted([1, 2, 4, 8], [2, 3, 4, 9, 10])
+        self.assertEquals([3, 9, 10], added)
+        self.assertEquals([1, 8], removed)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+        self.now += sec
+
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class FakeApi(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_response = None
+        self.remaining = 2
+
+    def followers_ids(self, user_id=None, cursor=-1):
+        self.remaining -= 1
+        self.last_response = FakeResponse({
+            'x-rate-limit-limit': '15',
+            'x-rate-limit-remaining': str(self.remaining),
+            'x-rate-limit-reset': str(int(self.clock.now) + 600)})
+        return ([1, 2], (0, 0))
+
+
+class RateLimitSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.api = FakeApi(self.clock)
+        self.scheduler = RateLimitScheduler(api=self.api,
+                                            min_intervals={'statuses/update': 5},
+                                            clock=self.clock.time,
+                                            sleep=self.clock.sleep)
+
+    def test_learn_from_headers(self):
+        # Budget remains: no sleep.
+        self.scheduler.call('followers/ids', self.api.followers_ids)
+        self.scheduler.call('followers/ids', self.api.followers_ids)
+        self.assertEquals([], self.clock.sleeps)
+
+        # Budget exhausted: sleep until the reset time.
+        self.scheduler.call('followers/ids', self.api.followers_ids)
+        self.assertEquals([600], self.clock.sleeps)
+
+    def test_learn_only_own_response(self):
+        # A response left by followers/ids with no budget.
+        self.api.remaining = 1
+        self.api.followers_ids()
+        func = lambda: None
+        self.scheduler.call('nico/search', func)
+        self.scheduler.call('statuses/mentions', func)
+        self.scheduler.call('statuses/mentions', func)
+        self.assertEquals([], self.clock.sleeps)
+
+    def test_min_interval(self):
+        func = lambda: None
+        self.scheduler.call('statuses/update', func)
+        self.clock.now += 2
+        self.scheduler.call('statuses/update', func)
+        self.assertEquals([3], self.clock.sleeps)
+
+    def test_token_bucket(self):
+        nico_scheduler = RateLimitScheduler(limits={'nico/search': (2, 10)},
+                                            clock=self.clock.time,
+                                            sleep=self.clock.sleep)
+        for _ in range(3):
+            nico_scheduler.acquire('nico/search')
+        self.assertEquals([5], self.clock.sleeps)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = scheduler.HostCircuitBreaker(failure_threshold=2,
+                                                    reset_sec=60,
+                                                    clock=self.clock.time)
+        self.url = 'http://msg.example.com/api/'
+
+    def test_open_and_close(self):
+        self.breaker.failure(self.url)
+        self.breaker.before(self.url)
+        self.breaker.failure(self.url)
+        self.assertRaises(scheduler.CircuitOpenError, self.breaker.before,
+                          self.url)
+        # Other hosts are not affected.
+        self.breaker.before('http://example.com/')
+
+        # Half open: one trial request.
+        self.clock.now += 60
+        self.breaker.before(self.url)
+        self.assertRaises(scheduler.CircuitOpenError, self.breaker.before,
+                          self.url)
+        self.breaker.success(self.url)
+        self.breaker.before(self.url)
+
+    def test_trial_failure(self):
+        self.breaker.failure(self.url)
+        self.breaker.failure(self.url)
+        self.clock.now += 60
+        self.breaker.before(self.url)
+        self.breaker.failure(self.url)
+        self.clock.now += 30
+        self.assertRaises(scheduler.CircuitOpenError, self.breaker.before,
+                          self.url)
+
+    def test_backoff_sec(self):
+        self.assertEquals(0, scheduler.backoff_sec(0, 15, 120))
+        self.assertEquals(15, scheduler.backoff_sec(1, 15, 120, rand=lambda: 1))
+        self.assertEquals(60, scheduler.backoff_sec(3, 15, 120, rand=lambda: 1))
+        self.assertEquals(120, scheduler.backoff_sec(5, 15, 120, rand=lambda: 1))
+        self.assertTrue(0 <= scheduler.backoff_sec(2, 15, 120) <= 30)
+
+    def test_fail_fast(self):
+        server = StubNicoServer(read_sample_search_json(),
+                                read_sample_comments_xml())
+        server.start()
+        nico = server.make_nico_search(
+            circuit_breaker=scheduler.HostCircuitBreaker(failure_threshold=2))
+        nico.login()
+        server.stop()
+        nico.session.close()
+        for _ in range(2):
+            self.assertRaises(Exception, nico._fetch, nico._fetch_videos,
+                              u'keyword')
+        self.assertRaises(scheduler.CircuitOpenError, nico._fetch,
+                          nico._fetch_videos, u'keyword')
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.db_session = make_memory_session()
+        self.outbox = outbox.Outbox(self.db_session, max_attempts=2)
+        self.posted_msgs = []
+
+    def post(self, msg):
+        if msg == 'fail':
+            raise Exception('post failed')
+        self.posted_msgs.append(msg)
+
+    def test_dispatch(self):
+        self.assertTrue(self.outbox.enqueue(u'msg1', 'key1'))
+        self.assertTrue(self.outbox.enqueue(u'fail', 'key2'))
+        self.assertFalse(self.outbox.enqueue(u'msg1', 'key1'))
+        self.db_session.commit()
+
+        sent_count, failed_list = self.outbox.dispatch(self.post)
+        self.assertEquals(1, sent_count)
+        self.assertEquals(1, len(failed_list))
+        self.assertEquals([u'msg1'], self.posted_msgs)
+
+        # Sent messages are not posted again even if enqueued again.
+        self.assertFalse(self.outbox.enqueue(u'msg1', 'key1'))
+        self.assertEquals(['fail'], [m.message for m in self.outbox.pending()])
+
+        # Give up after max_attempts.
+        self.outbox.dispatch(self.post)
+        self.assertEquals([], self.outbox.pending())
+        self.assertEquals([u'msg1'], self.posted_msgs)
+
+
 class SampleBot(TwitterBotBase):
     def __init__(self, bot_config):
         # Init TwitterBotBase.
@@ -158,6 +518,125 @@ class TwitterBotTest(unittest.TestCase):
             self.assertTrue(isinstance(prev_datetime, datetime.datetime))
 
 
+class FakeFriendshipApi(object):
+    def __init__(self):
+        self.last_response = None
+        self.called_ids = []
+
+    def create_friendship(self, user_id):
+        self.called_ids.append(user_id)
+        if user_id % 5 == 0:
+            raise TweepError('cannot follow')
+
+    destroy_friendship = create_friendship
+
+
+class FriendshipTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = TwitterBot(SAMPLE_BOT_CONFIG)
+        self.bot.create_database()
+        self.bot.api = FakeFriendshipApi()
+        self.bot.db_session.query(User).delete()
+        date = datetime.datetime(2013, 1, 1)
+        for user_id in range(1, 20):
+            follow_status = User.follow_status_not_following if user_id < 15 \
+                else User.follow_status_following
+            self.bot.db_session.add(User(user_id, follow_status,
+                                         User.follower_status_not_follower,
+                                         date + datetime.timedelta(user_id)))
+        self.bot.commit()
+
+    def tearDown(self):
+        self.bot.db_session.query(User).delete()
+        self.bot.close()
+
+    def get_follow_status(self, user_id):
+        return self.bot.db_session.query(User).get(user_id).follow_status
+
+    def test_follow_not_following_users(self):
+        self.bot.follow_not_following_users(limit=6, max_workers=4)
+        self.assertEquals(range(1, 8), sorted(self.bot.api.called_ids))
+        self.assertEquals(User.follow_status_following, self.get_follow_status(1))
+        self.assertEquals(User.follow_status_cannot_follow_back,
+                          self.get_follow_status(5))
+        self.assertEquals(User.follow_status_not_following,
+                          self.get_follow_status(8))
+
+    def test_unfollow_not_followers(self):
+        self.bot.unfollow_not_followers(max_workers=4)
+        self.assertEquals([15, 16], self.bot.api.called_ids)
+        self.assertEquals(User.follow_status_following, self.get_follow_status(15))
+        self.assertEquals(User.follow_status_removed, self.get_follow_status(16))
+
+
+class FakeIdsApi(object):
+    def __init__(self, follower_ids, friend_ids):
+        self.last_response = None
+        self.follower_ids = follower_ids
+        self.friend_ids = friend_ids
+
+    def followers_ids(self, user_id=None, cursor=-1):
+        return (self.follower_ids, (0, 0))
+
+    def friends_ids(self, user_id=None, cursor=-1):
+        return (self.friend_ids, (0, 0))
+
+
+class UpdateDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.bot = TwitterBot(SAMPLE_BOT_CONFIG, snapshot_dir=self.snapshot_dir)
+        self.bot.create_database()
+        self.bot.api = FakeIdsApi([1, 2, 3], [1, 4])
+        self.bot.scheduler.api = None
+        self.bot.db_session.query(User).delete()
+        self.bot.commit()
+
+    def tearDown(self):
+        self.bot.db_session.query(User).delete()
+        self.bot.commit()
+        self.bot.close()
+        shutil.rmtree(self.snapshot_dir)
+
+    def get_follow_status(self, user_id):
+        return self.bot.db_session.query(User).get(user_id).follow_status
+
+    def set_follow_status(self, user_id, follow_status):
+        self.bot.db_session.query(User).get(user_id).follow_status = follow_status
+        self.bot.commit()
+
+    def test_reset_drifted_users(self):
+        self.bot.update_database()
+        self.assertEquals(User.follow_status_not_following, self.get_follow_status(2))
+
+        # Snapshots are unchanged, but a failed follow was recorded.
+        self.set_follow_status(2, User.follow_status_cannot_follow_back)
+        self.set_follow_status(4, User.follow_status_not_following)
+        self.bot.update_database()
+        self.assertEquals(User.follow_status_not_following, self.get_follow_status(2))
+        # Fixed only by a full pass.
+        self.assertEquals(User.follow_status_not_following, self.get_follow_status(4))
+
+        self.bot.FULL_RECONCILE_DAYS = 0
+        self.bot.update_database()
+        self.assertEquals(User.follow_status_following, self.get_follow_status(4))
+
+
+class DbManagerTest(unittest.TestCase):
+    def test_shared_engine(self):
+        with DbManager() as db_manager1:
+            with DbManager() as db_manager2:
+                self.assertTrue(db_manager1.db_engine is db_manager2.db_engine)
+                self.assertFalse(db_manager1.db_session is db_manager2.db_session)
+                journal_mode = db_manager1.db_session \
+                    .execute('PRAGMA journal_mode').scalar()
+                self.assertEquals('wal', journal_mode)
+
+    def test_memory_database(self):
+        with DbManager('sqlite://') as db_manager:
+            self.assertTrue(db_manager.db_engine is database.get_engine('sqlite://'))
+
+
 class NicoVideoTest(unittest.TestCase):
     def setUp(self):
         nico_comments = []
@@ -192,10 +671,861 @@ class NicoVideoTest(unittest.TestCase):
         self.assertTrue(latest_comments[1] is self.nc1)
         self.assertTrue(latest_comments[2] is self.nc3)
 
+    def test_max_comments(self):
+        nico_video = NicoVideo('titel', 'description_short', '00:00', '2012-01-03 00:00:00', 1, 2, {}, 3, 'id',
+                               max_comments=3)
+        for nico_comment in self.nico_video.nico_comments:
+            nico_video.append_nico_comment(nico_comment)
+        self.assertEquals([self.nc4, self.nc1, self.nc3], nico_video.nico_comments)
+        self.assertEquals([self.nc1, self.nc3], nico_video.get_latest_comments(2))
+
+    def test_max_comments_ties(self):
+        nico_video = NicoVideo('titel', 'description_short', '00:00', '2012-01-03 00:00:00', 1, 2, {}, 3, 'id',
+                               max_comments=2)
+        post_datetime = datetime.datetime(2013, 1, 1)
+        nico_comments = [NicoComment(str(i), i, post_datetime) for i in range(4)]
+        for nico_comment in nico_comments:
+            nico_video.append_nico_comment(nico_comment)
+        self.assertEquals(nico_comments[-2:], nico_video.get_latest_comments(2))
+        self.assertEquals(nico_comments[-2:], self.make_list_video(nico_comments).get_latest_comments(2))
+
+    def make_list_video(self, nico_comments):
+        nico_video = NicoVideo('titel', 'description_short', '00:00', '2012-01-03 00:00:00', 1, 2, {}, 3, 'id')
+        nico_video.nico_comments = list(nico_comments)
+        return nico_video
+
+    def test_first_retrieve(self):
+        self.assertEquals(datetime.datetime(2012, 1, 3),
+                          self.nico_video.first_retrieve)
+        self.assertFalse(hasattr(self.nico_video, '__dict__'))
+
+    def test_format_vpos(self):
+        self.assertEquals('01:05', NicoComment('c', 6543, None).format_vpos())
+
+
+def read_sample_comments_xml():
+    with open(SAMPLE_NICO_COMMENTS) as f:
+        sample = f.read()
+    start = sample.index('<?xml')
+    end = sample.index('</packet>', start) + len('</packet>')
+    return sample[start:end]
+
+
+class NicoCommentParserTest(unittest.TestCase):
+    def setUp(self):
+        self.comments_xml = read_sample_comments_xml()
+
+    def test_parse(self):
+        parser = NicoCommentParser()
+        nico_comments = parser.parse(StringIO.StringIO(self.comments_xml))
+        self.assertEquals(27, len(nico_comments))
+        self.assertEquals(u'うぽつ', nico_comments[1].comment)
+        self.assertEquals(2, nico_comments[1].no)
+        self.assertEquals(772, nico_comments[1].vpos)
+        self.assertEquals('00:07', nico_comments[1].format_vpos())
+        self.assertEquals('0', parser.thread_attrs['resultcode'])
+
+    def test_parse_from_datetime(self):
+        from_datetime = datetime.datetime.fromtimestamp(1356599749)
+        parser = NicoCommentParser(from_datetime)
+        # Feed the response in small pieces.
+        for i in range(0, len(self.comments_xml), 7):
+            parser.feed(self.comments_xml[i:i + 7])
+        parser.close()
+        self.assertTrue(all(nc.post_datetime >= from_datetime
+                            for nc in parser.nico_comments))
+        self.assertEquals(2, parser.nico_comments[0].no)
+
+
+class FakeNicoSearch(NicoSearch):
+    def __init__(self, comments_xml, failed_ids=None, **kwargs):
+        NicoSearch.__init__(self, None, 'user_id', 'pass_word',
+                            fetch_sleep_sec=0, retry_sleep_sec=0,
+                            max_retry_count=0, **kwargs)
+        self.comments_xml = comments_xml
+        self.failed_ids = failed_ids or []
+
+    def _fetch_videos(self, keyword, sort='f', order='d', page=1):
+        return [{'title': 'title{}'.format(i),
+                 'description_short': '',
+                 'length': '1:00',
+                 'first_retrieve': '2012-12-30 23:35:12',
+                 'mylist_counter': 0,
+                 'view_counter': 0,
+                 'thumbnail_url': '',
+                 'num_res': i,
+                 'id': 'sm{}'.format(i)} for i in range(1, 9)]
+
+    def _fetch_comments(self, video, scope=None):
+        if video.id in self.failed_ids:
+            raise Exception('fetch failed')
+        # Finish in reverse order.
+        time.sleep(0.01 * (10 - video.num_res))
+        return StringIO.StringIO(self.comments_xml)
+
+
+class PagedNicoSearch(NicoSearch):
+    """Returns pages of 3 videos first_retrieved an hour apart."""
+
+    def __init__(self, num_pages):
+        NicoSearch.__init__(self, None, 'user_id', 'pass_word',
+                            fetch_sleep_sec=0, retry_sleep_sec=0,
+                            max_retry_count=0)
+        self.num_pages = num_pages
+        self.fetched_pages = []
+        self.base_datetime = datetime.datetime(2013, 1, 1)
+
+    def _fetch_videos(self, keyword, sort='f', order='d', page=1):
+        self.fetched_pages.append(page)
+        if page > self.num_pages:
+            return []
+        videos = []
+        for i in range((page - 1) * 3, page * 3):
+            first_retrieve = self.base_datetime - datetime.timedelta(hours=i)
+            videos.append({'title': 'title{}'.format(i),
+                           'description_short': '',
+                           'length': '1:00',
+                           'first_retrieve': first_retrieve.strftime('%Y-%m-%d %H:%M:%S'),
+                           'mylist_counter': 0,
+                           'view_counter': 0,
+                           'thumbnail_url': '',
+                           'num_res': 1,
+                           'id': 'sm{}'.format(i)})
+        return videos
+
+
+class NicoSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.comments_xml = read_sample_comments_xml()
+
+    def test_search_videos_with_comments(self):
+        nico = FakeNicoSearch(self.comments_xml, failed_ids=['sm3'],
+                              max_workers=4)
+        videos = nico.search_videos_with_comments('keyword', max_comment_num=7)
+        self.assertEquals(['sm1', 'sm2', 'sm4', 'sm5', 'sm6', 'sm7'],
+                          [video.id for video in videos])
+        self.assertEquals(27, len(videos[0].nico_comments))
+        self.assertEquals(1, nico.fetch_fail_count)
+
+    def test_search_videos_with_comments_fail_count_over(self):
+        nico = FakeNicoSearch(self.comments_xml,
+                              failed_ids=['sm2', 'sm3', 'sm5'],
+                              max_fetch_fail_count=1, max_workers=4)
+        self.assertRaises(Exception, nico.search_videos_with_comments, 'keyword')
+
+    def test_search_videos_with_comments_seen_video_ids(self):
+        nico = FakeNicoSearch(self.comments_xml, max_workers=4)
+        seen_video_ids = set(['sm1', 'sm2'])
+        videos = nico.search_videos_with_comments('keyword', max_comment_num=4,
+                                                  seen_video_ids=seen_video_ids)
+        self.assertEquals(['sm3', 'sm4'], [video.id for video in videos])
+        self.assertEquals(set(['sm1', 'sm2', 'sm3', 'sm4']), seen_video_ids)
+
+
+class IterVideosTest(unittest.TestCase):
+    def test_stop_at_from_datetime(self):
+        nico = PagedNicoSearch(10)
+        from_datetime = nico.base_datetime - datetime.timedelta(hours=7)
+        videos = list(nico.iter_videos(u'keyword', from_datetime))
+        self.assertEquals(['sm{}'.format(i) for i in range(8)],
+                          [video.id for video in videos])
+        self.assertEquals([1, 2, 3], nico.fetched_pages)
+
+    def test_prefetch(self):
+        nico = PagedNicoSearch(10)
+        from_datetime = nico.base_datetime - datetime.timedelta(hours=7)
+        videos = list(nico.iter_videos(u'keyword', from_datetime, prefetch=True))
+        self.assertEquals(8, len(videos))
+        # The third page is the last one, so the fourth is not prefetched.
+        self.assertEquals([1, 2, 3], nico.fetched_pages)
+
+    def test_last_page(self):
+        nico = PagedNicoSearch(2)
+        self.assertEquals(6, len(list(nico.iter_videos(u'keyword',
+                                                       prefetch=True))))
+        self.assertEquals([1, 2, 3], nico.fetched_pages)
+
+    def test_max_count(self):
+        nico = PagedNicoSearch(10)
+        self.assertEquals(6, len(nico.search_videos(u'keyword', max_count=2)))
+        self.assertEquals([1, 2], nico.fetched_pages)
+
+    def test_not_sorted_by_date(self):
+        nico = PagedNicoSearch(3)
+        from_datetime = nico.base_datetime - datetime.timedelta(hours=1)
+        videos = list(nico.iter_videos(u'keyword', from_datetime, sort='n'))
+        self.assertEquals(2, len(videos))
+        self.assertEquals([1, 2, 3, 4], nico.fetched_pages)
+
+
+def read_sample_search_json():
+    with open(SAMPLE_NICO_SEARCH) as f:
+        sample = f.read()
+    return sample[sample.index('{', sample.index('# 正常')):]
+
+
+class StubNicoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Replays the samples as the login, search, getflv and message servers."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body, headers=None):
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/api/search/search/'):
+            cookie = self.headers.getheader('Cookie') or ''
+            if not any('user_session={}'.format(session) in cookie
+                       for session in server.sessions):
+                self._respond('{"status": "fail", "message": "ログインしてください"}')
+                return
+            server.search_count += 1
+            self._respond(server.search_json)
+        elif self.path.startswith('/api/getflv/'):
+            with server.lock:
+                server.getflv_count += 1
+            video_id = self.path.rsplit('/', 1)[1]
+            if video_id in server.no_ms_video_ids:
+                self._respond('thread_id=&user_id=2')
+                return
+            self._respond('thread_id={}.{}&user_id=2&ms={}'
+                          .format(server.thread_id, video_id,
+                                  server.base_url + '/api/'))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('Content-Length')))
+        if self.path.startswith('/secure/login'):
+            server.login_count += 1
+            session = 'stub{}'.format(server.login_count)
+            server.sessions.add(session)
+            self._respond('', {'Set-Cookie': 'user_session={}; path=/'
+                                             .format(session)})
+        elif self.path == '/api/':
+            self._respond(server.make_comments_xml(body))
+        else:
+            self.send_error(404)
+
+
+class StubNicoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, search_json, comments_xml):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubNicoHandler)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.search_json = search_json
+        self.comments_xml = comments_xml
+        self.search_count = 0
+        self.login_count = 0
+        self.sessions = set()
+        self.connection_count = 0
+        self.getflv_count = 0
+        self.thread_id = '1'
+        self.no_ms_video_ids = set()
+        self.post_bodies = []
+        self.lock = threading.Lock()
+
+    def make_comments_xml(self, body):
+        thread_id = re.search(r'<thread thread="([^"]+)"', body).group(1)
+        if not thread_id.startswith(self.thread_id + '.'):
+            return '<packet><thread resultcode="1"/></packet>'
+        with self.lock:
+            self.post_bodies.append(body)
+        comments_xml = self.comments_xml.replace('thread="1356594194"',
+                                                 'thread="{}"'.format(thread_id))
+        res_from = re.search(r'res_from="(\d+)"', body)
+        if res_from:
+            def drop_old_chat(match):
+                if int(match.group(1)) < int(res_from.group(1)):
+                    return ''
+                return match.group(0)
+            comments_xml = re.sub(r'<chat [^>]*no="(\d+)"[^>]*>[^<]*</chat>',
+                                  drop_old_chat, comments_xml)
+        return comments_xml
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def make_nico_search(self, db_manager=None, **kwargs):
+        nico = NicoSearch(db_manager, 'user_id', 'pass_word',
+                          fetch_sleep_sec=0, retry_sleep_sec=0,
+                          max_retry_count=0, **kwargs)
+        nico.LOGIN_URL = self.base_url + '/secure/login'
+        nico.SEARCH_URL = self.base_url + '/api/search/search/'
+        nico.GETFLV_URL = self.base_url + '/api/getflv/'
+        return nico
+
+
+class FileDbTestCase(unittest.TestCase):
+    """Gives each test a new database in a temporary directory."""
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_manager = make_file_db_manager(self.db_dir)
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.db_dir)
+
+
+class StubNicoTestCase(FileDbTestCase):
+    """Runs a StubNicoServer for each test, with a new database."""
+
+    def setUp(self):
+        FileDbTestCase.setUp(self)
+        self.server = StubNicoServer(read_sample_search_json(),
+                                     read_sample_comments_xml())
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        FileDbTestCase.tearDown(self)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.is_closed = False
+
+    def close(self):
+        self.is_closed = True
+
+
+class BrokenRawResponse(object):
+    status = 200
+    reason = 'OK'
+    will_close = False
+
+    def __init__(self):
+        self.is_closed = False
+
+    def read(self, amt=None):
+        raise socket.error('connection reset')
+
+    def isclosed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class PooledResponseTest(unittest.TestCase):
+    def test_read_error(self):
+        session = http_session.HttpSession()
+        connection = FakeConnection()
+        response = http_session.PooledResponse(session, ('http', 'example.com'),
+                                               connection, BrokenRawResponse(),
+                                               'http://example.com/')
+        self.assertRaises(socket.error, response.read)
+        self.assertTrue(connection.is_closed)
+        self.assertEquals({}, session._idle_connections)
+        response.close()
+
+
+class HttpSessionTest(StubNicoTestCase):
+    def test_keep_alive(self):
+        nico = self.server.make_nico_search()
+        nico.login()
+        for page in range(1, 4):
+            self.assertEquals(32, len(nico._fetch_videos(u'keyword', page=page)))
+        nico.session.close()
+        self.assertEquals(3, self.server.search_count)
+        self.assertEquals(1, self.server.connection_count)
+
+    def test_cookies_per_instance(self):
+        nico = self.server.make_nico_search()
+        nico.login()
+        other_nico = self.server.make_nico_search()
+        self.assertTrue(nico._fetch_videos(u'keyword'))
+        self.assertRaises(Exception, other_nico._fetch_videos, u'keyword')
+
+    def test_reconnect(self):
+        nico = self.server.make_nico_search()
+        nico.login()
+        # The server closes the idle connection.
+        for connections in nico.session._idle_connections.values():
+            for connection in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(nico._fetch_videos(u'keyword'))
+
+    def test_hold_host_slot_until_read(self):
+        nico = self.server.make_nico_search(max_connections_per_host=1)
+        nico.login()
+        semaphore = nico.host_limiter._semaphore(
+            urlparse.urlparse(self.server.base_url).netloc)
+        response = nico._urlopen(nico.GETFLV_URL + 'sm1')
+        self.assertFalse(semaphore.acquire(False))
+        response.read(1)
+        self.assertFalse(semaphore.acquire(False))
+        response.read()
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+        response = nico._urlopen(nico.GETFLV_URL + 'sm1')
+        response.close()
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+
+class LoginCacheTest(StubNicoTestCase):
+    def test_reuse_session(self):
+        nico = self.server.make_nico_search(self.db_manager)
+        nico.login()
+        other_nico = self.server.make_nico_search(self.db_manager)
+        other_nico.login()
+        self.assertTrue(other_nico._fetch(other_nico._fetch_videos, u'keyword'))
+        self.assertEquals(1, self.server.login_count)
+
+    def test_expired_cache(self):
+        nico = self.server.make_nico_search(self.db_manager)
+        nico.login()
+        nico.login_cache.default_ttl_sec = -1
+        nico.login(force=True)
+        other_nico = self.server.make_nico_search(self.db_manager)
+        other_nico.login()
+        self.assertEquals(3, self.server.login_count)
+
+    def test_relogin(self):
+        nico = self.server.make_nico_search(self.db_manager)
+        nico.login()
+        # The server forgets the session.
+        self.server.sessions.clear()
+        other_nico = self.server.make_nico_search(self.db_manager)
+        other_nico.login()
+        self.assertTrue(other_nico._fetch(other_nico._fetch_videos, u'keyword'))
+        self.assertEquals(2, self.server.login_count)
+        self.assertTrue(nico._fetch(nico._fetch_videos, u'keyword'))
+        self.assertEquals(3, self.server.login_count)
+
+    def test_dump_and_load_cookies(self):
+        cookie_jar = cookielib.CookieJar()
+        nico = self.server.make_nico_search()
+        nico.login()
+        login_cache.load_cookies(cookie_jar,
+                                 login_cache.dump_cookies(nico.session.cookie_jar))
+        self.assertEquals(['user_session'], [c.name for c in cookie_jar])
+
+
+class CommentInfoCacheTest(StubNicoTestCase):
+    def search(self, keyword, **kwargs):
+        nico = self.server.make_nico_search(self.db_manager, **kwargs)
+        nico.login()
+        # Keywords have their own watermarks, so all comments are fetched.
+        videos = nico.search_videos_with_comments(keyword)
+        self.assertEquals(32, len(videos))
+        self.assertTrue(all(len(video.nico_comments) == 27 for video in videos))
+
+    def test_reuse_comment_info(self):
+        self.search(u'keyword1')
+        self.assertEquals(32, self.server.getflv_count)
+        self.search(u'keyword2')
+        self.assertEquals(32, self.server.getflv_count)
+
+    def test_expired_comment_info(self):
+        self.search(u'keyword1')
+        self.search(u'keyword2', comment_info_ttl_sec=0)
+        self.assertEquals(64, self.server.getflv_count)
+
+    def test_rejected_comment_info(self):
+        self.search(u'keyword1')
+        # The thread moved, so the cached comment info is rejected.
+        self.server.thread_id = '2'
+        self.search(u'keyword2')
+        self.assertEquals(64, self.server.getflv_count)
+        self.search(u'keyword3')
+        self.assertEquals(64, self.server.getflv_count)
+
+
+class ThreadWatermarkTest(StubNicoTestCase):
+    def search(self, keyword):
+        nico = self.server.make_nico_search(self.db_manager)
+        nico.login()
+        return nico.search_videos_with_comments(keyword)
+
+    def test_fetch_new_comments_only(self):
+        self.assertEquals(32, len(self.search(u'keyword')))
+        self.assertFalse(any('res_from' in body
+                             for body in self.server.post_bodies))
+        del self.server.post_bodies[:]
+
+        # Nothing is posted since the last fetch.
+        self.assertEquals([], self.search(u'keyword'))
+        self.assertEquals(32, len(self.server.post_bodies))
+        self.assertTrue(all('res_from="28"' in body
+                            for body in self.server.post_bodies))
+
+        # The other keyword has its own watermarks.
+        self.assertEquals(32, len(self.search(u'other')))
+
+    def test_parser_last_no(self):
+        from_datetime = datetime.datetime.fromtimestamp(2000000000)
+        parser = NicoCommentParser(from_datetime)
+        parser.parse(StringIO.StringIO(read_sample_comments_xml()))
+        self.assertEquals([], parser.nico_comments)
+        self.assertEquals(27, parser.last_no)
+
+
+class FetchMemoTest(StubNicoTestCase):
+    def test_shared_memo(self):
+        memo = fetch_memo.FetchMemo()
+        nico = self.server.make_nico_search(fetch_memo=memo)
+        nico.login()
+        self.assertEquals(32, len(nico.search_videos_with_comments(u'keyword')))
+        other_nico = self.server.make_nico_search(fetch_memo=memo)
+        other_nico.login()
+        self.assertEquals(32, len(other_nico.search_videos(u'keyword', sort='n')))
+        self.assertEquals(32, len(other_nico.search_videos_with_comments(u'keyword')))
+        self.assertEquals(1, self.server.search_count)
+        self.assertEquals(32, self.server.getflv_count)
+        self.assertEquals(33, memo.misses)
+        self.assertEquals(34, memo.hits)
+        # Other arguments are fetched.
+        other_nico.search_videos(u'keyword', sort='n', page=2)
+        self.assertEquals(2, self.server.search_count)
+
+    def test_rejected_comment_info(self):
+        memo = fetch_memo.FetchMemo()
+        nico = self.server.make_nico_search(fetch_memo=memo)
+        nico.login()
+        nico.search_videos_with_comments(u'keyword')
+        self.server.thread_id = '2'
+        videos = nico.search_videos_with_comments(u'keyword')
+        self.assertTrue(all(len(video.nico_comments) == 27 for video in videos))
+        self.assertEquals(64, self.server.getflv_count)
+
+    def test_comment_info_without_message_server(self):
+        nico = self.server.make_nico_search(fetch_memo=fetch_memo.FetchMemo())
+        nico.login()
+        self.server.no_ms_video_ids.add('sm1')
+        self.assertEquals((None, None, None),
+                          nico._fetch(nico._fetch_comment_info, 'sm1'))
+        self.server.no_ms_video_ids.clear()
+        ms, _, _ = nico._fetch(nico._fetch_comment_info, 'sm1')
+        self.assertEquals(self.server.base_url + '/api/', ms)
+        self.assertEquals(2, self.server.getflv_count)
+
+
+class FetchMemoUnitTest(unittest.TestCase):
+    def test_ttl(self):
+        clock = FakeClock()
+        memo = fetch_memo.FetchMemo(ttl_sec=60, clock=clock.time)
+        memo.put('key1', 'result1')
+        clock.now += 30
+        memo.put('key2', 'result2')
+        self.assertEquals((True, 'result1'), memo.get('key1'))
+        clock.now += 30
+        self.assertEquals((False, None), memo.get('key1'))
+        self.assertEquals((True, 'result2'), memo.get('key2'))
+        # Expired results are dropped without lookups.
+        clock.now += 60
+        memo.put('key3', 'result3')
+        self.assertEquals(1, len(memo))
+
+
+class PostedVideosTest(FileDbTestCase):
+    def setUp(self):
+        FileDbTestCase.setUp(self)
+        posted_videos.forget_posted_video_ids()
+
+    def tearDown(self):
+        posted_videos.forget_posted_video_ids()
+        FileDbTestCase.tearDown(self)
+
+    def count_queries(self, func, *args):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = self.db_manager.db_engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                before_cursor_execute)
+        try:
+            result = func(*args)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    before_cursor_execute)
+        return result, len(statements)
+
+    def test_find_post_videos(self):
+        for i in range(3):
+            self.db_manager.db_session.add(models.PostVideo('sm{}'.format(i)))
+        self.db_manager.commit()
+
+        video_ids = ['sm{}'.format(i) for i in range(10)]
+        post_videos, num_queries = self.count_queries(
+            posted_videos.find_post_videos, self.db_manager, video_ids)
+        self.assertEquals(['sm0', 'sm1', 'sm2'], sorted(post_videos))
+        # Loading the ids and one IN query.
+        self.assertEquals(2, num_queries)
+
+        post_videos, num_queries = self.count_queries(
+            posted_videos.find_post_videos, self.db_manager, ['sm5', 'sm6'])
+        self.assertEquals({}, post_videos)
+        self.assertEquals(0, num_queries)
+
+    def test_add_post_video(self):
+        posted_videos.find_post_videos(self.db_manager, [])
+        posted_videos.add_post_video(self.db_manager, models.PostVideo('sm1'))
+        post_videos = posted_videos.find_post_videos(self.db_manager, ['sm1'])
+        self.assertEquals(['sm1'], list(post_videos))
+
+    def test_search_latest_commenting_videos(self):
+        server = StubNicoServer(read_sample_search_json(),
+                                read_sample_comments_xml())
+        server.start()
+        try:
+            nico = server.make_nico_search(self.db_manager)
+            nico.login()
+            first_ids = [video.id for video in
+                         nico.search_latest_commenting_videos(u'keyword')]
+            second_ids = [video.id for video in
+                          nico.search_latest_commenting_videos(u'keyword')]
+        finally:
+            server.stop()
+        self.assertEquals(3, len(first_ids))
+        self.assertEquals(3, len(second_ids))
+        self.assertFalse(set(first_ids) & set(second_ids))
+
+
+class AsyncNicoSearchTest(StubNicoTestCase):
+    def setUp(self):
+        StubNicoTestCase.setUp(self)
+        self.nico = self.server.make_nico_search()
+
+    def test_login_and_search(self):
+        with AsyncNicoSearch(self.nico) as async_nico:
+            async_nico.login().get(10)
+            videos = async_nico.search_videos(u'keyword').get(10)
+        self.assertEquals(32, len(videos))
+        self.assertEquals('sm19714151', videos[0].id)
+
+    def test_fetch_comments(self):
+        with AsyncNicoSearch(self.nico) as async_nico:
+            async_nico.login().get(10)
+            ms, thread_id, user_id = async_nico.fetch_comment_info('sm1').get(10)
+            self.assertEquals(self.server.base_url + '/api/', ms)
+            videos = async_nico.search_videos(u'keyword').get(10)
+            result = async_nico.fetch_comments(videos[0]).get(10)
+        self.assertEquals(27, len(NicoCommentParser().parse(result)))
+
+    def test_track_keywords(self):
+        keywords = [u'keyword{}'.format(i) for i in range(5)]
+        with AsyncNicoSearch(self.nico, max_workers=5) as async_nico:
+            async_nico.login().get(10)
+            async_results = async_nico.track_keywords(keywords)
+            results, errors = niconico_async.gather(async_results, 30)
+        self.assertEquals({}, errors)
+        self.assertEquals(set(keywords), set(results))
+        self.assertEquals(5, self.server.search_count)
+        for videos in results.values():
+            self.assertTrue(videos)
+            self.assertTrue(all(len(video.nico_comments) == 27
+                                for video in videos))
+
+    def test_track_keywords_with_database(self):
+        db_manager = self.db_manager
+        nico = self.server.make_nico_search(db_manager)
+        try:
+            keywords = [u'keyword{}'.format(i) for i in range(16)]
+            with AsyncNicoSearch(nico, max_workers=8) as async_nico:
+                async_nico.login().get(10)
+                # The server forgets the session, so workers log in again.
+                self.server.sessions.clear()
+                async_results = async_nico.track_keywords(keywords)
+                results, errors = niconico_async.gather(async_results, 60)
+            self.assertEquals({}, errors)
+            self.assertEquals(set(keywords), set(results))
+            db_manager.commit()
+            db_session = db_manager.db_session
+            self.assertEquals(16 * 32, db_session.query(models.NicoThreadWatermark).count())
+            self.assertEquals(32, db_session.query(models.NicoCommentInfo).count())
+            self.assertEquals(1, db_session.query(models.NicoLoginSession).count())
+        finally:
+            nico.session.close()
+
 
 NG_ID = ['sm16284937', 'sm19370827', 'sm14276357', 'sm16577879', 'sm16570187', 'sm18308612', 'sm18976851', 'sm19644424']
 
 
+def read_sample_youtube_items():
+    with open(SAMPLE_YOUTUBE_RESULT) as f:
+        sample = f.read()
+    # Items are followed by the titles found in them.
+    sample = sample[:sample.rindex('}}') + 2]
+    return ast.literal_eval('[' + sample.replace('}}\n{', '}},\n{') + ']')
+
+
+class StubYoutubeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a discovery document of search().list() and the sample."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/discovery/'):
+            server.discovery_count += 1
+            self._respond(json.dumps(server.make_discovery_document()))
+        elif self.path.startswith('/youtube/v3/search?'):
+            server.search_count += 1
+            self._respond(json.dumps(server.search(self.path)))
+        else:
+            self.send_error(404)
+
+
+class StubYoutubeServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, items):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubYoutubeHandler)
+        self.items = sorted(items, key=lambda x: x['snippet']['publishedAt'],
+                            reverse=True)
+        self.discovery_count = 0
+        self.search_count = 0
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def search(self, path):
+        """Return a page of the items published after publishedAfter."""
+        query = dict((name, values[0]) for name, values
+                     in urlparse.parse_qs(urlparse.urlparse(path).query).items())
+        items = [item for item in self.items
+                 if item['snippet']['publishedAt'][:19] >= query['publishedAfter'][:19]]
+        start = int(query.get('pageToken', 0))
+        end = start + int(query['maxResults'])
+        response = {'items': items[start:end]}
+        if end < len(items):
+            response['nextPageToken'] = str(end)
+        return response
+
+    def make_discovery_document(self):
+        parameters = dict((name, {'type': 'string', 'location': 'query'})
+                          for name in ['q', 'part', 'maxResults', 'type',
+                                       'order', 'publishedAfter',
+                                       'pageToken'])
+        return {'kind': 'discovery#restDescription',
+                'name': 'youtube', 'version': 'v3',
+                'rootUrl': self.base_url + '/', 'servicePath': 'youtube/v3/',
+                'schemas': {'SearchListResponse': {
+                    'id': 'SearchListResponse', 'type': 'object'}},
+                'resources': {'search': {'methods': {'list': {
+                    'id': 'youtube.search.list', 'path': 'search',
+                    'httpMethod': 'GET', 'parameters': parameters,
+                    'response': {'$ref': 'SearchListResponse'}}}}}}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class YoutubeSearchTest(FileDbTestCase):
+    def setUp(self):
+        FileDbTestCase.setUp(self)
+        self.server = StubYoutubeServer(read_sample_youtube_items())
+        self.server.start()
+        self.discovery_file = os.path.join(self.db_dir, 'discovery.json')
+        youtube.forget_services()
+
+    def tearDown(self):
+        youtube.forget_services()
+        self.server.stop()
+        FileDbTestCase.tearDown(self)
+
+    def make_youtube_search(self, developer_key='developer_key',
+                            db_manager=None):
+        return YoutubeSearch(developer_key, self.discovery_file,
+                             self.server.base_url + '/discovery/youtube/v3',
+                             db_manager=db_manager)
+
+    def test_search_videos(self):
+        videos = self.make_youtube_search().search_videos('MBAACC OR MBAA')
+        self.assertEquals(10, len(videos))
+        self.assertEquals(sorted(videos, key=lambda x: x.published_at, reverse=True),
+                          videos)
+        self.assertEquals(1, self.server.search_count)
+        self.assertEquals(1, self.server.discovery_count)
+        self.assertTrue(os.path.isfile(self.discovery_file))
+
+    def test_search_videos_pages(self):
+        youtube_search = self.make_youtube_search()
+        youtube_search.MAX_RESULTS = 3
+        videos = youtube_search.search_videos('MBAACC OR MBAA')
+        self.assertEquals(10, len(videos))
+        self.assertEquals(4, self.server.search_count)
+
+        self.server.search_count = 0
+        videos = youtube_search.search_videos('MBAACC OR MBAA',
+                                              videos[4].published_at)
+        self.assertEquals(5, len(videos))
+        self.assertEquals(2, self.server.search_count)
+
+    def test_watermark(self):
+        youtube_search = self.make_youtube_search(db_manager=self.db_manager)
+        videos = youtube_search.search_videos('MBAACC OR MBAA')
+        newest_published_at = videos[0].published_at
+        self.assertEquals(newest_published_at,
+                          youtube_search.watermarks.get('MBAACC OR MBAA'))
+
+        # Only videos newer than the newest one seen are returned.
+        self.server.search_count = 0
+        self.assertEquals([], youtube_search.search_videos('MBAACC OR MBAA'))
+        self.assertEquals(1, self.server.search_count)
+        self.assertEquals(None, youtube_search.watermarks.get('MBAACC'))
+
+        # Another video published in the same second is still new.
+        item = copy.deepcopy(self.server.items[0])
+        item['id']['videoId'] = 'same_second'
+        self.server.items.insert(0, item)
+        videos = youtube_search.search_videos('MBAACC OR MBAA')
+        self.assertEquals(['same_second'], [video.video_id for video in videos])
+        self.assertEquals([], youtube_search.search_videos('MBAACC OR MBAA'))
+        self.assertEquals(newest_published_at,
+                          youtube_search.watermarks.get('MBAACC OR MBAA'))
+
+    def test_service_cache(self):
+        youtube_search = self.make_youtube_search()
+        service = youtube_search.get_service()
+        self.assertTrue(service is self.make_youtube_search().get_service())
+        self.assertFalse(service is self.make_youtube_search('other_key').get_service())
+        self.assertEquals(1, self.server.discovery_count)
+
+        # A new process reads the saved document.
+        youtube.forget_services()
+        self.assertFalse(service is youtube_search.get_service())
+        self.assertEquals(1, self.server.discovery_count)
+
+
 class TwitterVideoBotTest(unittest.TestCase):
     def setUp(self):
         config = Config(BOT_CONFIG, section='niconico')
@@ -249,6 +1579,74 @@ class TwitterVideoBotTest(unittest.TestCase):
         bot.youtube_video_post('mbaacc OR mbaa', None)
 
 
+class TwitterVideoBotBatchTest(StubNicoTestCase):
+    """Batch posts against the stub server, which finds the same videos
+    by any keyword."""
+
+    def setUp(self):
+        StubNicoTestCase.setUp(self)
+        self.db_name = DbManager.DB_NAME
+        DbManager.DB_NAME = self.db_manager.db_name
+        posted_videos.forget_posted_video_ids()
+        self.nicos = []
+        self.bot = TwitterVideoBot(SAMPLE_BOT_CONFIG, auto_dispatch=False)
+        self.bot._make_nico_search = self.make_nico_search
+
+    def tearDown(self):
+        for nico in self.nicos:
+            nico.session.close()
+        posted_videos.forget_posted_video_ids()
+        DbManager.DB_NAME = self.db_name
+        StubNicoTestCase.tearDown(self)
+
+    def make_nico_search(self, db_manager):
+        nico = self.server.make_nico_search(db_manager,
+                                            fetch_memo=self.bot.nico_fetch_memo)
+        self.nicos.append(nico)
+        return nico
+
+    def enqueued(self):
+        self.db_manager.rollback()
+        return self.db_manager.db_session.query(models.OutboxMessage.dedup_key,
+                                                models.OutboxMessage.message).all()
+
+    def test_nico_video_post_batch(self):
+        self.bot.nico_video_post_batch([(u'keyword1', 'A {title} [{}] {url}'),
+                                        (u'keyword2', 'B {title} [{}] {url}')], None)
+        enqueued = self.enqueued()
+        self.assertEquals(32, len(enqueued))
+        self.assertTrue(all(msg.startswith('A ') for _, msg in enqueued))
+        self.assertEquals(32, self.db_manager.db_session.query(models.PostVideo).count())
+
+    def test_nico_comment_post_batch(self):
+        self.bot.nico_comment_post_batch([(u'keyword1', 'A {comment} {title} {url}'),
+                                          (u'keyword2', 'B {comment} {title} {url}')], None)
+        enqueued = self.enqueued()
+        self.assertEquals(32 * 3, len(enqueued))
+        self.assertTrue(all(msg.startswith('A ') for _, msg in enqueued))
+        # Comments of a video are fetched for the first keyword only.
+        self.assertEquals(32, len(self.server.post_bodies))
+
+    def test_nico_latest_commenting_video_post_batch(self):
+        # Videos may be posted twice, but not by two keywords of a batch.
+        self.bot.nico_latest_commenting_video_post_batch(
+            [u'keyword1', u'keyword2'], None, number_of_results=3,
+            max_post_count=2)
+        video_ids = [dedup_key.split(':')[1] for dedup_key, _ in self.enqueued()]
+        self.assertEquals(6, len(video_ids))
+        self.assertEquals(6, len(set(video_ids)))
+
+    def test_youtube_discovery_file(self):
+        self.assertEquals(os.path.abspath('samples/youtube_v3_discovery.json'),
+                          self.bot.youtube_discovery_file)
+
+    def test_keyword_formats(self):
+        self.assertEquals([('a', 'default'), ('b', 'format')],
+                          TwitterVideoBot._keyword_formats(['a', ('b', 'format')], 'default'))
+        self.assertEquals([('a', '1'), ('b', '2')],
+                          TwitterVideoBot._keyword_formats({'b': '2', 'a': '1'}, 'default'))
+
+
 from tweepy.error import TweepError
 
 
@@ -282,6 +1680,34 @@ class TwitterBotBaseTest(unittest.TestCase):
         except:
             pass
 
+    def test_learn_concurrent_responses(self):
+        api = self.bot.api
+        is_set = threading.Event()
+        is_overwritten = threading.Event()
+
+        def make_response(remaining):
+            return FakeResponse({'x-rate-limit-limit': '15',
+                                 'x-rate-limit-remaining': str(remaining),
+                                 'x-rate-limit-reset': str(int(time.time()) + 600)})
+
+        def exhausted():
+            api.last_response = make_response(0)
+            is_set.set()
+            is_overwritten.wait(10)
+
+        def fresh():
+            is_set.wait(10)
+            api.last_response = make_response(14)
+            is_overwritten.set()
+
+        thread = threading.Thread(target=self.bot.scheduler.call,
+                                  args=('followers/ids', exhausted))
+        thread.start()
+        self.bot.scheduler.call('friends/ids', fresh)
+        thread.join()
+        self.assertEquals(0, self.bot.scheduler.bucket('followers/ids').tokens)
+        self.assertEquals(14, self.bot.scheduler.bucket('friends/ids').tokens)
+
 
 class UtilTest(unittest.TestCase):
     def setUp(self):
@@ -6,7 +6,9 @@ This module is for twitter bot.
 
 from config import Config
 
-from niconico import NicoSearch, NicoVideo, NicoComment
+from niconico import NicoSearch, NicoVideo, NicoComment, NicoCommentParser
+
+from niconico_async import AsyncNicoSearch
 
 from youtube import YoutubeSearch, YoutubeVideo
 
@@ -16,4 +18,6 @@ from models import Job, User
 
 from job import JobManager
 
+from scheduler import RateLimitScheduler
+
 from twitter_bot import TwitterBotBase, TwitterBot, TwitterVideoBot
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import datetime
+import logging
+import threading
+
+from follow_graph import chunks, IN_CHUNK_SIZE
+from models import NicoCommentInfo
+
+logger = logging.getLogger(__name__)
+
+
+class CommentInfoCache(object):
+    """Cache of getflv results (message server, thread and user ID) per video.
+
+    Entries are read from and written to the bot database only by the
+    thread owning the session (preload() and save()); fetch threads use
+    get(), put() and invalidate(), which work in memory.
+    """
+
+    def __init__(self, db_manager, ttl_sec=24 * 60 * 60):
+        self.db_manager = db_manager
+        self.ttl_sec = ttl_sec
+
+        # video_id: (message_server_url, thread_id, user_id, fetched_at)
+        self._entries = {}
+        self._dirty_ids = set()
+        self._invalidated_ids = set()
+        self._lock = threading.Lock()
+
+    def _is_alive(self, fetched_at, now):
+        return now - fetched_at < datetime.timedelta(seconds=self.ttl_sec)
+
+    def preload(self, video_ids, now=None):
+        """Read alive entries of video_ids from the database."""
+        now = now or datetime.datetime.now()
+        with self._lock:
+            video_ids = [video_id for video_id in set(video_ids)
+                         if video_id not in self._entries
+                         and video_id not in self._invalidated_ids]
+        db_session = self.db_manager.db_session
+        for chunk in chunks(video_ids, IN_CHUNK_SIZE):
+            comment_infos = db_session.query(NicoCommentInfo) \
+                .filter(NicoCommentInfo.video_id.in_(chunk)).all()
+            with self._lock:
+                for comment_info in comment_infos:
+                    if not self._is_alive(comment_info.fetched_at, now):
+                        continue
+                    self._entries.setdefault(
+                        comment_info.video_id,
+                        (comment_info.message_server_url,
+                         comment_info.thread_id, comment_info.user_id,
+                         comment_info.fetched_at))
+
+    def get(self, video_id, now=None):
+        """Return (message_server_url, thread_id, user_id) or None."""
+        now = now or datetime.datetime.now()
+        with self._lock:
+            entry = self._entries.get(video_id)
+        if entry is None or not self._is_alive(entry[3], now):
+            return None
+        return entry[:3]
+
+    def put(self, video_id, message_server_url, thread_id, user_id):
+        with self._lock:
+            self._entries[video_id] = (message_server_url, thread_id, user_id,
+                                       datetime.datetime.now())
+            self._dirty_ids.add(video_id)
+            self._invalidated_ids.discard(video_id)
+
+    def invalidate(self, video_id):
+        """Forget the entry of video_id. Returns True if it was cached."""
+        with self._lock:
+            entry = self._entries.pop(video_id, None)
+            self._dirty_ids.discard(video_id)
+            self._invalidated_ids.add(video_id)
+        if entry is not None:
+            logger.info('Invalidate comment info : video_id={}'.format(video_id))
+        return entry is not None
+
+    def save(self):
+        """Write changed entries to the database session."""
+        with self._lock:
+            entries = dict((video_id, self._entries[video_id])
+                           for video_id in self._dirty_ids)
+            invalidated_ids = list(self._invalidated_ids)
+            self._dirty_ids = set()
+            self._invalidated_ids = set()
+
+        db_session = self.db_manager.db_session
+        for chunk in chunks(invalidated_ids, IN_CHUNK_SIZE):
+            db_session.query(NicoCommentInfo) \
+                .filter(NicoCommentInfo.video_id.in_(chunk)) \
+                .delete(synchronize_session=False)
+        for video_id, (message_server_url, thread_id, user_id, fetched_at) \
+                in entries.items():
+            db_session.merge(NicoCommentInfo(video_id, message_server_url,
+                                             thread_id, user_id, fetched_at))
+        db_session.flush()
@@ -4,19 +4,95 @@
 from __future__ import print_function
 import logging
 import sqlalchemy
+import sqlalchemy.engine.url
+import sqlalchemy.event
 import sqlalchemy.orm
+import sqlalchemy.pool
+import threading
+
+import migration
 
 logger = logging.getLogger(__name__)
 
+# Applied to every new SQLite connection.
+# WAL lets readers and a writer work at the same time, and
+# synchronous=NORMAL is safe with WAL. cache_size is in KiB when negative.
+SQLITE_PRAGMAS = ['PRAGMA journal_mode=WAL',
+                  'PRAGMA synchronous=NORMAL',
+                  'PRAGMA cache_size=-16384']
+
+SQLITE_POOL_SIZE = 5
+
+# {db_name: (engine, session factory)}
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def _create_engine(db_name):
+    url = sqlalchemy.engine.url.make_url(db_name)
+    is_sqlite = url.drivername.startswith('sqlite')
+    kwargs = {}
+    if is_sqlite and url.database not in (None, '', ':memory:'):
+        # Pool connections to the file so that they are shared by threads.
+        kwargs['poolclass'] = sqlalchemy.pool.QueuePool
+        kwargs['pool_size'] = SQLITE_POOL_SIZE
+        kwargs['connect_args'] = {'check_same_thread': False}
+    db_engine = sqlalchemy.create_engine(db_name, **kwargs)
+    if is_sqlite:
+        sqlalchemy.event.listen(db_engine, 'connect', _set_sqlite_pragmas)
+    return db_engine
+
+
+def _get_registered(db_name):
+    with _registry_lock:
+        registered = _registry.get(db_name)
+        if registered is None:
+            logger.debug('Create engine : db_name={}'.format(db_name))
+            db_engine = _create_engine(db_name)
+            # Jobs of a new version may run before create_database().
+            version = migration.upgrade_existing(db_engine)
+            logger.debug('Database schema version : {}'.format(version))
+            registered = (db_engine,
+                          sqlalchemy.orm.sessionmaker(bind=db_engine))
+            _registry[db_name] = registered
+        return registered
+
+
+def get_engine(db_name):
+    """Return the engine of db_name shared in the process."""
+    return _get_registered(db_name)[0]
+
+
+def get_session_factory(db_name):
+    """Return the session factory of db_name shared in the process."""
+    return _get_registered(db_name)[1]
+
+
+def dispose_engines():
+    """Close all pooled connections and forget the engines."""
+    with _registry_lock:
+        for db_engine, _ in _registry.values():
+            db_engine.dispose()
+        _registry.clear()
+
 
 class DbManager(object):
     DB_NAME = 'sqlite:///twitter_bot.db'
 
-    def __init__(self):
-        self.db_name = DbManager.DB_NAME
+    def __init__(self, db_name=None):
+        self.db_name = db_name or DbManager.DB_NAME
         # Create db session.
-        self.db_engine = sqlalchemy.create_engine(self.db_name)
-        Session = sqlalchemy.orm.sessionmaker(bind=self.db_engine)
+        self.db_engine = get_engine(self.db_name)
+        Session = get_session_factory(self.db_name)
         self.db_session = Session()
 
     def __enter__(self):
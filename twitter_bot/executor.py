@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import functools
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor(object):
+    """Runs a function over items on at most max_workers threads.
+
+    Results are returned in the order of the items as
+    (is_success, result or exception) tuples, so one failure does not
+    abort the others. max_workers=1 runs everything in the caller's thread.
+    """
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max(max_workers, 1)
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            # Do not wait for the rest of the items.
+            self.terminate()
+        else:
+            self.close()
+        return False
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+        return self._pool
+
+    def map(self, func, items):
+        """Run func(item) for items and return the results as a list."""
+        if self.max_workers == 1 or len(items) <= 1:
+            return [_call(func, item) for item in items]
+        return self._get_pool().map(functools.partial(_call, func), items)
+
+    def imap(self, func, items):
+        """Run func(item) for items and yield the results in order."""
+        if self.max_workers == 1:
+            return (_call(func, item) for item in items)
+        return self._get_pool().imap(functools.partial(_call, func), items)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+def _call(func, item):
+    try:
+        return True, func(item)
+    except Exception as e:
+        return False, e
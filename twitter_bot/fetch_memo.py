@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FetchMemo(object):
+    """Results of identical fetches within a run.
+
+    Shared by the NicoSearch instances of a run, so the same search or
+    getflv request goes to the network only once. hits and misses count
+    the lookups. Results expire after ttl_sec (None: never), so an
+    instance kept over runs fetches again and does not grow forever.
+    """
+    _MISSING = object()
+
+    def __init__(self, ttl_sec=None, clock=time.time):
+        self.ttl_sec = ttl_sec
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # {key: (stored_at, result)}
+        self._results = {}
+        self._purged_at = clock()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __str__(self):
+        return 'hits={}, misses={}, size={}' \
+            .format(self.hits, self.misses, len(self))
+
+    def get(self, key):
+        """Return (True, result) if key is memoized, or (False, None)."""
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and self._is_expired(entry, self.clock()):
+                del self._results[key]
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, result):
+        with self._lock:
+            now = self.clock()
+            self._results[key] = (now, result)
+            if self.ttl_sec is not None \
+                    and now - self._purged_at >= self.ttl_sec:
+                self._purge(now)
+
+    def _is_expired(self, entry, now):
+        return self.ttl_sec is not None and now - entry[0] >= self.ttl_sec
+
+    def _purge(self, now):
+        for key, entry in self._results.items():
+            if self._is_expired(entry, now):
+                del self._results[key]
+        self._purged_at = now
+
+    def discard(self, key):
+        """Forget the result of key. Returns True if it was memoized."""
+        with self._lock:
+            return self._results.pop(key, FetchMemo._MISSING) \
+                is not FetchMemo._MISSING
+
+    def clear(self):
+        with self._lock:
+            self._results = {}
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import logging
+import sqlalchemy
+
+from models import User
+
+logger = logging.getLogger(__name__)
+
+# The number of rows to read per SELECT when loading the user table.
+LOAD_CHUNK_SIZE = 10000
+
+# The number of rows to write per executemany().
+WRITE_BATCH_SIZE = 10000
+
+# The number of ids per IN (...) clause.
+# (SQLite allows at most 999 host parameters per statement.)
+IN_CHUNK_SIZE = 500
+
+
+def chunks(seq, size):
+    """Split a sequence into lists of at most size items."""
+    chunk = []
+    for item in seq:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_user_states(db_session, user_ids=None, chunk_size=LOAD_CHUNK_SIZE,
+                     in_chunk_size=IN_CHUNK_SIZE):
+    """Load {user_id: (follow_status, follower_status)}.
+
+    All users are read in user_id order, chunk_size rows at a time, unless
+    user_ids is specified.
+    """
+    user_table = User.__table__
+    columns = [user_table.c.user_id,
+               user_table.c.follow_status,
+               user_table.c.follower_status]
+    states = {}
+    if user_ids is not None:
+        for chunk in chunks(user_ids, in_chunk_size):
+            query = sqlalchemy.select(columns) \
+                .where(user_table.c.user_id.in_(chunk))
+            for user_id, follow_status, follower_status in db_session.execute(query):
+                states[user_id] = (follow_status, follower_status)
+        return states
+
+    last_user_id = None
+    while True:
+        query = sqlalchemy.select(columns) \
+            .order_by(user_table.c.user_id).limit(chunk_size)
+        if last_user_id is not None:
+            query = query.where(user_table.c.user_id > last_user_id)
+        rows = db_session.execute(query).fetchall()
+        for user_id, follow_status, follower_status in rows:
+            states[user_id] = (follow_status, follower_status)
+        if len(rows) < chunk_size:
+            break
+        last_user_id = rows[-1][0]
+    return states
+
+
+def find_existing_user_ids(db_session, user_ids, chunk_size=IN_CHUNK_SIZE):
+    """Return the set of user_ids that already exist in the user table."""
+    user_table = User.__table__
+    existing_ids = set()
+    for chunk in chunks(user_ids, chunk_size):
+        query = sqlalchemy.select([user_table.c.user_id]) \
+            .where(user_table.c.user_id.in_(chunk))
+        existing_ids.update(row[0] for row in db_session.execute(query))
+    return existing_ids
+
+
+def find_drifted_user_ids(db_session, follower_ids, friend_ids):
+    """Return the users in follower_ids or friend_ids whose follow_status
+    was set by a follow/unfollow call (removed or cannot_follow_back).
+
+    upsert_users() derives another status for them from the sets, but they
+    do not appear in a snapshot diff. follower_ids/friend_ids may be any
+    container supporting "in" (e.g. IdSnapshot).
+    """
+    user_table = User.__table__
+    query = sqlalchemy.select([user_table.c.user_id]) \
+        .where(user_table.c.follow_status.in_([
+            User.follow_status_removed,
+            User.follow_status_cannot_follow_back]))
+    return set(user_id for user_id, in db_session.execute(query)
+               if user_id in follower_ids or user_id in friend_ids)
+
+
+def insert_users(db_session, user_ids, follow_status, follower_status, date,
+                 batch_size=WRITE_BATCH_SIZE):
+    """Insert new users with the same status."""
+    rows = ({'user_id': user_id,
+             'follow_status': follow_status,
+             'follower_status': follower_status,
+             'date': date} for user_id in user_ids)
+    insert = User.__table__.insert()
+    for batch in chunks(rows, batch_size):
+        db_session.execute(insert, batch)
+
+
+def update_follow_status(db_session, user_ids, follow_status, date,
+                         chunk_size=IN_CHUNK_SIZE):
+    """Set follow_status and date of users."""
+    user_table = User.__table__
+    for chunk in chunks(user_ids, chunk_size):
+        update = user_table.update() \
+            .where(user_table.c.user_id.in_(chunk)) \
+            .values(follow_status=follow_status, date=date)
+        db_session.execute(update)
+
+
+def upsert_users(db_session, follower_ids, friend_ids, date, user_ids=None,
+                 batch_size=WRITE_BATCH_SIZE):
+    """Reconcile the user table with the follower and friend id sets.
+
+    Every user in follower_ids | friend_ids gets follow_status and
+    follower_status derived from the sets, same as update_database() always
+    did. Only new users and users whose status changed are written.
+    Users in neither set are left untouched.
+
+    When user_ids is specified, only those users are reconciled and
+    follower_ids/friend_ids may be any container supporting "in"
+    (e.g. IdSnapshot).
+
+    Returns (the number of inserted users, the number of updated users).
+    """
+    user_table = User.__table__
+    if user_ids is None:
+        follower_ids = set(follower_ids)
+        friend_ids = set(friend_ids)
+        user_ids = follower_ids | friend_ids
+        states = load_user_states(db_session)
+    else:
+        user_ids = [user_id for user_id in user_ids
+                    if user_id in follower_ids or user_id in friend_ids]
+        states = load_user_states(db_session, user_ids=user_ids)
+
+    new_users = []
+    changed_users = []
+    for user_id in user_ids:
+        follow_status = User.follow_status_following if user_id in friend_ids \
+            else User.follow_status_not_following
+        follower_status = User.follower_status_follower if user_id in follower_ids \
+            else User.follower_status_not_follower
+        state = states.get(user_id)
+        if state is None:
+            new_users.append({'user_id': user_id,
+                              'follow_status': follow_status,
+                              'follower_status': follower_status,
+                              'date': date})
+        elif state != (follow_status, follower_status):
+            changed_users.append({'b_user_id': user_id,
+                                  'b_follow_status': follow_status,
+                                  'b_follower_status': follower_status,
+                                  'b_date': date})
+
+    insert = user_table.insert()
+    for batch in chunks(new_users, batch_size):
+        db_session.execute(insert, batch)
+
+    update = user_table.update() \
+        .where(user_table.c.user_id == sqlalchemy.bindparam('b_user_id')) \
+        .values(follow_status=sqlalchemy.bindparam('b_follow_status'),
+                follower_status=sqlalchemy.bindparam('b_follower_status'),
+                date=sqlalchemy.bindparam('b_date'))
+    for batch in chunks(changed_users, batch_size):
+        db_session.execute(update, batch)
+
+    logger.debug('upsert_users(): inserted={}, updated={}'
+                 .format(len(new_users), len(changed_users)))
+    return len(new_users), len(changed_users)
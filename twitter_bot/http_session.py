@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import cookielib
+import httplib
+import logging
+import socket
+import threading
+import urllib2
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class HttpSession(object):
+    """HTTP client with its own cookie jar and keep-alive connections.
+
+    Connections are pooled per (scheme, host, port) and reused once the
+    previous response has been read to the end, so repeated requests to a
+    host do not pay for a new TCP/TLS handshake. Unlike
+    urllib2.install_opener(), cookies belong to the session, not to the
+    process.
+    """
+    MAX_REDIRECTS = 5
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    def __init__(self, cookie_jar=None, max_idle_per_host=4, timeout=60):
+        self.cookie_jar = cookie_jar if cookie_jar is not None \
+            else cookielib.CookieJar()
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        """Close idle connections."""
+        with self._lock:
+            connections = [connection
+                           for connections in self._idle_connections.values()
+                           for connection in connections]
+            self._idle_connections = {}
+        for connection in connections:
+            connection.close()
+
+    def open(self, url, data=None, headers=None):
+        """Request url (POST when data is specified) and return the response.
+
+        Redirects are followed like urllib2, and urllib2.HTTPError is
+        raised for error statuses.
+        """
+        for _ in range(HttpSession.MAX_REDIRECTS + 1):
+            response = self._open(url, data, headers)
+            location = response.getheader('location')
+            if response.code not in HttpSession.REDIRECT_CODES or not location:
+                break
+            response.read()
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                data = None
+        else:
+            raise urllib2.HTTPError(url, response.code,
+                                    'Too many redirects', response.info(),
+                                    response)
+
+        if response.code >= 400:
+            raise urllib2.HTTPError(url, response.code, response.msg,
+                                    response.info(), response)
+        return response
+
+    def _open(self, url, data, headers):
+        request = urllib2.Request(url, data, headers or {})
+        self.cookie_jar.add_cookie_header(request)
+        request_headers = dict(request.header_items())
+        if data is not None:
+            request_headers.setdefault('Content-Type',
+                                       'application/x-www-form-urlencoded')
+        key = (request.get_type(), request.get_host())
+        path = request.get_selector()
+
+        while True:
+            connection, is_reused = self._get_connection(key)
+            try:
+                connection.request(request.get_method(), path, data,
+                                   request_headers)
+                raw_response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # The server closed an idle connection. Retry on a new one.
+                if not is_reused:
+                    raise
+                logger.debug('Reconnect to {}'.format(key))
+
+        response = PooledResponse(self, key, connection, raw_response, url)
+        self.cookie_jar.extract_cookies(response, request)
+        return response
+
+    def _get_connection(self, key):
+        with self._lock:
+            connections = self._idle_connections.get(key)
+            if connections:
+                return connections.pop(), True
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle_connections.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+class PooledResponse(object):
+    """Response which gives its connection back to the session when read."""
+
+    def __init__(self, session, key, connection, raw_response, url):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.raw_response = raw_response
+        self.url = url
+        self.code = raw_response.status
+        self.msg = raw_response.reason
+
+    def info(self):
+        return self.raw_response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def getheader(self, name, default=None):
+        return self.raw_response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self.raw_response.read(amt)
+        except Exception:
+            # The rest of the body is unknown, so the connection is not
+            # reused.
+            self._close_connection()
+            raise
+        if self.raw_response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self.connection is None:
+            return
+        if not self.raw_response.isclosed():
+            # The rest of the body is still on the connection.
+            self._close_connection()
+            return
+        self._release()
+
+    def _close_connection(self):
+        connection, self.connection = self.connection, None
+        self.raw_response.close()
+        if connection is not None:
+            connection.close()
+
+    def _release(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        if self.raw_response.will_close:
+            connection.close()
+        else:
+            self.session._release(self.key, connection)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import cookielib
+import datetime
+import json
+import logging
+
+from models import NicoLoginSession
+
+logger = logging.getLogger(__name__)
+
+# Attributes to rebuild cookielib.Cookie.
+COOKIE_ATTRS = ['version', 'name', 'value', 'port', 'port_specified',
+                'domain', 'domain_specified', 'domain_initial_dot', 'path',
+                'path_specified', 'secure', 'expires', 'discard', 'comment',
+                'comment_url', 'rfc2109']
+
+
+def dump_cookies(cookie_jar):
+    """Serialize cookies of cookie_jar (including session cookies) to JSON."""
+    cookies = []
+    for cookie in cookie_jar:
+        values = dict((attr, getattr(cookie, attr)) for attr in COOKIE_ATTRS)
+        values['rest'] = cookie._rest
+        cookies.append(values)
+    return json.dumps(cookies)
+
+
+def load_cookies(cookie_jar, data):
+    """Set cookies serialized by dump_cookies() to cookie_jar."""
+    for values in json.loads(data):
+        cookie_jar.set_cookie(cookielib.Cookie(**values))
+
+
+def get_expires_at(cookie_jar, default_ttl_sec):
+    """Return when the first cookie with an expiry expires.
+
+    Session cookies have no expiry, so now + default_ttl_sec is used when
+    no cookie has one.
+    """
+    expires = [cookie.expires for cookie in cookie_jar
+               if cookie.expires is not None]
+    if not expires:
+        return datetime.datetime.now() \
+            + datetime.timedelta(seconds=default_ttl_sec)
+    return datetime.datetime.fromtimestamp(min(expires))
+
+
+class LoginCache(object):
+    """Keeps logged in cookies per account in the bot database."""
+
+    def __init__(self, db_manager, default_ttl_sec=24 * 60 * 60):
+        self.db_manager = db_manager
+        self.default_ttl_sec = default_ttl_sec
+
+    def load(self, user_id, cookie_jar, now=None):
+        """Set the cached cookies of user_id to cookie_jar.
+
+        Returns False when nothing is cached or the cache has expired.
+        """
+        now = now or datetime.datetime.now()
+        login_session = self.db_manager.db_session.query(NicoLoginSession) \
+            .get(user_id)
+        if login_session is None:
+            return False
+        if login_session.expires_at <= now:
+            logger.info('Login session expired : {}'.format(login_session))
+            return False
+        load_cookies(cookie_jar, login_session.cookies)
+        # Drop cookies which expired while cached.
+        cookie_jar.clear_expired_cookies()
+        logger.debug('Reuse login session : {}'.format(login_session))
+        return True
+
+    def save(self, user_id, cookie_jar):
+        """Save cookies of cookie_jar as the session of user_id."""
+        db_session = self.db_manager.db_session
+        cookies = dump_cookies(cookie_jar)
+        expires_at = get_expires_at(cookie_jar, self.default_ttl_sec)
+        login_session = db_session.query(NicoLoginSession).get(user_id)
+        if login_session is None:
+            db_session.add(NicoLoginSession(user_id, cookies, expires_at))
+        else:
+            login_session.cookies = cookies
+            login_session.expires_at = expires_at
+            login_session.updated_at = datetime.datetime.now()
+        # Saved with the transaction of the job, so the next jobs reuse it.
+        db_session.flush()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import datetime
+import logging
+import sqlalchemy
+
+from models import (FetchCursor, NicoCommentInfo, NicoLoginSession,
+                    NicoThreadWatermark, OutboxMessage, SchemaVersion,
+                    YoutubeWatermark, YoutubeWatermarkVideo)
+
+logger = logging.getLogger(__name__)
+
+# [(version, description, [SQL statement or Table, ]), ]
+# Statements must be idempotent, because create_all() already creates the
+# latest schema (including indexes) on a new database. Tables are created
+# only when missing.
+MIGRATIONS = [
+    (1, 'Add indexes for follow/unfollow and post_video pruning', [
+        'CREATE INDEX IF NOT EXISTS ix_user_follow_status_date'
+        ' ON user (follow_status, date)',
+        'CREATE INDEX IF NOT EXISTS ix_user_follower_status_follow_status_date'
+        ' ON user (follower_status, follow_status, date)',
+        'CREATE INDEX IF NOT EXISTS ix_post_video_last_post_datetime'
+        ' ON post_video (last_post_datetime)',
+    ]),
+    (2, 'Add fetch_cursor to resume id harvests', [
+        FetchCursor.__table__,
+    ]),
+    (3, 'Add tweet_outbox to post messages apart from fetching', [
+        OutboxMessage.__table__,
+    ]),
+    (4, 'Add nico_login_session to reuse logins', [
+        NicoLoginSession.__table__,
+    ]),
+    (5, 'Add nico_comment_info to reuse getflv results', [
+        NicoCommentInfo.__table__,
+    ]),
+    (6, 'Add nico_thread_watermark to fetch new comments only', [
+        NicoThreadWatermark.__table__,
+    ]),
+    (7, 'Add youtube_watermark to search new videos only', [
+        YoutubeWatermark.__table__,
+    ]),
+    (8, 'Add youtube_watermark_video to keep videos at the watermark', [
+        YoutubeWatermarkVideo.__table__,
+    ]),
+]
+
+
+def get_version(db_engine):
+    """Return the latest applied migration version. (0: none)"""
+    SchemaVersion.__table__.create(db_engine, checkfirst=True)
+    query = sqlalchemy.select([sqlalchemy.func.max(SchemaVersion.__table__.c.version)])
+    return db_engine.execute(query).scalar() or 0
+
+
+def upgrade(db_engine, migrations=None):
+    """Apply migrations newer than the database in order.
+
+    Returns the version of the database.
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    version = get_version(db_engine)
+    for migration_version, description, statements in migrations:
+        if migration_version <= version:
+            continue
+        logger.info('Apply migration {} : {}'
+                    .format(migration_version, description))
+        with db_engine.begin() as connection:
+            for statement in statements:
+                if isinstance(statement, sqlalchemy.Table):
+                    statement.create(connection, checkfirst=True)
+                else:
+                    connection.execute(sqlalchemy.text(statement))
+            connection.execute(SchemaVersion.__table__.insert(),
+                               {'version': migration_version,
+                                'applied_at': datetime.datetime.now()})
+        version = migration_version
+    return version
+
+
+def upgrade_existing(db_engine):
+    """Upgrade a database made by an older version.
+
+    A database without tables is left to create_database(). Returns the
+    version of the database, or None when it has no tables.
+    """
+    if not sqlalchemy.inspect(db_engine).get_table_names():
+        return None
+    return upgrade(db_engine)
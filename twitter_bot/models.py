@@ -37,6 +37,14 @@ class Job(Base):
 
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (
+        # follow_not_following_users()
+        sqlalchemy.Index('ix_user_follow_status_date', 'follow_status', 'date'),
+        # unfollow_not_followers()
+        sqlalchemy.Index('ix_user_follower_status_follow_status_date',
+                         'follower_status', 'follow_status', 'date'),
+    )
+
     # Twitter user id
     user_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
 
@@ -80,6 +88,10 @@ class User(Base):
 
 class PostVideo(Base):
     __tablename__ = 'post_video'
+    __table_args__ = (
+        sqlalchemy.Index('ix_post_video_last_post_datetime',
+                         'last_post_datetime'),
+    )
 
     # video_id
     video_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
@@ -102,3 +114,250 @@ class PostVideo(Base):
     def __repr__(self):
         return "Job<'{}','{}', {}>" \
             .format(self.video_id, self.last_post_datetime, self.post_count)
+
+
+class FetchCursor(Base):
+    __tablename__ = 'fetch_cursor'
+
+    # name : Name of the paginated fetch. (e.g. 'followers')
+    name = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    # cursor : Next cursor to fetch.
+    cursor = sqlalchemy.Column(sqlalchemy.Integer)
+
+    # updated_at : Datetime when the cursor saved.
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, name, cursor=-1, updated_at=None):
+        self.name = name
+        self.cursor = cursor
+        self.updated_at = updated_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'name={}, cursor={}, updated_at={}' \
+            .format(self.name, self.cursor, self.updated_at)
+
+    def __repr__(self):
+        return "FetchCursor<'{}', {}, {}>" \
+            .format(self.name, self.cursor, self.updated_at)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    # version : Version of an applied migration.
+    version = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    # applied_at : Datetime when the migration applied.
+    applied_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, version, applied_at=None):
+        self.version = version
+        self.applied_at = applied_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'version={}, applied_at={}'.format(self.version, self.applied_at)
+
+    def __repr__(self):
+        return 'SchemaVersion<{}, {}>'.format(self.version, self.applied_at)
+
+
+class NicoLoginSession(Base):
+    __tablename__ = 'nico_login_session'
+
+    # user_id : Mail address of the niconico account.
+    user_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    # cookies : Cookies of the logged in session in JSON.
+    cookies = sqlalchemy.Column(sqlalchemy.Text)
+
+    # expires_at : Datetime when the session expires.
+    expires_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    # updated_at : Datetime when the session saved.
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, user_id, cookies, expires_at, updated_at=None):
+        self.user_id = user_id
+        self.cookies = cookies
+        self.expires_at = expires_at
+        self.updated_at = updated_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'user_id={}, expires_at={}, updated_at={}' \
+            .format(self.user_id, self.expires_at, self.updated_at)
+
+    def __repr__(self):
+        return "NicoLoginSession<'{}', {}, {}>" \
+            .format(self.user_id, self.expires_at, self.updated_at)
+
+
+class NicoCommentInfo(Base):
+    __tablename__ = 'nico_comment_info'
+
+    # video_id : Video ID. (e.g. 'sm12345')
+    video_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    # message_server_url : URL of the message server of the video.
+    message_server_url = sqlalchemy.Column(sqlalchemy.String)
+
+    # thread_id : Comment thread ID of the video.
+    thread_id = sqlalchemy.Column(sqlalchemy.String)
+
+    # user_id : User ID to fetch the comments.
+    user_id = sqlalchemy.Column(sqlalchemy.String)
+
+    # fetched_at : Datetime when the info fetched by getflv.
+    fetched_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, video_id, message_server_url, thread_id, user_id,
+                 fetched_at=None):
+        self.video_id = video_id
+        self.message_server_url = message_server_url
+        self.thread_id = thread_id
+        self.user_id = user_id
+        self.fetched_at = fetched_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'video_id={}, message_server_url={}, thread_id={}, fetched_at={}' \
+            .format(self.video_id, self.message_server_url, self.thread_id,
+                    self.fetched_at)
+
+    def __repr__(self):
+        return "NicoCommentInfo<'{}', '{}', '{}', {}>" \
+            .format(self.video_id, self.message_server_url, self.thread_id,
+                    self.fetched_at)
+
+
+class NicoThreadWatermark(Base):
+    __tablename__ = 'nico_thread_watermark'
+
+    # scope : Consumer of the comments. (e.g. search keyword)
+    scope = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
+
+    # thread_id : Comment thread ID.
+    thread_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    # last_no : The last comment number seen in the thread.
+    last_no = sqlalchemy.Column(sqlalchemy.Integer)
+
+    # last_date : Datetime when the last comment posted.
+    last_date = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    # updated_at : Datetime when the watermark saved.
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, scope, thread_id, last_no, last_date, updated_at=None):
+        self.scope = scope
+        self.thread_id = thread_id
+        self.last_no = last_no
+        self.last_date = last_date
+        self.updated_at = updated_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'thread_id={}, last_no={}, last_date={}, updated_at={}' \
+            .format(self.thread_id, self.last_no, self.last_date,
+                    self.updated_at)
+
+    def __repr__(self):
+        return "NicoThreadWatermark<'{}', {}, {}, {}>" \
+            .format(self.thread_id, self.last_no, self.last_date,
+                    self.updated_at)
+
+
+class YoutubeWatermark(Base):
+    __tablename__ = 'youtube_watermark'
+
+    # keyword : Search keyword.
+    keyword = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
+
+    # published_at : Datetime when the newest video found was published.
+    published_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    # updated_at : Datetime when the watermark saved.
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, keyword, published_at, updated_at=None):
+        self.keyword = keyword
+        self.published_at = published_at
+        self.updated_at = updated_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'keyword={}, published_at={}, updated_at={}' \
+            .format(self.keyword, self.published_at, self.updated_at)
+
+    def __repr__(self):
+        return "YoutubeWatermark<'{}', {}, {}>" \
+            .format(self.keyword, self.published_at, self.updated_at)
+
+
+class YoutubeWatermarkVideo(Base):
+    __tablename__ = 'youtube_watermark_video'
+
+    # keyword : Search keyword.
+    keyword = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
+
+    # video_id : YouTube video ID published at the watermark of keyword.
+    video_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    def __init__(self, keyword, video_id):
+        self.keyword = keyword
+        self.video_id = video_id
+
+    def __str__(self):
+        return 'keyword={}, video_id={}'.format(self.keyword, self.video_id)
+
+    def __repr__(self):
+        return "YoutubeWatermarkVideo<'{}', '{}'>" \
+            .format(self.keyword, self.video_id)
+
+
+class OutboxMessage(Base):
+    __tablename__ = 'tweet_outbox'
+    __table_args__ = (
+        sqlalchemy.Index('ix_tweet_outbox_status_id', 'status', 'id'),
+    )
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    # dedup_key : Key to avoid posting the same message twice.
+    dedup_key = sqlalchemy.Column(sqlalchemy.String, unique=True)
+
+    # message : Tweet message.
+    message = sqlalchemy.Column(sqlalchemy.Unicode)
+
+    # Status
+    #   -1: failed (gave up)
+    #   0 : pending
+    #   1 : sent
+    status_failed = -1
+    status_pending = 0
+    status_sent = 1
+    status = sqlalchemy.Column(sqlalchemy.Integer)
+
+    # attempts : The number of failed attempts.
+    attempts = sqlalchemy.Column(sqlalchemy.Integer)
+
+    # last_error : Error of the last failed attempt.
+    last_error = sqlalchemy.Column(sqlalchemy.Unicode)
+
+    # created_at : Datetime when the message enqueued.
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    # sent_at : Datetime when the message sent.
+    sent_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __init__(self, dedup_key, message, created_at=None):
+        self.dedup_key = dedup_key
+        self.message = message
+        self.status = OutboxMessage.status_pending
+        self.attempts = 0
+        self.created_at = created_at or datetime.datetime.now()
+
+    def __str__(self):
+        return 'id={}, dedup_key={}, status={}, attempts={}' \
+            .format(self.id, self.dedup_key, self.status, self.attempts)
+
+    def __repr__(self):
+        return "OutboxMessage<{}, '{}', {}, {}>" \
+            .format(self.id, self.dedup_key, self.status, self.attempts)
@@ -3,198 +3,575 @@
 
 from __future__ import print_function
 import calendar
-import cookielib
 import datetime
+import heapq
+import itertools
 import json
 import logging
-import sqlalchemy
+import threading
 import traceback
 import time
 import urllib
-import urllib2
 
 import urlparse
-import xml.dom.minidom
+import xml.parsers.expat
+from multiprocessing.pool import ThreadPool
 
 import pprint
 
+import posted_videos
 from models import PostVideo
+from executor import BoundedExecutor
+from comment_info_cache import CommentInfoCache
+from http_session import HttpSession
+from login_cache import LoginCache
+from scheduler import (HostLimiter, HostCircuitBreaker, CircuitOpenError,
+                       RateLimitScheduler, backoff_sec)
+from thread_watermark import ThreadWatermarks
 
 logger = logging.getLogger(__name__)
 
 
+def _encode(value):
+    """Encode unicode to UTF-8 to use it in str.format()."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _parse_datetime(value):
+    """Parse 'YYYY-mm-dd HH:MM:SS' faster than strptime()."""
+    if len(value) == 19 and value[4] == '-' and value[10] == ' ':
+        return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                                 int(value[8:10]), int(value[11:13]),
+                                 int(value[14:16]), int(value[17:19]))
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
 class NicoVideo(object):
     VIDEO_URL = 'http://www.nicovideo.jp/watch/'
 
+    # Many videos are made per search, so do not give them a __dict__.
+    __slots__ = ('title', 'description_short', 'length', '_first_retrieve',
+                 'mylist_counter', 'view_counter', 'thumbnail_url', 'num_res',
+                 'id', 'max_comments', '_nico_comments', '_comment_seq')
+
     def __init__(self, title, description_short, length, first_retrieve,
-                 mylist_counter, view_counter, thumbnail_url, num_res, id):
+                 mylist_counter, view_counter, thumbnail_url, num_res, id,
+                 max_comments=None):
+        """
+        max_comments: Keep only the newest max_comments comments.
+                      (None: keep all)
+        """
         self.title = title
         self.description_short = description_short
         self.length = length
-        self.first_retrieve = datetime.datetime.strptime(first_retrieve,
-                                                         '%Y-%m-%d %H:%M:%S')
+        # Parsed on the first access.
+        self._first_retrieve = first_retrieve
         self.mylist_counter = int(mylist_counter)
         self.view_counter = int(view_counter)
         self.thumbnail_url = thumbnail_url
         self.num_res = int(num_res)
         self.id = id
 
-        self.nico_comments = []
+        self.max_comments = max_comments
+        # A list of comments, or a heap of (post_datetime, seq, comment)
+        # when max_comments is set.
+        self._nico_comments = []
+        self._comment_seq = 0
 
     def __str__(self):
-        return 'title={}, id={}, nico_comments={}'.format(self.title, self.id,
-                                                          self.nico_comments)
+        return 'title={}, id={}, nico_comments={}' \
+            .format(_encode(self.title), self.id, self.nico_comments)
 
     def __repr__(self):
-        return 'NicoVideo<{}, {}, {}>'.format(self.title, self.id,
-                                              self.nico_comments)
+        return 'NicoVideo<{}, {}, {}>' \
+            .format(_encode(self.title), self.id, self.nico_comments)
+
+    @property
+    def first_retrieve(self):
+        if not isinstance(self._first_retrieve, datetime.datetime):
+            self._first_retrieve = _parse_datetime(self._first_retrieve)
+        return self._first_retrieve
+
+    @first_retrieve.setter
+    def first_retrieve(self, value):
+        self._first_retrieve = value
+
+    @property
+    def nico_comments(self):
+        if self.max_comments is None:
+            return self._nico_comments
+        return [entry[2] for entry in sorted(self._nico_comments)]
+
+    @nico_comments.setter
+    def nico_comments(self, nico_comments):
+        if self.max_comments is None:
+            self._nico_comments = nico_comments
+            return
+        self._nico_comments = []
+        for nico_comment in nico_comments:
+            self.append_nico_comment(nico_comment)
 
     def get_url(self):
         return NicoVideo.VIDEO_URL + self.id
 
     def append_nico_comment(self, nico_comment):
-        self.nico_comments.append(nico_comment)
+        if self.max_comments is None:
+            self._nico_comments.append(nico_comment)
+            return
+        # Later comments win ties, as a stable sort does.
+        entry = (nico_comment.post_datetime, self._comment_seq, nico_comment)
+        self._comment_seq += 1
+        if len(self._nico_comments) < self.max_comments:
+            heapq.heappush(self._nico_comments, entry)
+        elif self._nico_comments and entry > self._nico_comments[0]:
+            heapq.heapreplace(self._nico_comments, entry)
 
     def get_latest_comments(self, num):
-        sorted_ncs = sorted(self.nico_comments, key=lambda x: x.post_datetime)
-        return sorted_ncs[-num:]
+        """Return the newest num comments in posted order."""
+        if self.max_comments is not None:
+            return self.nico_comments[-num:]
+        if num <= 0:
+            return sorted(self._nico_comments, key=lambda x: x.post_datetime)
+        latest = heapq.nlargest(num, enumerate(self._nico_comments),
+                                key=lambda item: (item[1].post_datetime,
+                                                  item[0]))
+        return [nico_comment for _, nico_comment in reversed(latest)]
 
 
 class NicoComment(object):
-    def __init__(self, comment, vpos, post_datetime):
+    __slots__ = ('comment', 'vpos', 'post_datetime', 'no')
+
+    def __init__(self, comment, vpos, post_datetime, no=None):
         self.comment = comment
+        # Play time posted a comment in 1/100 sec.
         self.vpos = vpos
         self.post_datetime = post_datetime
+        # Comment number in the thread.
+        self.no = no
 
     def __str__(self):
         return ('comment={}, ' +
                 'vpos={}, ' +
                 'post_datetime={}') \
-            .format(self.comment, self.vpos, self.post_datetime)
+            .format(_encode(self.comment), self.vpos, self.post_datetime)
 
     def __repr__(self):
         return ('NicoComment<{}, {}, {}>') \
-            .format(self.comment, self.vpos, self.post_datetime)
+            .format(_encode(self.comment), self.vpos, self.post_datetime)
+
+    def format_vpos(self):
+        """Return the play time as 'MM:SS'."""
+        sec = int(self.vpos) // 100
+        return '{:>02d}:{:>02d}'.format(sec // 60, sec % 60)
+
+
+class NicoCommentParser(object):
+    """Incremental parser of a message server response.
+
+    The response is fed to expat piece by piece, and <chat> elements older
+    than from_datetime are dropped while parsing, so neither the whole
+    response nor a DOM is kept in memory.
+    """
+    READ_SIZE = 16 * 1024
+
+    def __init__(self, from_datetime=None):
+        self.from_datetime = from_datetime or datetime.datetime.fromtimestamp(0)
+        self.from_timestamp = time.mktime(self.from_datetime.timetuple()) \
+            + self.from_datetime.microsecond / 1000000.0
+
+        # Attributes of the <thread> element.
+        self.thread_attrs = {}
+        self.nico_comments = []
+        # The newest comment in the response, including dropped ones.
+        self.last_no = None
+        self.last_date = None
+
+        self._chat_attrs = None
+        self._texts = []
+
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+
+    def _start_element(self, name, attrs):
+        if name == 'chat':
+            no = attrs.get('no')
+            if no is not None and (self.last_no is None
+                                   or int(no) > self.last_no):
+                self.last_no = int(no)
+                self.last_date = datetime.datetime.fromtimestamp(
+                    int(attrs.get('date', 0)))
+
+            # Drop old comments.
+            date = attrs.get('date')
+            if date is None or int(date) < self.from_timestamp:
+                return
+            self._chat_attrs = attrs
+            self._texts = []
+        elif name == 'thread':
+            self.thread_attrs = attrs
+
+    def _character_data(self, data):
+        if self._chat_attrs is not None:
+            self._texts.append(data)
+
+    def _end_element(self, name):
+        if name != 'chat' or self._chat_attrs is None:
+            return
+        attrs = self._chat_attrs
+        self._chat_attrs = None
+
+        # Get a comment text.
+        comment = u''.join(self._texts)
+        if not comment:
+            return
+
+        # Get datetime posted a comment.
+        post_datetime = datetime.datetime.fromtimestamp(int(attrs['date']))
+
+        # Get play time posted a comment.
+        vpos = int(attrs.get('vpos', 0))
+
+        no = int(attrs['no']) if 'no' in attrs else None
+
+        self.nico_comments.append(NicoComment(comment, vpos, post_datetime, no))
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse('', True)
+
+    def parse(self, stream):
+        """Parse a file-like stream and return NicoComment list."""
+        while True:
+            data = stream.read(NicoCommentParser.READ_SIZE)
+            if not data:
+                break
+            self.feed(data)
+        self.close()
+        return self.nico_comments
+
+
+class NicoLoginRequiredError(Exception):
+    """Raised when niconico asks to log in again."""
+
+
+class _HostSlotResponse(object):
+    """Response which holds the slot of its host until the body is read.
+
+    The slot is released and the result is recorded on the circuit breaker
+    when the body is read to the end, reading it fails, or it is closed.
+    """
+
+    def __init__(self, response, url, host_limiter, circuit_breaker):
+        self._response = response
+        self._url = url
+        self._host_limiter = host_limiter
+        self._circuit_breaker = circuit_breaker
+        self._is_released = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except Exception as e:
+            self._release(e)
+            raise
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._release()
+
+    def _release(self, error=None):
+        if self._is_released:
+            return
+        self._is_released = True
+        self._host_limiter.release(self._url)
+        self._circuit_breaker.record(self._url, error)
 
 
 class NicoSearch(object):
     LOGIN_URL = 'https://secure.nicovideo.jp/secure/login'
     SEARCH_URL = 'http://www.nicovideo.jp/api/search/search/'
     GETFLV_URL = 'http://flapi.nicovideo.jp/api/getflv/'
+    LOGIN_REQUIRED_MESSAGE = u'ログインしてください'
 
     POST_XML = '<packet>' + \
         '<thread thread="{thread_id}" version="20090904" user_id="{user_id}"/>' + \
         '<thread_leaves thread="{thread_id}" user_id="{user_id}">0-99:10,1000</thread_leaves>' + \
         '</packet>'
+    # Request comments from the comment number res_from.
+    POST_XML_FROM = '<packet>' + \
+        '<thread thread="{thread_id}" version="20090904" user_id="{user_id}"' + \
+        ' res_from="{res_from}"/>' + \
+        '</packet>'
+
+    # Fetch functions whose results are memoized within a run.
+    MEMO_FUNCS = ['_fetch_videos', '_fetch_comment_info']
+
+    # Rate limit family of each fetch function.
+    FETCH_FAMILIES = {'_fetch_videos': 'nico/search',
+                      '_fetch_comment_info': 'nico/getflv',
+                      '_fetch_comments': 'nico/msg'}
 
     def __init__(self, db_manager, user_id, pass_word, fetch_sleep_sec=1, max_retry_count=3,
-                 retry_sleep_sec=15, max_fetch_fail_count=2):
+                 retry_sleep_sec=15, max_fetch_fail_count=2, scheduler=None,
+                 max_retry_sleep_sec=120, circuit_breaker=None,
+                 max_workers=4, max_connections_per_host=2,
+                 comment_info_ttl_sec=24 * 60 * 60, fetch_memo=None):
         self.db_manager = db_manager
         self.user_id = user_id
         self.pass_word = pass_word
         self.fetch_sleep_sec = fetch_sleep_sec
         self.max_retry_count = max_retry_count
         self.retry_sleep_sec = retry_sleep_sec
+        self.max_retry_sleep_sec = max_retry_sleep_sec
         self.max_fetch_fail_count = max_fetch_fail_count
 
-        self.fetch_fail_count = 0
+        # Pace fetching so that it does not run continuously at short times.
+        self.scheduler = scheduler or RateLimitScheduler(
+            limits=RateLimitScheduler.nico_limits(fetch_sleep_sec))
 
-    def login(self):
-        opener = urllib2 \
-            .build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
-        urllib2.install_opener(opener)
-        urllib2.urlopen(NicoSearch.LOGIN_URL,
-                        urllib.urlencode({'mail': self.user_id,
-                                          'password': self.pass_word}))
-        return opener
+        # Fetch comments of max_workers videos at once, but do not open
+        # more than max_connections_per_host connections to a host.
+        self.max_workers = max_workers
+        self.host_limiter = HostLimiter(max_connections_per_host)
 
-    def search_videos(self, keyword, from_datetime=None, sort='f', order='d',
-                      page=1, max_count=1, current_count=1, results=None):
-        results = results or []
-        # Limit the number of fetching.
-        if current_count > max_count:
-            return results
-        from_datetime = from_datetime or datetime.datetime.fromtimestamp(0)
+        # Fail fast while a host is down instead of sleeping through retries.
+        self.circuit_breaker = circuit_breaker or HostCircuitBreaker()
 
-        # Fetch videos from NicoNico.
-        json_videos = self._fetch(self._fetch_videos, keyword, sort, order, page)
-        for json_video in json_videos:
-            video = NicoVideo(**json_video)
-            if video.first_retrieve < from_datetime:
-                continue
-            results.append(video)
+        self.fetch_fail_count = 0
+        self._fetch_fail_count_lock = threading.Lock()
+
+        # Cookies and keep-alive connections of this instance.
+        self.session = HttpSession()
+
+        # The session of db_manager is used by one thread at a time.
+        # Take it before _login_lock, as login() does.
+        self.db_lock = threading.RLock()
+
+        # Reuse the logged in cookies saved by the previous jobs.
+        self.login_cache = LoginCache(db_manager) if db_manager else None
+        self.login_count = 0
+        self._login_lock = threading.RLock()
+
+        # getflv results rarely change, so reuse them for comment_info_ttl_sec.
+        self.comment_info_cache = CommentInfoCache(db_manager, comment_info_ttl_sec) \
+            if db_manager else None
+
+        # Results of search and getflv shared by the instances of a run.
+        self.fetch_memo = fetch_memo
+
+        # Request only comments newer than the last fetch per thread.
+        self.thread_watermarks = ThreadWatermarks(db_manager) \
+            if db_manager else None
+
+    def login(self, force=False):
+        """Log in unless a cached session is alive. (force: always log in)"""
+        with self.db_lock, self._login_lock:
+            cookie_jar = self.session.cookie_jar
+            if not force and self.login_cache \
+                    and self.login_cache.load(self.user_id, cookie_jar):
+                return self.session
+
+            logger.info('Login to NicoNico: user_id={}'.format(self.user_id))
+            cookie_jar.clear()
+            self._urlopen(self.LOGIN_URL,
+                          urllib.urlencode({'mail': self.user_id,
+                                            'password': self.pass_word})).read()
+            self.login_count += 1
+            if self.login_cache:
+                self.login_cache.save(self.user_id, cookie_jar)
+        return self.session
+
+    def _relogin(self, login_count):
+        """Log in again unless another thread did since login_count."""
+        with self.db_lock, self._login_lock:
+            if self.login_count != login_count:
+                return
+            self.login(force=True)
 
-        current_count += 1
-        page += 1
-        return self.search_videos(keyword, from_datetime, sort, order, page,
-                                  max_count, current_count, results)
+    def search_videos(self, keyword, from_datetime=None, sort='f', order='d',
+                      page=1, max_count=1):
+        """Search videos of up to max_count pages as a list."""
+        return list(self.iter_videos(keyword, from_datetime, sort, order, page,
+                                     max_count))
+
+    def iter_videos(self, keyword, from_datetime=None, sort='f', order='d',
+                    page=1, max_count=None, prefetch=False):
+        """Yield videos first_retrieved since from_datetime page by page.
+
+        Results sorted by first_retrieve in descending order (sort='f',
+        order='d') stop at the first older video, so stale pages are not
+        fetched; otherwise older videos are skipped. max_count limits the
+        number of pages (None: until an empty page). With prefetch=True,
+        the next page is fetched while the current one is processed.
+        """
+        from_datetime = from_datetime or datetime.datetime.fromtimestamp(0)
+        is_sorted_by_date = sort == 'f' and order == 'd'
+
+        pool = ThreadPool(1) if prefetch else None
+        try:
+            next_page = None
+            count = 0
+            while max_count is None or count < max_count:
+                # Fetch videos from NicoNico.
+                if next_page is not None:
+                    json_videos = next_page.get()
+                else:
+                    json_videos = self._fetch(self._fetch_videos, keyword,
+                                              sort, order, page)
+                next_page = None
+                count += 1
+                page += 1
+                if not json_videos:
+                    return
+                videos = [NicoVideo(**json_video) for json_video in json_videos]
+
+                is_last = is_sorted_by_date \
+                    and videos[-1].first_retrieve < from_datetime
+                if pool and not is_last \
+                        and (max_count is None or count < max_count):
+                    next_page = pool.apply_async(
+                        self._fetch, (self._fetch_videos, keyword, sort, order,
+                                      page))
+
+                for video in videos:
+                    if video.first_retrieve < from_datetime:
+                        if is_sorted_by_date:
+                            return
+                        continue
+                    yield video
+        finally:
+            if pool:
+                pool.terminate()
 
     def search_videos_with_comments(self, keyword, from_datetime=None,
-                                    max_comment_num=1500):
+                                    max_comment_num=1500,
+                                    max_comments_per_video=None,
+                                    seen_video_ids=None):
+        """Search videos with comments posted since from_datetime.
+
+        Comments of up to max_workers videos are fetched at once, and
+        results are returned in search order. Each video keeps only its
+        newest max_comments_per_video comments. (None: all)
+
+        seen_video_ids: A set of video ids whose comments are already
+                        fetched by another keyword. The videos are skipped,
+                        and the ones fetched here are added to it.
+        """
         results = []
         from_datetime = from_datetime or datetime.datetime.fromtimestamp(0)
 
         # Search videos with latest comments by NicoNico.
         videos = self.search_videos(keyword, sort='n')
 
-        for video in videos:
-            # Exclude too many commnets videos.
-            if not (0 < video.num_res <= max_comment_num):
-                continue
-            # Fetch comments from NicoNico.
-            try:
-                result = self._fetch(self._fetch_comments, video)
-            except:
-                if self.fetch_fail_count > self.max_fetch_fail_count:
-                    raise Exception("Fetch fail count over({})\n\n{}"
-                                    .format(self.fetch_fail_count,
-                                            traceback.format_exc()))
-                logger.exception('_fetch_comments() failed but continue')
-                sleep_sec = self.retry_sleep_sec * self.max_retry_count * 2
-                logger.info('Sleep {}sec... (_fetch_comments() failed)'
-                            .format(sleep_sec))
-                time.sleep(sleep_sec)
-                continue
-
-            if not result:
-                continue
-            dom = xml.dom.minidom.parseString(result.read())
-
-            chats = dom.getElementsByTagName('chat')
-            for chat in chats:
-                # Get datetime posted a comment.
-                post_datetime = chat.getAttribute('date')
-                post_datetime = datetime.datetime.fromtimestamp(int(post_datetime))
-                if post_datetime < from_datetime:
-                    continue
+        # Exclude too many commnets videos.
+        videos = [video for video in videos
+                  if 0 < video.num_res <= max_comment_num]
+        if seen_video_ids is not None:
+            videos = [video for video in videos
+                      if video.id not in seen_video_ids]
+            seen_video_ids.update(video.id for video in videos)
 
-                # Get play time posted a comment.
-                vpos = int(chat.getAttribute('vpos'))
-                vpos = '{:>02d}:{:>02d}'.format((vpos / 100 / 60),
-                                                (vpos / 100 % 60))
-
-                # Get a comment text.
-                try:
-                    chat_node = chat.childNodes[0]
-                except IndexError:
+        def fetch_comments(video):
+            """Return (True, NicoComment list or None) or (False, traceback)."""
+            try:
+                # Fetch comments from NicoNico.
+                return True, self._fetch_nico_comments(video, from_datetime,
+                                                       keyword)
+            except Exception:
+                return False, traceback.format_exc()
+
+        with self.db_lock:
+            if self.comment_info_cache:
+                self.comment_info_cache.preload([video.id for video in videos])
+            if self.thread_watermarks:
+                self.thread_watermarks.preload(keyword)
+
+        with BoundedExecutor(self.max_workers) as executor:
+            # fetch_comments() never raises, so the executor always succeeds.
+            fetched = executor.imap(fetch_comments, videos)
+            for video, (_, (is_success, value)) in itertools.izip(videos, fetched):
+                if not is_success:
+                    if self.fetch_fail_count > self.max_fetch_fail_count:
+                        raise Exception("Fetch fail count over({})\n\n{}"
+                                        .format(self.fetch_fail_count, value))
+                    # _fetch() has already backed off, so go on to the next.
+                    logger.error('_fetch_comments() failed but continue\n{}'
+                                 .format(value))
                     continue
 
-                if not chat_node.nodeType == chat_node.TEXT_NODE:
+                if not value:
                     continue
-                comment = chat_node.data
+                video.max_comments = max_comments_per_video
+                for nico_comment in value:
+                    video.append_nico_comment(nico_comment)
 
-                nico_comment = NicoComment(comment, vpos, post_datetime)
-                video.append_nico_comment(nico_comment)
+                if video.nico_comments:
+                    results.append(video)
 
-            if video.nico_comments:
-                results.append(video)
+        with self.db_lock:
+            if self.comment_info_cache:
+                self.comment_info_cache.save()
+            if self.thread_watermarks:
+                self.thread_watermarks.save()
 
         return results
 
+    def _fetch_nico_comments(self, video, from_datetime, scope=None):
+        """Fetch and parse comments of video posted since from_datetime.
+
+        When the message server rejects cached comment info, it is fetched
+        by getflv again. When scope is specified, only comments newer than
+        the last fetch of the scope are fetched.
+        """
+        while True:
+            result = self._fetch(self._fetch_comments, video, scope)
+            if not result:
+                return None
+            parser = NicoCommentParser(from_datetime)
+            try:
+                nico_comments = parser.parse(result)
+            finally:
+                result.close()
+            resultcode = parser.thread_attrs.get('resultcode', '0')
+            if resultcode == '0':
+                thread_id = parser.thread_attrs.get('thread')
+                if scope is not None and self.thread_watermarks \
+                        and thread_id and parser.last_no is not None:
+                    self.thread_watermarks.update(scope, thread_id,
+                                                  parser.last_no,
+                                                  parser.last_date)
+                return nico_comments
+            logger.warning('Message server rejected: video_id={}, resultcode={}'
+                           .format(video.id, resultcode))
+            if not self._invalidate_comment_info(video.id):
+                return nico_comments
+
     def search_latest_commenting_videos(self, keyword, from_datetime=None,
                                         number_of_results=3, expire_days=30,
                                         max_post_count=1, max_count=5,
-                                        current_count=1, results=None):
+                                        current_count=1, results=None,
+                                        seen_video_ids=None):
+        """Yield up to number_of_results commented videos to post.
+
+        seen_video_ids: A set of video ids already posted by another
+                        keyword. The videos are skipped, and the ones
+                        yielded here are added to it.
+        """
         results = results or []
 
         if current_count > max_count:
@@ -205,11 +582,13 @@ class NicoSearch(object):
 
         # Search latest commenting videos.
         videos = self.search_videos(keyword, sort='n', page=current_count)
+        # Check if the videos of the page are already posted at once.
+        post_videos = posted_videos.find_post_videos(
+            self.db_manager, [video.id for video in videos])
         for video in videos:
-            # Check if the video is already posted.
-            old_post_video = self.db_manager.db_session.query(PostVideo) \
-                .filter(sqlalchemy
-                        .and_(PostVideo.video_id == video.id)).first()
+            if seen_video_ids is not None and video.id in seen_video_ids:
+                continue
+            old_post_video = post_videos.get(video.id)
 
             if old_post_video:
                 now_date = datetime.datetime.now()
@@ -233,8 +612,11 @@ class NicoSearch(object):
                 # Add new post_video to database when not registerd
                 post_video = PostVideo(video.id)
                 logger.info('Add new post_video to database : post_video={}'.format(post_video))
-                self.db_manager.db_session.add(post_video)
+                posted_videos.add_post_video(self.db_manager, post_video)
+                post_videos[video.id] = post_video
 
+            if seen_video_ids is not None:
+                seen_video_ids.add(video.id)
             results.append(video)
             yield video
             if len(results) >= number_of_results:
@@ -245,38 +627,95 @@ class NicoSearch(object):
                                                   number_of_results,
                                                   expire_days, max_post_count,
                                                   max_count, current_count,
-                                                  results)
+                                                  results, seen_video_ids)
         for result in it:
             yield result
 
     def _fetch(self, func, *args, **kwargs):
         """Run func(*args, **kwargs) with retry."""
+        memo_key = None
+        if self.fetch_memo is not None and func.__name__ in NicoSearch.MEMO_FUNCS:
+            memo_key = _make_memo_key(func.__name__, args, kwargs)
+            is_memoized, result = self.fetch_memo.get(memo_key)
+            if is_memoized:
+                logger.debug('Memoized: {}({}, {})'
+                             .format(func.__name__, args, kwargs))
+                return result
+
         logger.debug('Fetch from NicoNico: {}({}, {})'
                      .format(func.__name__, args, kwargs))
 
         remaining_retry_count = self.max_retry_count
+        is_relogged_in = False
         while(remaining_retry_count >= 0):
             try:
                 retry_count = self.max_retry_count - remaining_retry_count
                 if retry_count > 0:
-                    sleep_sec = self.retry_sleep_sec * retry_count
-                    logger.info('Sleep {}sec... Retry {}: {}({}, {})'
+                    sleep_sec = backoff_sec(retry_count, self.retry_sleep_sec,
+                                            self.max_retry_sleep_sec)
+                    logger.info('Sleep {:.2f}sec... Retry {}: {}({}, {})'
                                 .format(sleep_sec, retry_count, func.__name__,
                                         args, kwargs))
                     time.sleep(sleep_sec)
                 # Run fetch function.
-                result = func(*args, **kwargs)
+                login_count = self.login_count
+                family = NicoSearch.FETCH_FAMILIES.get(func.__name__)
+                if family:
+                    result = self.scheduler.call(family, func, *args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
                 break
+            except NicoLoginRequiredError:
+                # The cached session has expired on the server.
+                if is_relogged_in:
+                    raise
+                logger.info('Login session expired. Login again.')
+                self._relogin(login_count)
+                is_relogged_in = True
+            except CircuitOpenError:
+                # Retrying a host known to be down only wastes time.
+                with self._fetch_fail_count_lock:
+                    self.fetch_fail_count += 1
+                raise
             except Exception:
                 if remaining_retry_count <= 0:
-                    self.fetch_fail_count += 1
+                    with self._fetch_fail_count_lock:
+                        self.fetch_fail_count += 1
                     raise
                 remaining_retry_count -= 1
 
-        # Sleep so that fetching continuously does not at short times.
-        time.sleep(self.fetch_sleep_sec)
+        if memo_key is not None and _is_memoizable(func.__name__, result):
+            self.fetch_memo.put(memo_key, result)
         return result
 
+    def _invalidate_comment_info(self, video_id):
+        """Forget comment info of video_id. Returns True if it was kept."""
+        is_invalidated = False
+        if self.comment_info_cache:
+            is_invalidated = self.comment_info_cache.invalidate(video_id)
+        if self.fetch_memo is not None:
+            memo_key = _make_memo_key('_fetch_comment_info', (video_id,), {})
+            is_invalidated = self.fetch_memo.discard(memo_key) or is_invalidated
+        return is_invalidated
+
+    def _urlopen(self, url, data=None, headers=None):
+        """Request url on the session within the connection limit of the host.
+
+        The slot of the host is held until the response is read to the end
+        or closed, so the caller must do either.
+        Raises CircuitOpenError while the host is down.
+        """
+        self.circuit_breaker.before(url)
+        self.host_limiter.acquire(url)
+        try:
+            response = self.session.open(url, data, headers)
+        except Exception as e:
+            self.host_limiter.release(url)
+            self.circuit_breaker.record(url, e)
+            raise
+        return _HostSlotResponse(response, url, self.host_limiter,
+                                 self.circuit_breaker)
+
     def _fetch_videos(self, keyword, sort='f', order='d', page=1):
         """Searching by keyward, fetch videos from NicoNico.
         sort:
@@ -287,7 +726,7 @@ class NicoSearch(object):
         """
         # Make url to search by keyword.
         keyword = urllib.quote(keyword.encode('utf-8'))
-        url = NicoSearch.SEARCH_URL + keyword
+        url = self.SEARCH_URL + keyword
         params = {}
         params['mode'] = 'watch'
         params['sort'] = sort
@@ -296,34 +735,58 @@ class NicoSearch(object):
         url += '?' + urllib.urlencode(params)
 
         # Get search result.
-        j = json.load(urllib2.urlopen(url), encoding='utf8')
+        j = json.load(self._urlopen(url), encoding='utf8')
 
         # Check result status.
         status = j['status']
+        if j.get('message') == NicoSearch.LOGIN_REQUIRED_MESSAGE:
+            raise NicoLoginRequiredError(j['message'])
         if not status == 'ok':
             raise Exception('Fetch videos failed\n' + json.dumps(j, indent=4,
                             ensure_ascii=False))
 
         return j['list']
 
-    def _fetch_comments(self, video):
-        """Fetch comments from NicoNico."""
-        message_server_url, post_xml = self._fetch(self._fetch_comment_info,
-                                                   video.id)
-        if not (message_server_url or post_xml):
+    def _fetch_comments(self, video, scope=None):
+        """Fetch comments from NicoNico.
+
+        When scope has a watermark of the thread, only newer comments are
+        requested.
+        """
+        comment_info = None
+        if self.comment_info_cache:
+            comment_info = self.comment_info_cache.get(video.id)
+        if comment_info is None:
+            comment_info = self._fetch(self._fetch_comment_info, video.id)
+            if comment_info[0] and self.comment_info_cache:
+                self.comment_info_cache.put(video.id, *comment_info)
+        message_server_url, thread_id, user_id = comment_info
+        if not message_server_url:
             return None
 
+        fields = {'user_id': user_id, 'thread_id': thread_id}
+        last_no = None
+        if scope is not None and self.thread_watermarks:
+            last_no = self.thread_watermarks.get(scope, thread_id)
+        if last_no is None:
+            post_xml = NicoSearch.POST_XML.format(**fields)
+        else:
+            post_xml = NicoSearch.POST_XML_FROM.format(res_from=last_no + 1,
+                                                       **fields)
         headers = {'Content-Type': 'text/xml',
                    'Content-Length': "{}".format(len(post_xml))}
-        request = urllib2.Request(url=message_server_url, data=post_xml,
-                                  headers=headers)
-        result = urllib2.urlopen(request)
+        try:
+            result = self._urlopen(message_server_url, post_xml, headers)
+        except Exception:
+            # The message server may have moved.
+            self._invalidate_comment_info(video.id)
+            raise
         return result
 
     def _fetch_comment_info(self, video_id):
-        """Fetch info to get comments."""
-        url = NicoSearch.GETFLV_URL + video_id
-        result = urllib2.urlopen(url).read()
+        """Fetch info to get comments. (message server URL, thread ID, user ID)"""
+        url = self.GETFLV_URL + video_id
+        result = self._urlopen(url).read()
         result = urlparse.parse_qs(result)
 
         # Chek result status.
@@ -335,12 +798,23 @@ class NicoSearch(object):
         if not 'ms' in result or len(result['ms']) < 1:
             logger.error('Could not get message server url: video_id={}, result={}'
                          .format(video_id, result))
-            return None, None
+            return None, None, None
         ms = result['ms'][0]
 
         thread_id = result['thread_id'][0]
         user_id = result['user_id'][0]
-        fields = {'user_id': user_id, 'thread_id': thread_id}
-        post_xml = NicoSearch.POST_XML.format(**fields)
 
-        return ms, post_xml
+        return ms, thread_id, user_id
+
+
+def _make_memo_key(func_name, args, kwargs):
+    return (func_name,) + tuple(args) + tuple(sorted(kwargs.items()))
+
+
+def _is_memoizable(func_name, result):
+    """Return False for a result which may be a transient failure."""
+    if func_name == '_fetch_comment_info':
+        # No message server URL, which is not cached in CommentInfoCache
+        # either.
+        return bool(result[0])
+    return True
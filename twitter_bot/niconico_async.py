@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncNicoSearch(object):
+    """Non-blocking client of NicoSearch.
+
+    Every operation is started on a shared thread pool at once and returns
+    an AsyncResult (ready(), successful(), get(timeout)), so one caller can
+    track dozens of keywords concurrently. Fetching goes through
+    NicoSearch._fetch(), so the retry policy and the rate-limit scheduler
+    are the same as NicoSearch.
+
+    Operations touching the database of nico_search are serialized by
+    nico_search.db_lock, because a database session must not be used by
+    threads at once.
+    """
+
+    def __init__(self, nico_search, max_workers=8):
+        self.nico_search = nico_search
+        self.max_workers = max_workers
+        self._pool = ThreadPool(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._pool.terminate()
+        else:
+            self.close()
+        return False
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def _apply(self, func, *args, **kwargs):
+        return self._pool.apply_async(func, args, kwargs)
+
+    def login(self):
+        return self._apply(self.nico_search.login)
+
+    def search_videos(self, keyword, from_datetime=None, sort='f', order='d',
+                      page=1, max_count=1):
+        return self._apply(self.nico_search.search_videos, keyword,
+                           from_datetime, sort, order, page, max_count)
+
+    def fetch_comment_info(self, video_id):
+        return self._apply(self.nico_search._fetch,
+                           self.nico_search._fetch_comment_info, video_id)
+
+    def fetch_comments(self, video):
+        return self._apply(self.nico_search._fetch,
+                           self.nico_search._fetch_comments, video)
+
+    def search_videos_with_comments(self, keyword, from_datetime=None,
+                                    max_comment_num=1500,
+                                    max_comments_per_video=None):
+        return self._apply(self.nico_search.search_videos_with_comments,
+                           keyword, from_datetime, max_comment_num,
+                           max_comments_per_video)
+
+    def search_latest_commenting_videos(self, keyword, from_datetime=None,
+                                        number_of_results=3, expire_days=30,
+                                        max_post_count=1):
+        def search():
+            with self.nico_search.db_lock:
+                return list(self.nico_search.search_latest_commenting_videos(
+                    keyword, from_datetime, number_of_results, expire_days,
+                    max_post_count))
+        return self._apply(search)
+
+    def track_keywords(self, keywords, from_datetime=None,
+                       max_comment_num=1500):
+        """Start search_videos_with_comments() of keywords at once.
+
+        Returns {keyword: AsyncResult}.
+        """
+        return dict((keyword,
+                     self.search_videos_with_comments(keyword, from_datetime,
+                                                      max_comment_num))
+                    for keyword in keywords)
+
+
+def gather(async_results, timeout=None):
+    """Wait for {key: AsyncResult} and return ({key: result},
+    {key: Exception})."""
+    results = {}
+    errors = {}
+    for key, async_result in async_results.items():
+        try:
+            results[key] = async_result.get(timeout)
+        except Exception as e:
+            logger.exception('Async operation failed: key={}'.format(key))
+            errors[key] = e
+    return results, errors
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import datetime
+import logging
+import traceback
+
+from models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """Tweet messages waiting to be posted, stored in database.
+
+    Producers enqueue() messages and commit them together with their own
+    changes. dispatch() posts pending messages in order.
+    """
+
+    def __init__(self, db_session, max_attempts=3):
+        self.db_session = db_session
+        self.max_attempts = max_attempts
+
+    def enqueue(self, msg, dedup_key):
+        """Add msg unless a message with the same dedup_key exists.
+
+        Returns True when msg is added.
+        """
+        old_message = self.db_session.query(OutboxMessage) \
+            .filter(OutboxMessage.dedup_key == dedup_key).first()
+        if old_message:
+            logger.debug('Skip enqueued message : {}'.format(old_message))
+            return False
+        message = OutboxMessage(dedup_key, msg)
+        self.db_session.add(message)
+        logger.debug('Enqueue message : dedup_key={}'.format(dedup_key))
+        return True
+
+    def pending(self, limit=None):
+        query = self.db_session.query(OutboxMessage) \
+            .filter(OutboxMessage.status == OutboxMessage.status_pending) \
+            .order_by(OutboxMessage.id)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+
+    def dispatch(self, post_func, limit=None):
+        """Post pending messages by post_func(msg).
+
+        Each result is committed right after posting, so a message is not
+        posted twice across runs. A failed message is retried on the next
+        dispatch until it fails max_attempts times.
+
+        Returns (the number of sent messages, [(Exception, msg), ]).
+        """
+        sent_count = 0
+        failed_list = []
+        for message in self.pending(limit):
+            try:
+                post_func(message.message)
+            except Exception as e:
+                logger.exception('Post failed : {}'.format(message))
+                message.attempts += 1
+                message.last_error = traceback.format_exc().decode('utf-8', 'replace')
+                if message.attempts >= self.max_attempts:
+                    message.status = OutboxMessage.status_failed
+                failed_list.append((e, message.message))
+            else:
+                message.status = OutboxMessage.status_sent
+                message.sent_at = datetime.datetime.now()
+                sent_count += 1
+            self.db_session.commit()
+        return sent_count, failed_list
+
+    def prune(self, days):
+        """Delete messages sent more than days ago."""
+        border = datetime.datetime.now() - datetime.timedelta(days)
+        count = self.db_session.query(OutboxMessage) \
+            .filter(OutboxMessage.status == OutboxMessage.status_sent,
+                    OutboxMessage.sent_at < border) \
+            .delete(synchronize_session=False)
+        logger.debug('Pruned outbox messages : {}'.format(count))
+        return count
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import logging
+import threading
+
+from follow_graph import chunks, IN_CHUNK_SIZE
+from models import PostVideo
+
+logger = logging.getLogger(__name__)
+
+# Process registry: {db_name: PostedVideoIds}
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class PostedVideoIds(object):
+    """Ids of posted videos, loaded from post_video once per process.
+
+    A video not in the set has never been posted, so it needs no query.
+    A video in the set may have been deleted from post_video (or added by
+    a rolled back job), so the database is still asked for it.
+    """
+
+    def __init__(self, video_ids=None):
+        self._video_ids = set(video_ids or [])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._video_ids)
+
+    def __contains__(self, video_id):
+        return video_id in self._video_ids
+
+    @classmethod
+    def load(cls, db_session):
+        video_ids = [video_id for video_id,
+                     in db_session.query(PostVideo.video_id)]
+        logger.debug('Load posted video ids : {}'.format(len(video_ids)))
+        return cls(video_ids)
+
+    def add(self, video_id):
+        with self._lock:
+            self._video_ids.add(video_id)
+
+
+def get_posted_video_ids(db_manager):
+    """Return PostedVideoIds of the database of db_manager."""
+    with _registry_lock:
+        posted_video_ids = _registry.get(db_manager.db_name)
+        if posted_video_ids is None:
+            posted_video_ids = PostedVideoIds.load(db_manager.db_session)
+            _registry[db_manager.db_name] = posted_video_ids
+        return posted_video_ids
+
+
+def forget_posted_video_ids():
+    """Reload the ids from the databases on the next use."""
+    with _registry_lock:
+        _registry.clear()
+
+
+def find_post_videos(db_manager, video_ids):
+    """Return {video_id: PostVideo} of posted videos in video_ids.
+
+    Videos never posted are filtered out in memory, and the rest are
+    looked up by IN queries of up to IN_CHUNK_SIZE ids.
+    """
+    posted_video_ids = get_posted_video_ids(db_manager)
+    candidates = set(video_id for video_id in video_ids
+                     if video_id in posted_video_ids)
+    post_videos = {}
+    for chunk in chunks(sorted(candidates), IN_CHUNK_SIZE):
+        for post_video in db_manager.db_session.query(PostVideo) \
+                .filter(PostVideo.video_id.in_(chunk)):
+            post_videos[post_video.video_id] = post_video
+    return post_videos
+
+
+def add_post_video(db_manager, post_video):
+    """Add post_video to the session and to the posted video ids."""
+    db_manager.db_session.add(post_video)
+    get_posted_video_ids(db_manager).add(post_video.video_id)
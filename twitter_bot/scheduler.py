@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import contextlib
+import logging
+import random
+import threading
+import time
+import urllib2
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Rate limit budget of an endpoint family.
+
+    limit tokens are refilled evenly over window_sec. Once the real budget
+    is learned from rate limit headers, the remaining count is used as is
+    until the reset time, and then the bucket is refilled to the limit.
+    min_interval_sec keeps a minimum spacing between calls regardless of
+    the budget. limit=None means no budget (min_interval_sec only).
+    """
+
+    def __init__(self, limit=None, window_sec=None, min_interval_sec=0,
+                 clock=time.time):
+        self.limit = limit
+        self.window_sec = window_sec
+        self.min_interval_sec = min_interval_sec
+        self.clock = clock
+
+        self.tokens = float(limit) if limit else 0.0
+        self.reset_at = None
+        self.updated_at = clock()
+        self.last_acquired_at = None
+
+    def __str__(self):
+        return 'limit={}, window_sec={}, tokens={}, reset_at={}' \
+            .format(self.limit, self.window_sec, self.tokens, self.reset_at)
+
+    def __repr__(self):
+        return 'TokenBucket<{}, {}, {}, {}>' \
+            .format(self.limit, self.window_sec, self.tokens, self.reset_at)
+
+    def _refill(self, now):
+        if self.reset_at is not None:
+            # Learned budget: nothing is refilled until the reset time.
+            if now >= self.reset_at:
+                self.tokens = float(self.limit or 0)
+                self.reset_at = None
+        elif self.limit and self.window_sec:
+            elapsed = max(now - self.updated_at, 0)
+            self.tokens = min(float(self.limit),
+                              self.tokens + elapsed * self.limit / float(self.window_sec))
+        self.updated_at = now
+
+    def wait_time(self, now=None):
+        """Return seconds to wait until the next call is allowed."""
+        now = self.clock() if now is None else now
+        self._refill(now)
+        wait_sec = 0
+        if self.last_acquired_at is not None:
+            wait_sec = self.last_acquired_at + self.min_interval_sec - now
+        if self.limit and self.tokens < 1:
+            if self.reset_at is not None:
+                budget_wait_sec = self.reset_at - now
+            elif self.window_sec:
+                budget_wait_sec = (1 - self.tokens) * self.window_sec / float(self.limit)
+            else:
+                budget_wait_sec = 0
+            wait_sec = max(wait_sec, budget_wait_sec)
+        return max(wait_sec, 0)
+
+    def consume(self, now=None):
+        now = self.clock() if now is None else now
+        self._refill(now)
+        if self.limit:
+            self.tokens = max(self.tokens - 1, 0)
+        self.last_acquired_at = now
+
+    def update(self, limit, remaining, reset_at):
+        """Set the real budget reported by the server."""
+        now = self.clock()
+        self._refill(now)
+        if limit is not None:
+            self.limit = limit
+            if not self.window_sec and reset_at is not None:
+                self.window_sec = max(reset_at - now, 1)
+        if remaining is not None:
+            self.tokens = float(remaining)
+        if reset_at is not None and reset_at > now:
+            self.reset_at = reset_at
+
+
+class RateLimitScheduler(object):
+    """Paces API calls per endpoint family just in time.
+
+    A call waits only when the family has no budget left (or was called
+    less than min_interval_sec ago). When api is specified, the budget of
+    twitter families is learned from the rate limit headers of
+    api.last_response set by each call, as tweepy sets it. When calls run
+    concurrently, api.last_response must be kept per thread.
+    """
+    # family: (limit, window_sec)
+    TWITTER_LIMITS = {
+        'statuses/update': (300, 3 * 60 * 60),
+        'friendships': (400, 24 * 60 * 60),
+        'followers/ids': (15, 15 * 60),
+        'friends/ids': (15, 15 * 60),
+        'statuses/mentions': (15, 15 * 60),
+    }
+
+    # Niconico does not report its budget, so these only burst up to
+    # NICO_BURST calls and then keep one call per fetch_sleep_sec.
+    NICO_FAMILIES = ['nico/search', 'nico/getflv', 'nico/msg']
+    NICO_BURST = 10
+
+    HEADER_LIMIT = 'x-rate-limit-limit'
+    HEADER_REMAINING = 'x-rate-limit-remaining'
+    HEADER_RESET = 'x-rate-limit-reset'
+
+    def __init__(self, api=None, limits=None, min_intervals=None,
+                 clock=time.time, sleep=time.sleep):
+        self.api = api
+        self.limits = dict(RateLimitScheduler.TWITTER_LIMITS)
+        self.limits.update(limits or {})
+        self.min_intervals = min_intervals or {}
+        self.clock = clock
+        self.sleep = sleep
+
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def nico_limits(cls, fetch_sleep_sec):
+        """Make limits of niconico families from fetch_sleep_sec."""
+        if not fetch_sleep_sec:
+            return {}
+        return dict((family, (cls.NICO_BURST, cls.NICO_BURST * fetch_sleep_sec))
+                    for family in cls.NICO_FAMILIES)
+
+    def bucket(self, family):
+        with self._lock:
+            return self._bucket(family)
+
+    def _bucket(self, family):
+        bucket = self.buckets.get(family)
+        if bucket is None:
+            limit, window_sec = self.limits.get(family, (None, None))
+            bucket = TokenBucket(limit, window_sec,
+                                 self.min_intervals.get(family, 0),
+                                 clock=self.clock)
+            self.buckets[family] = bucket
+        return bucket
+
+    def acquire(self, family):
+        """Wait until the family has budget, then use one token."""
+        while True:
+            with self._lock:
+                bucket = self._bucket(family)
+                wait_sec = bucket.wait_time()
+                if wait_sec <= 0:
+                    bucket.consume()
+                    return
+            logger.info('Sleep {:.2f}sec... (rate limit: {})'
+                        .format(wait_sec, family))
+            self.sleep(wait_sec)
+
+    def call(self, family, func, *args, **kwargs):
+        """Run func(*args, **kwargs) within the budget of family."""
+        # Only twitter reports its budget, and only the response of this
+        # call tells the budget of family.
+        is_learning = self.api is not None \
+            and family not in RateLimitScheduler.NICO_FAMILIES
+        self.acquire(family)
+        if is_learning:
+            self.api.last_response = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if is_learning:
+                self.learn(family, getattr(self.api, 'last_response', None))
+
+    def learn(self, family, response):
+        """Update the budget of family from rate limit headers."""
+        if response is None:
+            return
+        limit = _get_int_header(response, RateLimitScheduler.HEADER_LIMIT)
+        remaining = _get_int_header(response, RateLimitScheduler.HEADER_REMAINING)
+        reset_at = _get_int_header(response, RateLimitScheduler.HEADER_RESET)
+        if limit is None and remaining is None:
+            return
+        with self._lock:
+            bucket = self._bucket(family)
+            bucket.update(limit, remaining, reset_at)
+        logger.debug('Rate limit of {} : {}'.format(family, bucket))
+
+
+def _get_int_header(response, name):
+    if hasattr(response, 'getheader'):
+        value = response.getheader(name)
+    else:
+        value = response.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class HostLimiter(object):
+    """Limits the number of requests in flight per host."""
+
+    def __init__(self, max_per_host=2):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = semaphore
+            return semaphore
+
+    def acquire(self, url):
+        """Wait for a slot of the host of url."""
+        self._semaphore(urlparse.urlparse(url).netloc).acquire()
+
+    def release(self, url):
+        self._semaphore(urlparse.urlparse(url).netloc).release()
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        """Hold a slot of the host of url while in the with block."""
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+
+def backoff_sec(retry_count, base_sec, max_sec, rand=random.random):
+    """Return seconds to sleep before the retry_count-th retry.
+
+    The upper bound doubles per retry from base_sec up to max_sec, and the
+    sleep is drawn uniformly below it (full jitter), so clients failing
+    together do not retry together.
+    """
+    if retry_count <= 0:
+        return 0
+    return rand() * min(max_sec, base_sec * 2 ** (retry_count - 1))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of requesting a host known to be down."""
+
+
+class _CircuitState(object):
+    def __init__(self):
+        # The number of consecutive failures.
+        self.failure_count = 0
+        # Time when the circuit opened. (None: closed)
+        self.opened_at = None
+        # True while a trial request of a half open circuit is running.
+        self.is_trying = False
+
+
+class HostCircuitBreaker(object):
+    """Fails fast on hosts with consecutive failures.
+
+    After failure_threshold consecutive failures the circuit of a host
+    opens, and requests to it raise CircuitOpenError for reset_sec. Then
+    one trial request is let through (half open): its success closes the
+    circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_sec=60, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_sec = reset_sec
+        self.clock = clock
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def before(self, url):
+        """Raise CircuitOpenError if the host of url must not be requested."""
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            state = self._states.get(host)
+            if state is None or state.opened_at is None:
+                return
+            if state.is_trying \
+                    or self.clock() - state.opened_at < self.reset_sec:
+                raise CircuitOpenError('Circuit open: host={}, failures={}'
+                                       .format(host, state.failure_count))
+            state.is_trying = True
+
+    def success(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            state = self._states.pop(host, None)
+        if state is not None and state.opened_at is not None:
+            logger.info('Circuit closed: host={}'.format(host))
+
+    def failure(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            state = self._states.setdefault(host, _CircuitState())
+            state.failure_count += 1
+            state.is_trying = False
+            if state.failure_count < self.failure_threshold:
+                return
+            state.opened_at = self.clock()
+        logger.warning('Circuit open: host={}, failures={}'
+                       .format(host, state.failure_count))
+
+    def record(self, url, error=None):
+        """Record the result of a request to url. (error: the exception raised)
+
+        HTTP errors below 500 mean the host is up, so they are successes.
+        """
+        if error is None \
+                or isinstance(error, urllib2.HTTPError) and error.code < 500:
+            self.success(url)
+        else:
+            self.failure(url)
+
+    @contextlib.contextmanager
+    def guard(self, url):
+        """Check the circuit of url and record the result of the with block."""
+        self.before(url)
+        try:
+            yield
+        except Exception as e:
+            self.record(url, e)
+            raise
+        self.record(url)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import bisect
+import datetime
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+
+class IdSnapshot(object):
+    """Sorted unique ids stored as little-endian int64 and read via mmap."""
+    ITEM_SIZE = 8
+    # The number of ids to unpack at once when iterating.
+    ITER_CHUNK_SIZE = 4096
+    # The number of ids sorted in memory at once when writing.
+    RUN_SIZE = 1 << 18
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size % IdSnapshot.ITEM_SIZE:
+            self._file.close()
+            raise Exception('Broken snapshot file: path={}, size={}'
+                            .format(path, size))
+        self._len = size // IdSnapshot.ITEM_SIZE
+        self._mmap = None
+        if size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('IdSnapshot index out of range')
+        return struct.unpack_from('<q', self._mmap,
+                                  index * IdSnapshot.ITEM_SIZE)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self._len, IdSnapshot.ITER_CHUNK_SIZE):
+            count = min(IdSnapshot.ITER_CHUNK_SIZE, self._len - start)
+            for user_id in struct.unpack_from('<{}q'.format(count), self._mmap,
+                                              start * IdSnapshot.ITEM_SIZE):
+                yield user_id
+
+    def __contains__(self, user_id):
+        index = bisect.bisect_left(self, user_id)
+        return index < self._len and self[index] == user_id
+
+    def __str__(self):
+        return 'path={}, len={}'.format(self.path, self._len)
+
+    def __repr__(self):
+        return 'IdSnapshot<{}, {}>'.format(self.path, self._len)
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    @classmethod
+    def write(cls, path, ids, run_size=None):
+        """Write ids to path as a snapshot file, then open it.
+
+        ids are sorted in runs of run_size ids written next to path, and
+        the runs are merged, so memory use does not grow with ids.
+        """
+        run_size = run_size or IdSnapshot.RUN_SIZE
+        tmp_path = path + '.tmp'
+        run_paths = []
+        try:
+            it = iter(ids)
+            while True:
+                run = sorted(set(itertools.islice(it, run_size)))
+                if not run:
+                    break
+                run_path = '{}.run{}'.format(path, len(run_paths))
+                _write_ids(run_path, run)
+                run_paths.append(run_path)
+
+            runs = [cls(run_path) for run_path in run_paths]
+            try:
+                _write_ids(tmp_path, _unique(heapq.merge(*runs)))
+            finally:
+                for run in runs:
+                    run.close()
+        finally:
+            for run_path in run_paths:
+                os.remove(run_path)
+        os.rename(tmp_path, path)
+        return cls(path)
+
+
+def _write_ids(path, ids):
+    """Write an iterable of ids to path as int64."""
+    it = iter(ids)
+    with open(path, 'wb') as f:
+        while True:
+            chunk = list(itertools.islice(it, IdSnapshot.ITER_CHUNK_SIZE))
+            if not chunk:
+                break
+            f.write(struct.pack('<{}q'.format(len(chunk)), *chunk))
+
+
+def _unique(sorted_ids):
+    """Yield ascending ids without duplicates."""
+    prev_id = None
+    for user_id in sorted_ids:
+        if user_id != prev_id:
+            yield user_id
+            prev_id = user_id
+
+
+class IdSpool(object):
+    """Append-only int64 id file used while ids are being fetched."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._file = open(path, 'ab' if resume else 'wb')
+        if resume:
+            # Drop a partially written id left by an interrupted run.
+            size = os.fstat(self._file.fileno()).st_size
+            self._file.truncate(size - size % IdSnapshot.ITEM_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def append(self, ids):
+        """Append ids and flush them to disk."""
+        for start in xrange(0, len(ids), IdSnapshot.ITER_CHUNK_SIZE):
+            chunk = ids[start:start + IdSnapshot.ITER_CHUNK_SIZE]
+            self._file.write(struct.pack('<{}q'.format(len(chunk)), *chunk))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def diff_sorted(old_ids, new_ids):
+    """Compare two ascending id sequences by a linear merge.
+
+    Returns (added ids, removed ids).
+    """
+    added = []
+    removed = []
+    old_it = iter(old_ids)
+    new_it = iter(new_ids)
+    old_id = next(old_it, None)
+    new_id = next(new_it, None)
+    while old_id is not None and new_id is not None:
+        if old_id == new_id:
+            old_id = next(old_it, None)
+            new_id = next(new_it, None)
+        elif old_id < new_id:
+            removed.append(old_id)
+            old_id = next(old_it, None)
+        else:
+            added.append(new_id)
+            new_id = next(new_it, None)
+    while old_id is not None:
+        removed.append(old_id)
+        old_id = next(old_it, None)
+    while new_id is not None:
+        added.append(new_id)
+        new_id = next(new_it, None)
+    return added, removed
+
+
+class SnapshotStore(object):
+    """Directory of the latest IdSnapshot per name.
+
+    A new snapshot is staged with stage() and becomes the latest only
+    after commit(), so a failed run is compared against the same snapshot
+    on the next run.
+    """
+    SUFFIX = '.ids'
+    STAGED_SUFFIX = '.ids.new'
+    SPOOL_SUFFIX = '.ids.spool'
+    STAMP_SUFFIX = '.stamp'
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def load(self, name):
+        """Open the latest snapshot, or return None when not exists."""
+        path = self._path(name, SnapshotStore.SUFFIX)
+        if not os.path.isfile(path):
+            return None
+        return IdSnapshot(path)
+
+    def stage(self, name, ids):
+        """Write ids as the next snapshot and open it."""
+        return IdSnapshot.write(self._path(name, SnapshotStore.STAGED_SUFFIX),
+                                ids)
+
+    def has_spool(self, name):
+        return os.path.isfile(self._path(name, SnapshotStore.SPOOL_SUFFIX))
+
+    def open_spool(self, name, resume=False):
+        """Open the spool of name, appending to it when resume is True."""
+        return IdSpool(self._path(name, SnapshotStore.SPOOL_SUFFIX), resume)
+
+    def stage_spool(self, name):
+        """Stage the ids in the spool of name and remove the spool."""
+        spool_path = self._path(name, SnapshotStore.SPOOL_SUFFIX)
+        with IdSnapshot(spool_path) as spool:
+            staged = self.stage(name, spool)
+        os.remove(spool_path)
+        return staged
+
+    def get_stamp(self, name):
+        """Return the datetime of the last stamp(name), or None."""
+        path = self._path(name, SnapshotStore.STAMP_SUFFIX)
+        if not os.path.isfile(path):
+            return None
+        return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+    def stamp(self, name):
+        """Record the current time as the stamp of name."""
+        with open(self._path(name, SnapshotStore.STAMP_SUFFIX), 'w'):
+            pass
+
+    def commit(self, name):
+        """Make the staged snapshot the latest."""
+        staged_path = self._path(name, SnapshotStore.STAGED_SUFFIX)
+        path = self._path(name, SnapshotStore.SUFFIX)
+        logger.debug('Commit snapshot : {} -> {}'.format(staged_path, path))
+        os.rename(staged_path, path)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import datetime
+import logging
+import threading
+
+from models import NicoThreadWatermark
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadWatermarks(object):
+    """The last comment seen per (scope, comment thread).
+
+    Like CommentInfoCache, the database is read and written only by the
+    thread owning the session (preload() and save()), and fetch threads
+    use get() and update() in memory.
+    """
+
+    def __init__(self, db_manager, keep_days=30):
+        self.db_manager = db_manager
+        self.keep_days = keep_days
+
+        # (scope, thread_id): (last_no, last_date)
+        self._marks = {}
+        self._dirty_keys = set()
+        self._loaded_scopes = set()
+        self._lock = threading.Lock()
+
+    def preload(self, scope):
+        """Read watermarks of scope from the database."""
+        if scope in self._loaded_scopes:
+            return
+        watermarks = self.db_manager.db_session.query(NicoThreadWatermark) \
+            .filter(NicoThreadWatermark.scope == scope).all()
+        with self._lock:
+            for watermark in watermarks:
+                self._marks.setdefault((scope, watermark.thread_id),
+                                       (watermark.last_no, watermark.last_date))
+            self._loaded_scopes.add(scope)
+
+    def get(self, scope, thread_id):
+        """Return the last comment number seen, or None."""
+        with self._lock:
+            mark = self._marks.get((scope, thread_id))
+        return mark[0] if mark else None
+
+    def update(self, scope, thread_id, last_no, last_date):
+        """Move the watermark forward to last_no."""
+        key = (scope, thread_id)
+        with self._lock:
+            mark = self._marks.get(key)
+            if mark and mark[0] >= last_no:
+                return
+            self._marks[key] = (last_no, last_date)
+            self._dirty_keys.add(key)
+
+    def save(self):
+        """Write moved watermarks to the database session, and delete the
+        ones not moved for keep_days."""
+        with self._lock:
+            marks = dict((key, self._marks[key]) for key in self._dirty_keys)
+            self._dirty_keys = set()
+
+        db_session = self.db_manager.db_session
+        now = datetime.datetime.now()
+        for (scope, thread_id), (last_no, last_date) in marks.items():
+            db_session.merge(NicoThreadWatermark(scope, thread_id, last_no,
+                                                 last_date, now))
+        expired_at = now - datetime.timedelta(days=self.keep_days)
+        db_session.query(NicoThreadWatermark) \
+            .filter(NicoThreadWatermark.updated_at < expired_at) \
+            .delete(synchronize_session=False)
+        db_session.flush()
@@ -3,22 +3,55 @@
 
 from __future__ import print_function
 import datetime
+import itertools
 import logging
+import os
 import sqlalchemy
-import time
+import threading
 import tweepy
 
+import follow_graph
+import migration
+import posted_videos
 import prettyprint
+import snapshot
 import utils
 from config import Config
 from database import DbManager
-from models import Job, User, PostVideo
+from executor import BoundedExecutor
+from fetch_memo import FetchMemo
+from models import (Job, User, PostVideo, FetchCursor, OutboxMessage,
+                    NicoLoginSession, NicoCommentInfo, NicoThreadWatermark,
+                    YoutubeWatermark, YoutubeWatermarkVideo)
 from niconico import NicoSearch
+from outbox import Outbox
+from scheduler import HostCircuitBreaker, RateLimitScheduler
 from youtube import YoutubeSearch
 
 logger = logging.getLogger(__name__)
 
 
+class TwitterApi(tweepy.API):
+    """tweepy.API which keeps last_response per thread.
+
+    RateLimitScheduler learns the budget from last_response after each
+    call, and calls run concurrently (e.g. friendships), so each thread
+    must see the response of its own call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        tweepy.API.__init__(self, *args, **kwargs)
+
+    @property
+    def last_response(self):
+        return getattr(self._local, 'last_response', None)
+
+    @last_response.setter
+    def last_response(self, response):
+        self._local.last_response = response
+
+
 class TwitterBotBase(object):
     CONFIG_SECTION_TWITTER_BOT = 'twitter'
 
@@ -45,18 +78,24 @@ class TwitterBotBase(object):
         # Create tweepy api.
         auth = tweepy.OAuthHandler(self.consumer_key, self.consumer_secret)
         auth.set_access_token(self.access_token, self.access_token_secret)
-        self.api = tweepy.API(auth)
+        self.api = TwitterApi(auth)
         self.is_test = False
 
+        # Pace API calls by rate limits.
+        # (Tweets are kept at least sleep_time_sec apart.)
+        self.scheduler = RateLimitScheduler(
+            api=self.api, min_intervals={'statuses/update': sleep_time_sec})
+
     def tweet_msg(self, msg, is_sleep=False):
+        """Tweet msg.
+
+        is_sleep is kept for compatibility. Tweets are paced by
+        self.scheduler just before each call instead of sleeping after it.
+        """
         logger.info('Tweet : {}'.format(msg))
         if self.is_test:
             return
-        try:
-            self.api.update_status(msg)
-        finally:
-            if is_sleep:
-                time.sleep(self.sleep_time_sec)
+        self.scheduler.call('statuses/update', self.api.update_status, msg)
 
     def tweet_msgs(self, msgs):
         if not msgs:
@@ -82,99 +121,178 @@ class TwitterBotBase(object):
 
 class TwitterBot(TwitterBotBase, DbManager):
     FOLLOW_MARGIN = 100
-
-    def __init__(self, bot_config, sleep_time_sec=1):
+    FRIENDSHIP_COMMIT_BATCH_SIZE = 20
+    SNAPSHOT_DIR = 'snapshots'
+    # Days between passes reconciling all followers and friends, which fix
+    # users whose status drifted from the snapshots without a diff.
+    # (e.g. a follow request to a protected account still pending)
+    FULL_RECONCILE_DAYS = 7
+
+    def __init__(self, bot_config, sleep_time_sec=1, snapshot_dir=None):
         # Init TwitterBotBase.
         TwitterBotBase.__init__(self, bot_config, sleep_time_sec)
 
         # Init DbManager.
         DbManager.__init__(self)
 
-    def _get_follower_ids(self, user_id=None):
-        """Get all followers id list of a specified user."""
-        followers = []
+        self.snapshot_dir = snapshot_dir or TwitterBot.SNAPSHOT_DIR
+
+    def _iter_id_pages(self, family, api_func, user_id=None,
+                       checkpoint_name=None, resume=True):
+        """Yield id pages of a cursored api function as they arrive.
+
+        When checkpoint_name is specified, the next cursor is saved to
+        database (and committed together with the caller's changes) after
+        each page is processed, so an interrupted fetch resumes from there.
+        """
+        checkpoint = None
         cursor = -1
+        if checkpoint_name:
+            checkpoint = self.db_session.query(FetchCursor).get(checkpoint_name)
+            if checkpoint and resume:
+                cursor = checkpoint.cursor
+                logger.info('Resume fetching : {}'.format(checkpoint))
+            elif checkpoint:
+                checkpoint.cursor = cursor
+            else:
+                checkpoint = FetchCursor(checkpoint_name, cursor)
+                self.db_session.add(checkpoint)
+                self.db_session.flush()
+
         while True:
             # ret = ([id-list], (position, rest))
-            ret = self.api.followers_ids(user_id, cursor=cursor)
-            followers += ret[0]
+            ret = self.scheduler.call(family, api_func, user_id, cursor=cursor)
+            yield ret[0]
             cursor = ret[1][1]
+            if checkpoint:
+                if cursor == 0:
+                    self.db_session.delete(checkpoint)
+                else:
+                    checkpoint.cursor = cursor
+                    checkpoint.updated_at = datetime.datetime.now()
+                self.commit()
             if cursor == 0:
                 break
-        return followers
 
-    def _get_friend_ids(self, user_id=None):
-        """Get all frienda id list of a specified user."""
-        friends = []
-        cursor = -1
-        while True:
-            ret = self.api.friends_ids(user_id, cursor=cursor)
-            friends += ret[0]
-            cursor = ret[1][1]
-            if cursor == 0:
-                break
-        return friends
+    def _harvest_ids(self, store, name, family, api_func):
+        """Fetch all ids of my account into the staged snapshot of name.
+
+        Pages are spooled to disk as they arrive, so an interrupted harvest
+        resumes at the checkpointed cursor on the next run.
+        """
+        resume = store.has_spool(name)
+        with store.open_spool(name, resume) as spool:
+            for ids in self._iter_id_pages(family, api_func,
+                                           checkpoint_name=name,
+                                           resume=resume):
+                spool.append(ids)
+        return store.stage_spool(name)
 
     def create_database(self):
-        """Create database and table definition."""
+        """Create database and table definition.
+
+        An existing database is upgraded to the latest schema.
+        """
         logger.info('Create database : db_name={}'.format(self.db_name))
         User.metadata.create_all(self.db_engine)
         Job.metadata.create_all(self.db_engine)
         PostVideo.metadata.create_all(self.db_engine)
+        FetchCursor.metadata.create_all(self.db_engine)
+        OutboxMessage.metadata.create_all(self.db_engine)
+        NicoLoginSession.metadata.create_all(self.db_engine)
+        NicoCommentInfo.metadata.create_all(self.db_engine)
+        NicoThreadWatermark.metadata.create_all(self.db_engine)
+        YoutubeWatermark.metadata.create_all(self.db_engine)
+        YoutubeWatermarkVideo.metadata.create_all(self.db_engine)
+        version = migration.upgrade(self.db_engine)
+        logger.info('Database schema version : {}'.format(version))
+
+    def _mutate_friendships(self, user_ids, api_func, limit, success_status,
+                            failure_status, max_workers):
+        """Call api_func(user_id) for user_ids, max_workers calls in flight.
+
+        Stops after limit successful calls (limit=None means no limit).
+        follow_status of succeeded (and failed, when failure_status is not
+        None) users is updated in database and committed every
+        FRIENDSHIP_COMMIT_BATCH_SIZE users, so a crash loses at most one
+        batch of status updates.
+
+        Returns the number of successful calls.
+        """
+        def mutate(user_id):
+            self.scheduler.call('friendships', api_func, user_id)
 
-    def follow_not_following_users(self, limit=10):
-        """Follow users who are not follow."""
         date = datetime.datetime.now()
-
-        users = self.db_session.query(User) \
-            .filter(User.follow_status == User.follow_status_not_following) \
-            .order_by(User.date)
-        for user in users:
-            try:
-                # Follow on twitter.
-                logger.info('Follow user : user_id={}'.format(user.user_id))
-                self.api.create_friendship(user.user_id)
-            except:
-                # Cannot follow.
-                user.follow_status = User.follow_status_cannot_follow_back
-                user.date = date
-            else:
-                # Update db.
-                logger.info('Update user status to following : user_id={}'
-                            .format(user.user_id))
-                user.follow_status = User.follow_status_following
-                user.date = date
-                limit -= 1
-                if limit == 0:
+        user_ids = iter(user_ids)
+        success_count = 0
+        succeeded_ids = []
+        failed_ids = []
+
+        def flush():
+            follow_graph.update_follow_status(self.db_session, succeeded_ids,
+                                              success_status, date)
+            if failure_status is not None:
+                follow_graph.update_follow_status(self.db_session, failed_ids,
+                                                  failure_status, date)
+            self.commit()
+            del succeeded_ids[:]
+            del failed_ids[:]
+
+        with BoundedExecutor(max_workers) as executor:
+            while limit is None or success_count < limit:
+                # Do not call more than the rest of limit at once.
+                wave_size = executor.max_workers
+                if limit is not None:
+                    wave_size = min(wave_size, limit - success_count)
+                wave = list(itertools.islice(user_ids, wave_size))
+                if not wave:
                     break
-        self.commit()
 
-    def unfollow_not_followers(self, limit=-1):
+                for user_id, (is_success, error) in zip(wave, executor.map(mutate, wave)):
+                    if is_success:
+                        logger.info('Update user follow_status to {} : user_id={}'
+                                    .format(success_status, user_id))
+                        succeeded_ids.append(user_id)
+                        success_count += 1
+                    else:
+                        logger.info('Friendship update failed : user_id={}, error={}'
+                                    .format(user_id, error))
+                        failed_ids.append(user_id)
+
+                if len(succeeded_ids) + len(failed_ids) >= self.FRIENDSHIP_COMMIT_BATCH_SIZE:
+                    flush()
+        flush()
+        return success_count
+
+    def follow_not_following_users(self, limit=10, max_workers=4):
+        """Follow users who are not follow."""
+        user_ids = [row[0] for row in self.db_session.query(User.user_id)
+                    .filter(User.follow_status == User.follow_status_not_following)
+                    .order_by(User.date)]
+        logger.info('Follow users : candidates={}, limit={}'
+                    .format(len(user_ids), limit))
+        # Follow until limit users are followed. (limit <= 0: no limit)
+        self._mutate_friendships(user_ids, self.api.create_friendship,
+                                 limit if limit > 0 else None,
+                                 User.follow_status_following,
+                                 User.follow_status_cannot_follow_back,
+                                 max_workers)
+
+    def unfollow_not_followers(self, limit=-1, max_workers=4):
         """Unfollow friends who don't follow back."""
-        date = datetime.datetime.now()
-
-        users = self.db_session.query(User) \
-            .filter(sqlalchemy
-            .and_(User.follower_status == User.follower_status_not_follower,
-                  User.follow_status == User.follow_status_following)).order_by(User.date)
-        for user in users:
-            try:
-                # Unfollow on twitter
-                logger.info('Unfollow user : user_id={}'.format(user.user_id))
-                self.api.destroy_friendship(user.user_id)
-            except:
-                # Cannot unfollow
-                pass
-            else:
-                # Update db
-                logger.info('Update user status to unfollowing : user_id={}'
-                            .format(user.user_id))
-                user.follow_status = User.follow_status_removed
-                user.date = date
-                limit -= 1
-                if limit <= 0:
-                    break
-        self.commit()
+        user_ids = [row[0] for row in self.db_session.query(User.user_id)
+                    .filter(sqlalchemy
+                    .and_(User.follower_status == User.follower_status_not_follower,
+                          User.follow_status == User.follow_status_following))
+                    .order_by(User.date)]
+        logger.info('Unfollow users : candidates={}, limit={}'
+                    .format(len(user_ids), limit))
+        # Unfollow until limit users are unfollowed. (at least one user)
+        # Users who cannot be unfollowed are left as is.
+        self._mutate_friendships(user_ids, self.api.destroy_friendship,
+                                 max(limit, 1),
+                                 User.follow_status_removed, None,
+                                 max_workers)
 
     def limit_friends(self):
         me = self.api.me()
@@ -189,7 +307,7 @@ class TwitterBot(TwitterBotBase, DbManager):
 
     def retweet_mentions(self, since):
         """Retweet mentions."""
-        statuses = self.api.mentions()
+        statuses = self.scheduler.call('statuses/mentions', self.api.mentions)
         for status in statuses:
             created_at = utils.utc_str2local_datetime(status.created_at)
             if created_at < since:
@@ -216,58 +334,106 @@ class TwitterBot(TwitterBotBase, DbManager):
                 return
 
     def make_follow_list_from_followers(self, target_user_id):
-        """Make user list to follow from the followers of specified user."""
+        """Make user list to follow from the followers of specified user.
+
+        Candidates are added page by page and the fetch resumes from the
+        last processed page when it was interrupted.
+
+        Returns (the number of new candidates, the number of known users).
+        """
         logger.debug('Enter make_follow_list_from_followers()')
 
         target_user = self.api.get_user(target_user_id)
-        follow_candidate_ids = set(self._get_follower_ids(target_user.id))
+        checkpoint_name = 'followers:{}'.format(target_user.id)
 
         date = datetime.datetime.now()
 
-        count = 0
-        for candidate_id in follow_candidate_ids:
-            try:
-                self.db_session.query(User).filter(User.user_id == candidate_id).one()
-            except sqlalchemy.orm.exc.NoResultFound:
-                # Add user when not follow
-                logger.info('Add new following candidate : id={}'
-                            .format(candidate_id))
-                user = User(candidate_id, User.follow_status_not_following,
-                            User.follower_status_not_follower, date)
-                self.db_session.add(user)
-                count += 1
+        num_new = 0
+        num_known = 0
+        pages = self._iter_id_pages('followers/ids', self.api.followers_ids,
+                                    target_user.id,
+                                    checkpoint_name=checkpoint_name)
+        for follow_candidate_ids in pages:
+            follow_candidate_ids = set(follow_candidate_ids)
+
+            # Add users when not registered.
+            known_ids = follow_graph.find_existing_user_ids(self.db_session,
+                                                            follow_candidate_ids)
+            new_ids = follow_candidate_ids - known_ids
+            follow_graph.insert_users(self.db_session, sorted(new_ids),
+                                      User.follow_status_not_following,
+                                      User.follower_status_not_follower, date)
+            num_new += len(new_ids)
+            num_known += len(known_ids)
 
         self.commit()
-        logger.info('Added new following candidates : {}'.format(count))
+        logger.info('Added new following candidates : new={}, known={}'
+                    .format(num_new, num_known))
         logger.debug('Return make_follow_list_from_followers()')
+        return num_new, num_known
 
     def update_database(self):
-        """Update database."""
+        """Update database.
+
+        Users added to or removed from the followers/friends since the
+        previous snapshot, and followers/friends whose follow_status was
+        set by a follow/unfollow call, are reconciled. All users are
+        reconciled when there is no previous snapshot, and every
+        FULL_RECONCILE_DAYS.
+        """
         logger.debug('Enter update_database()')
+        store = snapshot.SnapshotStore(self.snapshot_dir)
 
         # Get all followers and followings
-        follower_ids = set(self._get_follower_ids())
-        following_ids = set(self._get_friend_ids())
+        follower_ids = self._harvest_ids(store, 'followers', 'followers/ids',
+                                         self.api.followers_ids)
+        following_ids = self._harvest_ids(store, 'friends', 'friends/ids',
+                                          self.api.friends_ids)
+        prev_follower_ids = store.load('followers')
+        prev_following_ids = store.load('friends')
 
         date = datetime.datetime.now()
+        reconciled_at = store.get_stamp('reconcile')
+        is_full = prev_follower_ids is None or prev_following_ids is None \
+            or reconciled_at is None \
+            or date - reconciled_at >= datetime.timedelta(self.FULL_RECONCILE_DAYS)
 
-        # Register users to database.
-        for user_id in set(follower_ids) | set(following_ids):
-            follow_status = User.follow_status_following if user_id in following_ids \
-                else User.follow_status_not_following
-            follower_status = User.follower_status_follower if user_id in follower_ids \
-                else User.follower_status_not_follower
-            try:
-                user = self.db_session.query(User).filter(User.user_id == user_id).one()
-                user.follow_status = follow_status
-                user.follower_status = follower_status
-                user.date = date
-            except sqlalchemy.orm.exc.NoResultFound:
-                user = User(user_id, follow_status, follower_status, date)
-                self.db_session.add(user)
-                logger.info('Added user to database : user_id={}'.format(user.user_id))
-
-        self.commit()
+        try:
+            changed_ids = None
+            if not is_full:
+                changed_ids = set()
+                for prev_ids, ids in ((prev_follower_ids, follower_ids),
+                                      (prev_following_ids, following_ids)):
+                    added, removed = snapshot.diff_sorted(prev_ids, ids)
+                    changed_ids.update(added)
+                    changed_ids.update(removed)
+                logger.info('Changed users since previous snapshot : {}'
+                            .format(len(changed_ids)))
+                drifted_ids = follow_graph.find_drifted_user_ids(self.db_session,
+                                                                 follower_ids,
+                                                                 following_ids)
+                logger.info('Users to reset follow_status : {}'
+                            .format(len(drifted_ids)))
+                changed_ids.update(drifted_ids)
+
+            # Register users to database.
+            inserted, updated = follow_graph.upsert_users(self.db_session,
+                                                          follower_ids,
+                                                          following_ids, date,
+                                                          user_ids=changed_ids)
+            self.commit()
+        finally:
+            for ids in (follower_ids, following_ids, prev_follower_ids,
+                        prev_following_ids):
+                if ids is not None:
+                    ids.close()
+
+        store.commit('followers')
+        store.commit('friends')
+        if is_full:
+            store.stamp('reconcile')
+        logger.info('Updated users in database : inserted={}, updated={}, full={}'
+                    .format(inserted, updated, is_full))
         logger.debug('Return update_database()')
 
 
@@ -282,20 +448,112 @@ class TwitterVideoBot(TwitterBotBase):
     # (title, published_at, url)
     TW_YOUTUBE_TWEET_FORMAT = '[新着動画]YouTube - {title} [{}] | {url}'
 
-    def __init__(self, bot_config, sleep_time_sec=1):
+    # Days to keep sent messages (and their dedup keys) in the outbox.
+    OUTBOX_KEEP_DAYS = 90
+
+    # Max search result pages to find new niconico videos since the last run.
+    NICO_VIDEO_MAX_PAGES = 10
+    # Without a run in this period (the first run, or after an outage),
+    # only the first page is posted so as not to flood the timeline.
+    NICO_VIDEO_CATCH_UP_DAYS = 1
+
+    # Seconds to share search and getflv results among the jobs of a run.
+    NICO_FETCH_MEMO_TTL_SEC = 10 * 60
+
+    def __init__(self, bot_config, sleep_time_sec=1, auto_dispatch=True):
+        """
+        auto_dispatch: Post enqueued messages at the end of each *_post().
+                       When False, register dispatch_outbox() as a job to
+                       post them independently of fetching.
+        """
         # Init TwitterBotBase.
         TwitterBotBase.__init__(self, bot_config, sleep_time_sec)
+        self.auto_dispatch = auto_dispatch
 
         self.nico_user_id = self.config.get_value('user_id', section='niconico')
         self.nico_pass_word = self.config.get_value('pass_word', section='niconico')
         self.youtube_developer_key = self.config.get_value('developer_key',
                                                            section='youtube')
+        # Keep the discovery document next to the config file.
+        self.youtube_discovery_file = os.path.join(
+            os.path.dirname(os.path.abspath(bot_config)),
+            YoutubeSearch.DISCOVERY_FILE)
+
+        # Share the scheduler with NicoSearch so that all niconico jobs of
+        # a run are paced together.
+        self.scheduler.limits.update(RateLimitScheduler.nico_limits(1))
+
+        # Share search and getflv results among the niconico jobs of a run.
+        self.nico_fetch_memo = FetchMemo(self.NICO_FETCH_MEMO_TTL_SEC)
+        # A host found down by a job is skipped by the following jobs.
+        self.nico_circuit_breaker = HostCircuitBreaker()
+
+    def dispatch_outbox(self, limit=None):
+        """Post messages enqueued to the outbox."""
+        with DbManager() as db_manager:
+            outbox = Outbox(db_manager.db_session)
+            tweet_count, failed_list = outbox.dispatch(self.tweet_msg, limit)
+            outbox.prune(self.OUTBOX_KEEP_DAYS)
+
+            logger.info('dispatch_outbox(): {} tweet'.format(tweet_count))
+            if failed_list:
+                raise Exception('Tweet faild {}'
+                                .format(prettyprint.pp_str(failed_list)))
+
+    def _enqueue_msgs(self, db_manager, msgs):
+        """Enqueue [(dedup_key, msg), ] and post them when auto_dispatch."""
+        outbox = Outbox(db_manager.db_session)
+        enqueue_count = 0
+        for dedup_key, msg in msgs:
+            if outbox.enqueue(msg, dedup_key):
+                enqueue_count += 1
+        db_manager.commit()
+        logger.info('Enqueued {} tweet'.format(enqueue_count))
+
+        if self.auto_dispatch:
+            self.dispatch_outbox()
+
+    @staticmethod
+    def _keyword_formats(search_keywords, default_format):
+        """Return [(keyword, tweet_format), ] of search_keywords.
+
+        search_keywords: A list of keywords or of (keyword, tweet_format),
+                         or {keyword: tweet_format}.
+        """
+        if isinstance(search_keywords, dict):
+            search_keywords = sorted(search_keywords.items())
+        keyword_formats = []
+        for item in search_keywords:
+            if isinstance(item, basestring):
+                keyword_formats.append((item, default_format))
+            else:
+                keyword, tweet_format = item
+                keyword_formats.append((keyword, tweet_format))
+        return keyword_formats
+
+    def _make_nico_search(self, db_manager):
+        return NicoSearch(db_manager, self.nico_user_id, self.nico_pass_word,
+                          scheduler=self.scheduler,
+                          fetch_memo=self.nico_fetch_memo,
+                          circuit_breaker=self.nico_circuit_breaker)
 
     def nico_video_post(self, search_keyword, prev_datetime):
-        logger.debug('Call nico_video_post({}, {})'
-                     .format(search_keyword, prev_datetime))
+        self.nico_video_post_batch([search_keyword], prev_datetime)
+
+    def nico_video_post_batch(self, search_keywords, prev_datetime):
+        """Post new videos of search_keywords with one login and database.
+
+        A video found by several keywords is posted once, in the format of
+        the first keyword.
+        """
+        logger.debug('Call nico_video_post_batch({}, {})'
+                     .format(search_keywords, prev_datetime))
+        max_pages = 1
         if prev_datetime:
             now_date = datetime.datetime.now()
+            if now_date - prev_datetime \
+                    < datetime.timedelta(self.NICO_VIDEO_CATCH_UP_DAYS):
+                max_pages = self.NICO_VIDEO_MAX_PAGES
             if now_date - prev_datetime < datetime.timedelta(1):
                 old_prev_datetime = prev_datetime
                 prev_datetime = prev_datetime - datetime.timedelta(hours=2)
@@ -303,20 +561,31 @@ class TwitterVideoBot(TwitterBotBase):
                              .format(old_prev_datetime, prev_datetime))
 
         with DbManager() as db_manager:
-            nico = NicoSearch(db_manager, self.nico_user_id, self.nico_pass_word)
+            nico = self._make_nico_search(db_manager)
             nico.login()
-            # Search latest videos by NicoNico.
-            videos = nico.search_videos(search_keyword, prev_datetime)
-
-            tweet_count = 0
-            failed_list = []
-            for video in reversed(videos):
-                # Check if the video is already posted.
-                old_post_video = db_manager.db_session.query(PostVideo) \
-                    .filter(sqlalchemy
-                            .and_(PostVideo.video_id == video.id)).first()
-
-                if old_post_video:
+            videos = []
+            # {video_id: tweet_format}
+            tweet_formats = {}
+            for search_keyword, tweet_format in self._keyword_formats(
+                    search_keywords, self.TW_NICO_VIDEO_TWEET_FORMAT):
+                # Search latest videos by NicoNico until prev_datetime.
+                for video in nico.iter_videos(
+                        search_keyword, prev_datetime,
+                        max_count=max_pages, prefetch=max_pages > 1):
+                    if video.id in tweet_formats:
+                        continue
+                    tweet_formats[video.id] = tweet_format
+                    videos.append(video)
+
+            # Check if the videos are already posted at once.
+            post_videos = posted_videos.find_post_videos(
+                db_manager, [video.id for video in videos])
+
+            msgs = []
+            # Oldest first. (search results are newest first)
+            for video in sorted(reversed(videos),
+                                key=lambda x: x.first_retrieve):
+                if video.id in post_videos:
                     logger.debug('Skip posted video: video={}'.format(video))
                     continue
 
@@ -324,121 +593,146 @@ class TwitterVideoBot(TwitterBotBase):
                 post_video = PostVideo(video.id)
                 logger.info('Add new post_video to database : post_video={}'
                             .format(post_video))
-                db_manager.db_session.add(post_video)
+                posted_videos.add_post_video(db_manager, post_video)
+                post_videos[video.id] = post_video
 
                 # Make message for twitter.
                 str_first_retrieve = video.first_retrieve.strftime('%y/%m/%d %H:%M')
-                msg = utils.make_tweet_msg(self.TW_NICO_VIDEO_TWEET_FORMAT,
+                msg = utils.make_tweet_msg(tweet_formats[video.id],
                                            str_first_retrieve,
                                            title=video.title,
                                            url=video.get_url())
-                try:
-                    self.tweet_msg(msg, is_sleep=True)
-                    tweet_count += 1
-                    db_manager.db_session.commit()
-                except Exception as e:
-                    db_manager.db_session.rollback()
-                    logger.exception('Tweet failed msg={}'.format(msg))
-                    failed_list.append((e, msg))
-
-            logger.info('nico_latest_commenting_video(): {} tweet'
-                        .format(tweet_count))
-            if failed_list:
-                raise Exception('Tweet faild {}'
-                                .format(prettyprint.pp_str(failed_list)))
+                msgs.append(('nico_video:{}'.format(video.id), msg))
+
+            self._enqueue_msgs(db_manager, msgs)
 
     def nico_comment_post(self, search_keyword, prev_datetime,
                           max_comment_num=1500, max_tweet_num_per_video=3,
                           filter_func=None):
-        logger.debug('Call nico_comment_post({}, {}, {}, {}, {})'
-                     .format(search_keyword, prev_datetime, max_comment_num,
+        self.nico_comment_post_batch([search_keyword], prev_datetime,
+                                     max_comment_num, max_tweet_num_per_video,
+                                     filter_func)
+
+    def nico_comment_post_batch(self, search_keywords, prev_datetime,
+                                max_comment_num=1500,
+                                max_tweet_num_per_video=3, filter_func=None):
+        """Post latest comments of search_keywords with one login and
+        database.
+
+        Comments of a video found by several keywords are fetched once, for
+        the first keyword.
+        """
+        logger.debug('Call nico_comment_post_batch({}, {}, {}, {}, {})'
+                     .format(search_keywords, prev_datetime, max_comment_num,
                              max_tweet_num_per_video, filter_func))
         with DbManager() as db_manager:
-            nico = NicoSearch(db_manager, self.nico_user_id, self.nico_pass_word)
+            nico = self._make_nico_search(db_manager)
             nico.login()
-            # Search latest comments by NicoNico.
-            videos = nico.search_videos_with_comments(search_keyword,
-                                                      prev_datetime,
-                                                      max_comment_num)
-            tweet_count = 0
-            failed_list = []
-            for video in videos:
-                if filter_func and filter_func(video):
-                    continue
-                for nico_comment in video.get_latest_comments(max_tweet_num_per_video):
-                    # Make message for twitter.
-                    msg = utils.make_tweet_msg(self.TW_NICO_COMMENT_TWEET_FORMAT,
-                                               nico_comment.vpos,
-                                               nico_comment.post_datetime,
-                                               comment=nico_comment.comment,
-                                               title=video.title,
-                                               url=video.get_url())
-                    try:
-                        self.tweet_msg(msg, is_sleep=True)
-                        tweet_count += 1
-                    except Exception as e:
-                        logger.exception('Tweet failed msg={}'.format(msg))
-                        failed_list.append((e, msg))
-
-            logger.info('nico_latest_commenting_video(): {} tweet'
-                        .format(tweet_count))
-            if failed_list:
-                raise Exception('Tweet faild {}'
-                                .format(prettyprint.pp_str(failed_list)))
+            seen_video_ids = set()
+            msgs = []
+            for search_keyword, tweet_format in self._keyword_formats(
+                    search_keywords, self.TW_NICO_COMMENT_TWEET_FORMAT):
+                # Search latest comments by NicoNico.
+                videos = nico.search_videos_with_comments(
+                    search_keyword, prev_datetime, max_comment_num,
+                    max_tweet_num_per_video, seen_video_ids)
+                for video in videos:
+                    if filter_func and filter_func(video):
+                        continue
+                    for nico_comment in video.get_latest_comments(max_tweet_num_per_video):
+                        # Make message for twitter.
+                        msg = utils.make_tweet_msg(tweet_format,
+                                                   nico_comment.format_vpos(),
+                                                   nico_comment.post_datetime,
+                                                   comment=nico_comment.comment,
+                                                   title=video.title,
+                                                   url=video.get_url())
+                        dedup_key = 'nico_comment:{}:{}'.format(video.id,
+                                                                nico_comment.no)
+                        msgs.append((dedup_key, msg))
+
+            self._enqueue_msgs(db_manager, msgs)
 
     def nico_latest_commenting_video_post(self, search_keyword, prev_datetime,
                                           number_of_results=3, expire_days=30,
                                           max_post_count=1):
-        logger.debug('Call nico_latest_commenting_video_post({}, {}, {}, {}, {})'
-                     .format(search_keyword, prev_datetime, number_of_results,
+        self.nico_latest_commenting_video_post_batch(
+            [search_keyword], prev_datetime, number_of_results, expire_days,
+            max_post_count)
+
+    def nico_latest_commenting_video_post_batch(self, search_keywords,
+                                                prev_datetime,
+                                                number_of_results=3,
+                                                expire_days=30,
+                                                max_post_count=1):
+        """Post latest commenting videos of search_keywords with one login
+        and database.
+
+        Up to number_of_results videos are posted per keyword. A video found
+        by several keywords is posted once, for the first keyword.
+        """
+        logger.debug('Call nico_latest_commenting_video_post_batch({}, {}, {}, {}, {})'
+                     .format(search_keywords, prev_datetime, number_of_results,
                              expire_days, max_post_count))
         with DbManager() as db_manager:
-            nico = NicoSearch(db_manager, self.nico_user_id, self.nico_pass_word)
+            nico = self._make_nico_search(db_manager)
             nico.login()
-            # Search latest commenting videos by NicoNico.
-            it = nico.search_latest_commenting_videos(search_keyword,
-                                                      prev_datetime,
-                                                      number_of_results,
-                                                      expire_days,
-                                                      max_post_count)
-            tweet_count = 0
-            failed_list = []
-            for video in it:
-                # Make message to tweet.
-                str_first_retrieve = video.first_retrieve.strftime('%y/%m/%d %H:%M')
-                msg = utils.make_tweet_msg(self.TW_NICO_DETAIL_VIDEO_TWEET_FORMAT,
-                                           str_first_retrieve,
-                                           video.view_counter,
-                                           video.num_res,
-                                           video.mylist_counter,
-                                           title=video.title,
-                                           url=video.get_url())
-                try:
-                    self.tweet_msg(msg, is_sleep=True)
-                    tweet_count += 1
-                    db_manager.db_session.commit()
-                except Exception as e:
-                    db_manager.db_session.rollback()
-                    logger.exception('Tweet failed msg={}'.format(msg))
-                    failed_list.append((e, msg))
-
-            logger.info('nico_latest_commenting_video(): {} tweet'
-                        .format(tweet_count))
-            if failed_list:
-                raise Exception('Tweet faild {}'
-                                .format(prettyprint.pp_str(failed_list)))
+            # A video may be posted again after expire_days.
+            str_today = datetime.date.today().strftime('%Y%m%d')
+            seen_video_ids = set()
+            msgs = []
+            for search_keyword, tweet_format in self._keyword_formats(
+                    search_keywords, self.TW_NICO_DETAIL_VIDEO_TWEET_FORMAT):
+                # Search latest commenting videos by NicoNico.
+                it = nico.search_latest_commenting_videos(
+                    search_keyword, prev_datetime, number_of_results,
+                    expire_days, max_post_count, seen_video_ids=seen_video_ids)
+                for video in it:
+                    # Make message to tweet.
+                    str_first_retrieve = video.first_retrieve.strftime('%y/%m/%d %H:%M')
+                    msg = utils.make_tweet_msg(tweet_format,
+                                               str_first_retrieve,
+                                               video.view_counter,
+                                               video.num_res,
+                                               video.mylist_counter,
+                                               title=video.title,
+                                               url=video.get_url())
+                    msgs.append(('nico_detail:{}:{}'.format(video.id, str_today), msg))
+
+            self._enqueue_msgs(db_manager, msgs)
 
     def youtube_video_post(self, search_keyword, prev_datetime):
-        youtube = YoutubeSearch(self.youtube_developer_key)
-        videos = youtube.search_videos(search_keyword, prev_datetime)
-        if not videos:
-            logger.info('youtube_video_post(): No tweet messages')
-            return
-        # Make tweet message.
-        for video in reversed(videos):
-            str_published_at = video.published_at.strftime('%y/%m/%d %H:%M')
-            tweet_msg = utils.make_tweet_msg(self.TW_YOUTUBE_TWEET_FORMAT,
-                                             str_published_at,
-                                             title=video.title,
-                                             url=video.get_url())
-            self.tweet_msg(tweet_msg)
+        self.youtube_video_post_batch([search_keyword], prev_datetime)
+
+    def youtube_video_post_batch(self, search_keywords, prev_datetime):
+        """Post new YouTube videos of search_keywords.
+
+        A video found by several keywords is posted once, in the format of
+        the first keyword.
+        """
+        with DbManager() as db_manager:
+            # The watermarks of the keywords are committed with the
+            # messages.
+            youtube = YoutubeSearch(self.youtube_developer_key,
+                                    self.youtube_discovery_file,
+                                    db_manager=db_manager)
+            seen_video_ids = set()
+            msgs = []
+            for search_keyword, tweet_format in self._keyword_formats(
+                    search_keywords, self.TW_YOUTUBE_TWEET_FORMAT):
+                videos = youtube.search_videos(search_keyword, prev_datetime)
+                # Make tweet message.
+                for video in reversed(videos):
+                    if video.video_id in seen_video_ids:
+                        continue
+                    seen_video_ids.add(video.video_id)
+                    str_published_at = video.published_at.strftime('%y/%m/%d %H:%M')
+                    tweet_msg = utils.make_tweet_msg(tweet_format,
+                                                     str_published_at,
+                                                     title=video.title,
+                                                     url=video.get_url())
+                    msgs.append(('youtube:{}'.format(video.video_id),
+                                 tweet_msg))
+            if not msgs:
+                logger.info('youtube_video_post(): No tweet messages')
+            self._enqueue_msgs(db_manager, msgs)
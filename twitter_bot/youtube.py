@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document, DISCOVERY_URI
 import datetime
+import json
 import logging
+import os
 import re
+import threading
+import urllib2
 
 import utils
+from youtube_watermark import YoutubeWatermarks
 
 logger = logging.getLogger(__name__)
 
+# Process cache: {(discovery_file, developer_key): service}
+_services = {}
+_services_lock = threading.Lock()
+
 
 class YoutubeVideo(object):
     VIDEO_URL = 'http://www.youtube.com/watch?v='
@@ -62,35 +71,124 @@ class YoutubeVideo(object):
         return False
 
 
+def forget_services():
+    """Build the services from the discovery documents again on the next
+    use."""
+    with _services_lock:
+        _services.clear()
+
+
 class YoutubeSearch(object):
     API_SERVICE_NAME = 'youtube'
     API_VERSION = 'v3'
-
-    def __init__(self, developer_key):
+    # The discovery document is downloaded once and read from this file.
+    # (TwitterVideoBot puts it next to the config file)
+    DISCOVERY_FILE = 'youtube_v3_discovery.json'
+    DISCOVERY_TIMEOUT_SEC = 60
+    # Max results per page. (the API allows 50 at most)
+    MAX_RESULTS = 50
+    # Max pages per search.
+    MAX_PAGES = 10
+
+    def __init__(self, developer_key, discovery_file=None, discovery_url=None,
+                 db_manager=None):
+        """
+        discovery_file: Path of the saved discovery document.
+        discovery_url: URL to download the discovery document from when
+                       discovery_file does not exist.
+        db_manager: Keep the newest publishedAt seen per keyword in the
+                    database. (None: search since from_datetime every time)
+        """
         self.developer_key = developer_key
-
-    def search_videos(self, keyword, from_datetime=None):
+        self.discovery_file = discovery_file or YoutubeSearch.DISCOVERY_FILE
+        self.discovery_url = discovery_url \
+            or DISCOVERY_URI.format(api=YoutubeSearch.API_SERVICE_NAME,
+                                    apiVersion=YoutubeSearch.API_VERSION)
+        self.watermarks = YoutubeWatermarks(db_manager) if db_manager \
+            else None
+
+    def load_discovery_document(self):
+        """Return the discovery document saved in discovery_file.
+
+        It is downloaded and saved first when the file does not exist.
+        """
+        if os.path.isfile(self.discovery_file):
+            with open(self.discovery_file) as f:
+                return f.read()
+
+        logger.info('Download discovery document: url={}'
+                    .format(self.discovery_url))
+        document = urllib2.urlopen(self.discovery_url,
+                                   timeout=YoutubeSearch.DISCOVERY_TIMEOUT_SEC) \
+            .read()
+        # Never save a broken document.
+        json.loads(document)
+        directory = os.path.dirname(self.discovery_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Rename a complete file, so that it is not read half written.
+        tmp_file = self.discovery_file + '.new'
+        with open(tmp_file, 'w') as f:
+            f.write(document)
+        os.rename(tmp_file, self.discovery_file)
+        return document
+
+    def get_service(self):
+        """Return the service of developer_key, built once per process."""
+        key = (self.discovery_file, self.developer_key)
+        with _services_lock:
+            service = _services.get(key)
+            if service is None:
+                service = build_from_document(self.load_discovery_document(),
+                                              developerKey=self.developer_key)
+                _services[key] = service
+            return service
+
+    def search_videos(self, keyword, from_datetime=None, max_pages=None):
+        """Search videos published since from_datetime, newest first.
+
+        Result pages are followed by nextPageToken until a video older than
+        from_datetime or max_pages. With db_manager, only videos newer than
+        the newest one seen by the last search of keyword are returned.
+        """
         from_datetime = from_datetime or datetime.datetime.fromtimestamp(0)
+        # publishedAfter is inclusive, so the videos at the watermark are
+        # found again. The ones already seen are skipped, but another video
+        # published in the same second is not.
+        seen_video_ids = set()
+        if self.watermarks:
+            watermark = self.watermarks.get(keyword)
+            if watermark and watermark >= from_datetime:
+                logger.debug('Change from_datetime to the watermark: {} -> {}'
+                             .format(from_datetime, watermark))
+                from_datetime = watermark
+                seen_video_ids = self.watermarks.get_video_ids(keyword)
         logger.debug('Call search_videos({}, {})'.format(keyword, from_datetime))
 
         re_keyword = '|'.join([x.strip() for x in keyword.split('OR')])
         re_keyword = re.compile(re_keyword, re.I)
 
-        video_dict = {}
-        for i in range(1, 3):
-            youtube = build(YoutubeSearch.API_SERVICE_NAME,
-                            YoutubeSearch.API_VERSION,
-                            developerKey=self.developer_key)
-
+        youtube = self.get_service()
+        videos = []
+        video_ids = set()
+        newest_published_at = None
+        newest_video_ids = set()
+        page_token = None
+        for _ in range(max_pages or self.MAX_PAGES):
+            params = {}
+            if page_token:
+                params['pageToken'] = page_token
             search_response = youtube.search().list(
                 q=keyword.encode('utf-8'),
                 part='id,snippet',
-                maxResults=32,
+                maxResults=self.MAX_RESULTS,
                 type='video',
                 order='date',
                 publishedAfter=utils.local_datetime2utc_str(from_datetime),
+                **params
             ).execute()
 
+            is_last = False
             for video in search_response.get('items', []):
                 if not YoutubeVideo.is_video(video):
                     logger.debug('Skip(not video): {}'.format(video))
@@ -98,14 +196,34 @@ class YoutubeSearch(object):
                 youtube_video = YoutubeVideo.fromResponse(video)
                 logger.debug('youtube_video={}'.format(youtube_video))
 
+                if newest_published_at is None \
+                        or youtube_video.published_at > newest_published_at:
+                    newest_published_at = youtube_video.published_at
+                    newest_video_ids = set()
+                if youtube_video.published_at == newest_published_at:
+                    newest_video_ids.add(youtube_video.video_id)
                 if youtube_video.published_at < from_datetime:
+                    # Results are sorted by date, so the rest are older.
                     logger.info('Skip(tiem over): {}'.format(youtube_video))
+                    is_last = True
+                    break
+                if youtube_video.published_at == from_datetime \
+                        and youtube_video.video_id in seen_video_ids:
+                    logger.debug('Skip(seen): {}'.format(youtube_video))
                     continue
                 if not (re_keyword.search(youtube_video.title)
                         or re_keyword.search(youtube_video.description)):
                     logger.info('Skip(not incules keyword): {}'.format(youtube_video))
                     continue
-                if not youtube_video.video_id in video_dict:
-                    video_dict[youtube_video.video_id] = youtube_video
-
-        return video_dict.values()
+                if not youtube_video.video_id in video_ids:
+                    video_ids.add(youtube_video.video_id)
+                    videos.append(youtube_video)
+
+            page_token = search_response.get('nextPageToken')
+            if is_last or not page_token:
+                break
+
+        if self.watermarks and newest_published_at:
+            self.watermarks.update(keyword, newest_published_at,
+                                   newest_video_ids)
+        return videos
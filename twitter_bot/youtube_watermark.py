@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import datetime
+import logging
+
+from models import YoutubeWatermark, YoutubeWatermarkVideo
+
+logger = logging.getLogger(__name__)
+
+
+class YoutubeWatermarks(object):
+    """The newest publishedAt seen per search keyword."""
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    def get(self, keyword):
+        """Return the newest published_at seen, or None."""
+        watermark = self.db_manager.db_session.query(YoutubeWatermark) \
+            .get(_to_unicode(keyword))
+        return watermark.published_at if watermark else None
+
+    def get_video_ids(self, keyword):
+        """Return the set of ids of the videos published at the watermark."""
+        query = self.db_manager.db_session.query(YoutubeWatermarkVideo.video_id) \
+            .filter(YoutubeWatermarkVideo.keyword == _to_unicode(keyword))
+        return set(row[0] for row in query)
+
+    def update(self, keyword, published_at, video_ids=()):
+        """Move the watermark of keyword forward to published_at.
+
+        video_ids: Ids of the videos published at published_at, which are
+                   added to the ones kept for the same watermark.
+        """
+        db_session = self.db_manager.db_session
+        keyword = _to_unicode(keyword)
+        watermark = db_session.query(YoutubeWatermark).get(keyword)
+        video_ids = set(video_ids)
+        if watermark is None:
+            db_session.add(YoutubeWatermark(keyword, published_at))
+        elif watermark.published_at < published_at:
+            watermark.published_at = published_at
+            watermark.updated_at = datetime.datetime.now()
+            db_session.query(YoutubeWatermarkVideo) \
+                .filter(YoutubeWatermarkVideo.keyword == keyword) \
+                .delete(synchronize_session=False)
+        elif watermark.published_at == published_at:
+            video_ids -= self.get_video_ids(keyword)
+            if not video_ids:
+                return
+        else:
+            return
+        for video_id in video_ids:
+            db_session.add(YoutubeWatermarkVideo(keyword, video_id))
+        logger.debug('Update youtube watermark: keyword={}, published_at={}, '
+                     'video_ids={}'.format(keyword, published_at, video_ids))
+        # Saved with the transaction of the job, so a failed job searches
+        # the same videos again.
+        db_session.flush()
+
+
+def _to_unicode(keyword):
+    if isinstance(keyword, str):
+        return keyword.decode('utf-8')
+    return keyword